@@ -0,0 +1,92 @@
+"""
+Compare storage codecs on cached payloads.
+
+Usage::
+
+    python -m benchmarks.codec [payload.json ...]
+
+Payload files should contain raw trakt responses, e.g. saved output of
+``calendars/my/shows/{date}/{days}?extended=full``. Without files a synthetic
+calendar payload shaped like the trakt one is used.
+"""
+import json
+import sys
+from argparse import ArgumentParser
+from timeit import Timer
+
+from traktogram.codec import JsonCodec, MsgpackCodec, msgpack
+
+
+def make_calendar_payload(size=50):
+    overview = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor. " * 6
+    return [
+        {
+            'first_aired': f'2020-03-{i % 28 + 1:02d}T01:00:00.000Z',
+            'episode': {
+                'season': 1 + i // 12, 'number': i % 12 + 1, 'title': f'Episode title #{i}',
+                'ids': {'trakt': 3000000 + i, 'tvdb': 7000000 + i, 'imdb': f'tt{9000000 + i}', 'tmdb': 2000000 + i},
+                'number_abs': None, 'overview': overview, 'rating': 7.8, 'votes': 42,
+                'comment_count': 0, 'first_aired': f'2020-03-{i % 28 + 1:02d}T01:00:00.000Z',
+                'updated_at': '2020-03-01T10:11:12.000Z', 'available_translations': ['en', 'de', 'fr', 'ja'],
+                'runtime': 24,
+            },
+            'show': {
+                'title': f'Show #{i % 10}', 'year': 2020,
+                'ids': {'trakt': 150000 + i % 10, 'slug': f'show-{i % 10}', 'tvdb': 360000 + i % 10,
+                        'imdb': f'tt{1100000 + i % 10}', 'tmdb': 90000 + i % 10, 'tvrage': None},
+                'overview': overview, 'first_aired': '2020-01-10T01:00:00.000Z',
+                'airs': {'day': 'Friday', 'time': '01:00', 'timezone': 'Asia/Tokyo'},
+                'runtime': 24, 'certification': 'TV-14', 'network': 'Tokyo MX', 'country': 'jp',
+                'trailer': None, 'homepage': None, 'status': 'returning series', 'rating': 8.1,
+                'votes': 1234, 'comment_count': 3, 'updated_at': '2020-03-01T10:11:12.000Z',
+                'language': 'ja', 'available_translations': ['en', 'de', 'fr', 'ja'],
+                'genres': ['anime', 'action', 'comedy'], 'aired_episodes': 10,
+            },
+        }
+        for i in range(size)
+    ]
+
+
+def bench(codec, value, number):
+    data = codec.encode(value)
+    encode = Timer(lambda: codec.encode(value)).timeit(number) / number
+    decode = Timer(lambda: codec.decode(data)).timeit(number) / number
+    return len(data), encode, decode
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('payloads', nargs='*')
+    parser.add_argument('--number', '-n', type=int, default=200)
+    args = parser.parse_args()
+
+    if args.payloads:
+        payloads = {}
+        for path in args.payloads:
+            with open(path) as f:
+                payloads[path] = json.load(f)
+    else:
+        payloads = {'calendar[10]': make_calendar_payload(10), 'calendar[100]': make_calendar_payload(100)}
+
+    codecs = {
+        'json': JsonCodec(compress_threshold=None),
+        'json+zlib': JsonCodec(compress_threshold=0),
+    }
+    if msgpack:
+        codecs['msgpack'] = MsgpackCodec(compress_threshold=None)
+        codecs['msgpack+zlib'] = MsgpackCodec(compress_threshold=0)
+
+    for name, value in payloads.items():
+        legacy = json.dumps(value)
+        legacy_size = len(legacy.encode())
+        legacy_decode = Timer(lambda: json.loads(legacy)).timeit(args.number) / args.number
+        print(f"{name}: legacy json.dumps {legacy_size} bytes, decode {legacy_decode * 1e6:.0f}us")
+        for codec_name, codec in codecs.items():
+            size, encode, decode = bench(codec, value, args.number)
+            saved = 100 * (1 - size / legacy_size)
+            print(f"  {codec_name:<14} {size:>8} bytes ({saved:5.1f}% saved)"
+                  f"  encode {encode * 1e6:7.0f}us  decode {decode * 1e6:7.0f}us")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+Compare scrapers html parsing against full-tree parsing on saved pages.
+Memory is reported as number of elements built by libxml2 because its allocations
+are not visible to python memory tracing.
+
+Usage::
+
+    python -m benchmarks.parsing [-n NUMBER]
+"""
+from argparse import ArgumentParser
+from pathlib import Path
+from timeit import Timer
+
+from lxml import html
+
+from traktogram.services import parsing
+from traktogram.services.anime import MALService, NineAnimeService, white_space_re
+from traktogram.services.torrent import PirateBayService
+
+
+FIXTURES = Path(__file__).parent.parent / 'tests' / 'fixtures'
+
+
+def full_parse_mal_title(text: bytes):
+    root = html.fromstring(text)
+    row = root.xpath("//div[@id='content']/descendant::table[last()]/descendant::tr[2]")[0]
+    info = row.xpath("td[2]")[0]
+    link = info.xpath(".//a[starts-with(@href, 'https://myanimelist.net/anime/')]")[0]
+    return white_space_re.sub(' ', link.text_content().strip())
+
+
+def full_parse_9anime_url(html_data: bytes, episode: int = None):
+    root = html.fromstring(html_data)
+    items = root.xpath("(//div[@class='film-list']/div[@class='item'])")
+    for item in items:
+        el = item.xpath(".//div[@class='status']//div[@class='dub' or @class='special' or @class='movie']")
+        if not el:
+            break
+    else:
+        return
+    return item.xpath('.//a')[0].get("href")
+
+
+def full_parse_magnet_link(data: bytes):
+    root = html.fromstring(data)
+    el = root.xpath("/descendant::a[starts-with(@href, 'magnet:')][1]")
+    if el:
+        return el[0].get('href')
+
+
+CASES = [
+    ('mal_search.html', full_parse_mal_title, MALService.extract_title, 'tr', MALService.match_title),
+    ('9anime_filter.html', full_parse_9anime_url, NineAnimeService.extract_episode_url, 'div',
+     NineAnimeService.match_item),
+    ('piratebay_search.html', full_parse_magnet_link, PirateBayService.extract_magnet_link, 'a',
+     PirateBayService.match_magnet_link),
+]
+
+
+def full_parse_size(data: bytes):
+    return sum(1 for _ in html.fromstring(data).iter())
+
+
+def early_exit_size(data: bytes, tag, match):
+    last = None
+
+    def track(el):
+        nonlocal last
+        last = el
+        return match(el)
+
+    parsing.parse_first(data, tag, track)
+    return sum(1 for _ in last.getroottree().iter())
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--number', '-n', type=int, default=100)
+    args = parser.parse_args()
+
+    for fixture, before, after, tag, match in CASES:
+        data = (FIXTURES / fixture).read_bytes()
+        assert before(data) == after(data), fixture
+        print(f"{fixture} ({len(data)} bytes)")
+        sizes = (full_parse_size(data), early_exit_size(data, tag, match))
+        for name, func, size in zip(('full parse', 'early exit'), (before, after), sizes):
+            duration = Timer(lambda: func(data)).timeit(args.number) / args.number
+            print(f"  {name:<12} {duration * 1e3:7.3f}ms  {size:6d} elements")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Measure end-to-end resolution time and parse cost of scraped providers offline.
+Providers are served by local stand-in (see `benchmarks.standin`) with saved pages.
+
+Usage::
+
+    python -m benchmarks.providers [-n NUMBER] [--latency SECONDS] [--executor thread|process|inline]
+"""
+import asyncio
+from argparse import ArgumentParser
+from collections import OrderedDict
+from statistics import mean, median
+from time import perf_counter
+from timeit import Timer
+
+from benchmarks.standin import FIXTURES, StandIn
+from traktogram.services import parsing
+from traktogram.services.anime import AnimeDaoService, AnimepaheService, MALService, NineAnimeService
+from traktogram.services.parsing import ParsingExecutor
+from traktogram.services.torrent import PirateBayService
+
+
+async def mal_title(session):
+    return await MALService(session).get_title('my hero academia')
+
+
+async def nineanime_url(session):
+    return await NineAnimeService(session).get_9anime_url('one punch man', episode=3, season=2)
+
+
+async def pahe_url(session):
+    return await AnimepaheService(session).season_url('one punch man', 2)
+
+
+async def magnet_link(session):
+    return await PirateBayService(session).magnet_link('one punch man S02E03')
+
+
+async def animedao_url(session):
+    AnimeDaoService.season_titles_memo = OrderedDict()
+    return await AnimeDaoService(session).episode_url('my hero academia', 2, 5, episode_abs=18)
+
+
+PROVIDERS = [
+    ('mal', mal_title, 'mal_search.html', MALService.extract_title),
+    ('9anime', nineanime_url, '9anime_filter.html', NineAnimeService.extract_episode_url),
+    ('pahe', pahe_url, None, None),
+    ('piratebay', magnet_link, 'piratebay_search.html', PirateBayService.extract_magnet_link),
+    ('animedao', animedao_url, None, None),
+]
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+async def run(number: int, latency: float):
+    async with StandIn(latency=latency) as standin:
+        session = standin.client_session()
+        try:
+            for name, resolve, fixture, extract in PROVIDERS:
+                await resolve(session)  # warm up connection
+                durations = []
+                for _ in range(number):
+                    start = perf_counter()
+                    await resolve(session)
+                    durations.append(perf_counter() - start)
+                line = (f"{name:<10} mean {mean(durations) * 1e3:7.2f}ms  p50 {median(durations) * 1e3:7.2f}ms"
+                        f"  p95 {percentile(durations, 0.95) * 1e3:7.2f}ms")
+                if extract:
+                    data = (FIXTURES / fixture).read_bytes()
+                    parse = Timer(lambda: extract(data)).timeit(number) / number
+                    line += f"  parse {parse * 1e3:6.3f}ms"
+                print(line)
+        finally:
+            await session.close()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--number', '-n', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0., help="simulated latency of every response")
+    parser.add_argument('--executor', choices=('thread', 'process', 'inline'), default=parsing.executor.kind)
+    args = parser.parse_args()
+
+    parsing.executor = ParsingExecutor(args.executor, parsing.executor.max_workers)
+    try:
+        asyncio.get_event_loop().run_until_complete(run(args.number, args.latency))
+    finally:
+        parsing.executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
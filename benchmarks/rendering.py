@@ -0,0 +1,79 @@
+"""
+Measure rendering time of notification templates against the previous implementation,
+which looked template up on every call and cleaned white space in four passes.
+
+Usage::
+
+    python -m benchmarks.rendering [-n NUMBER]
+"""
+import re
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from timeit import Timer
+
+from jinja2 import Environment, FileSystemLoader, Template
+
+from traktogram import rendering
+from traktogram.models import CalendarEpisode
+
+
+legacy_env = Environment(loader=FileSystemLoader(str(rendering.TEMPLATES_DIR)))
+white_spaces = re.compile(r' +')
+leading_space = re.compile(r'(^ +| +$)', re.MULTILINE)
+
+
+def legacy_render(template: Template, **kwargs):
+    text = template.render(**kwargs)
+    text = text.replace('\n', ' ').replace(r'<br/>', '\n')
+    text = white_spaces.sub(' ', text)
+    text = leading_space.sub('', text)
+    text = text.strip(' \n')
+    return text
+
+
+def legacy_render_html(template_name: str, **kwargs):
+    return legacy_render(legacy_env.get_template(f'{template_name}.html'), **kwargs)
+
+
+def make_episodes(num: int):
+    start = datetime(2020, 1, 1, 12)
+    return [
+        CalendarEpisode(**{
+            'show': {'ids': {'trakt': i % 3, 'slug': f'show-{i % 3}'}, 'title': f'show {i % 3}', 'year': 2020},
+            'episode': {'ids': {'trakt': i}, 'title': f'episode {i}', 'season': 1, 'number': i + 1},
+            'first_aired': start + timedelta(hours=i),
+        })
+        for i in range(num)
+    ]
+
+
+def cases():
+    episodes = make_episodes(15)
+    return [
+        ('calendar_notification', dict(show_episode=episodes[0])),
+        ('calendar_multi_notification', dict(show=episodes[0].show, episodes=episodes[:8])),
+        ('shows_list', dict(episodes=episodes)),
+    ]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--number', '-n', type=int, default=2000)
+    args = parser.parse_args()
+
+    for name, kwargs in cases():
+        assert rendering.render_html(name, **kwargs) == legacy_render_html(name, **kwargs)
+        legacy = Timer(lambda: legacy_render_html(name, **kwargs)).timeit(args.number) / args.number
+        current = Timer(lambda: rendering.render_html(name, **kwargs)).timeit(args.number) / args.number
+        print(f"{name:<28} legacy {legacy * 1e6:8.2f}us  current {current * 1e6:8.2f}us  "
+              f"x{legacy / current:.2f}")
+
+    template = "{% for i in range(5) %} {{ i }} <br/> {% endfor %}"
+    legacy = Timer(lambda: legacy_render(Template(template))).timeit(args.number) / args.number
+    current = Timer(lambda: rendering.render_string(template)).timeit(args.number) / args.number
+    print(f"{'render_string':<28} legacy {legacy * 1e6:8.2f}us  current {current * 1e6:8.2f}us  "
+          f"x{legacy / current:.2f}")
+
+
+if __name__ == '__main__':
+    main()
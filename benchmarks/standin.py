@@ -0,0 +1,86 @@
+"""
+Local stand-in for scraped sites which serves saved pages from ``tests/fixtures``.
+
+Scrapers are pointed to it with `StandInClientSession`, which rewrites
+``https://{host}/{path}`` into ``http://127.0.0.1:{port}/{host}/{path}``::
+
+    async with StandIn(latency=0.05) as standin:
+        async with MALService(standin.client_session()) as mal:
+            await mal.get_title('my hero academia')
+"""
+import asyncio
+from pathlib import Path
+from typing import Dict, Tuple, Union
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+from yarl import URL
+
+
+FIXTURES = Path(__file__).parent.parent / 'tests' / 'fixtures'
+
+# (host, path prefix) -> fixture
+ROUTES: Dict[Tuple[str, str], str] = {
+    ('myanimelist.net', '/anime.php'): 'mal_search.html',
+    ('9anime.to', '/filter'): '9anime_filter.html',
+    ('animepahe.com', '/api'): 'animepahe_search.json',
+    ('thepiratebay.org', '/search/'): 'piratebay_search.html',
+}
+
+
+class StandIn:
+    def __init__(self, fixtures: Path = FIXTURES, latency: Union[float, Dict[str, float]] = 0.):
+        """
+        :param latency: delay of every response in seconds, can be specified per host
+        """
+        self.fixtures = fixtures
+        self.latency = latency
+        self.requests = []
+        app = web.Application()
+        app.router.add_get('/{host}/{path:.*}', self.handle)
+        self.server = TestServer(app)
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.server.close()
+
+    def host_latency(self, host):
+        if isinstance(self.latency, dict):
+            return self.latency.get(host, 0.)
+        return self.latency
+
+    async def handle(self, request: web.Request):
+        host = request.match_info['host']
+        path = '/' + request.match_info['path']
+        self.requests.append((host, path, dict(request.query)))
+        await asyncio.sleep(self.host_latency(host))
+        for (route_host, prefix), fixture in ROUTES.items():
+            if host == route_host and path.startswith(prefix):
+                data = (self.fixtures / fixture).read_bytes()
+                content_type = 'application/json' if fixture.endswith('.json') else 'text/html'
+                return web.Response(body=data, content_type=content_type)
+        raise web.HTTPNotFound()
+
+    def make_url(self, url) -> URL:
+        url = URL(url)
+        return self.server.make_url(f'/{url.host}{url.path}').with_query(url.query)
+
+    def client_session(self) -> 'StandInClientSession':
+        return StandInClientSession(self)
+
+
+class StandInClientSession:
+    """Minimal `aiohttp.ClientSession` replacement which sends all requests to stand-in."""
+
+    def __init__(self, standin: StandIn):
+        self.standin = standin
+        self.session = ClientSession()
+
+    def get(self, url, **kwargs):
+        return self.session.get(self.standin.make_url(url), **kwargs)
+
+    def close(self):
+        return self.session.close()
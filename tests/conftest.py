@@ -36,6 +36,19 @@ async def store():
         await store.wait_closed()
 
 
+@pytest.fixture
+async def sharded_store():
+    shards = [f'{REDIS_URL.rsplit("/", 1)[0]}/{db}' for db in (2, 3)]
+    store = Storage(uri=REDIS_URL, db=1, shards=shards)
+    try:
+        yield store
+    finally:
+        for conn in [await store.redis(), *await store.all_shards()]:
+            await conn.flushdb()
+        await store.close()
+        await store.wait_closed()
+
+
 @pytest.fixture('class')
 def make_calendar_episode(request):
     def make(first_aired, show_id, episode_number=1):
@@ -0,0 +1,83 @@
+from time import time
+from types import SimpleNamespace
+
+import pytest
+from aiogram.utils.exceptions import BotBlocked, NetworkError, RetryAfter
+
+from traktogram.services import delivery
+from traktogram.services.delivery import PreparedMessage
+
+
+class FlakyBot:
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.messages = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.messages.append((chat_id, text))
+        return SimpleNamespace(message_id=len(self.messages))
+
+
+def test_backoff(monkeypatch):
+    monkeypatch.setattr(delivery, 'DELIVERY_BACKOFF', 5)
+    monkeypatch.setattr(delivery, 'DELIVERY_MAX_BACKOFF', 60)
+    assert [delivery.backoff(i) for i in range(1, 6)] == [5, 10, 20, 40, 60]
+
+
+@pytest.mark.asyncio
+async def test_retry_after_keeps_order(store):
+    bot = FlakyBot([RetryAfter(3)])
+    await PreparedMessage(text='a', state={'x': 1}).deliver(bot, store, 1)
+    await PreparedMessage(text='b').deliver(bot, store, 1)
+    await PreparedMessage().deliver(bot, store, 1)
+    assert bot.messages == []
+    assert await store.delivery_delay(1) > time() + 2
+    assert await delivery.retry_due(bot, store) == 0
+
+    await store.delay_delivery(1, 0)
+    assert await delivery.retry_due(bot, store) == 2
+    assert bot.messages == [('1', 'a'), ('1', 'b')]
+    assert await store.get_message_state(1, 1) == {'x': 1}
+    assert await store.delivery_delay(1) is None
+
+
+@pytest.mark.asyncio
+async def test_dead_letters(store, monkeypatch):
+    monkeypatch.setattr(delivery, 'DELIVERY_ATTEMPTS', 2)
+    bot = FlakyBot([NetworkError('timeout'), NetworkError('timeout'), BotBlocked('bot was blocked')])
+    await PreparedMessage(text='a').deliver(bot, store, 1)
+    item = await store.peek_delivery(1)
+    assert item['attempts'] == 1
+    await store.delay_delivery(1, 0)
+    assert await delivery.retry_due(bot, store) == 0
+    await PreparedMessage(text='b').deliver(bot, store, 1)
+    await PreparedMessage(text='c').deliver(bot, store, 1)
+    assert bot.messages == [(1, 'c')]
+    dead = await store.get_dead_letters()
+    assert [d['data']['message']['text'] for d in dead] == ['b', 'a']
+
+
+@pytest.mark.asyncio
+async def test_chat_lock(store):
+    bot = FlakyBot()
+    token = await store.lock_delivery(1)
+    await PreparedMessage(text='a').deliver(bot, store, 1)
+    assert bot.messages == []
+    await store.unlock_delivery(1, token)
+    assert await delivery.retry_due(bot, store) == 1
+
+
+@pytest.mark.asyncio
+async def test_drain_batch(store, monkeypatch):
+    monkeypatch.setattr(delivery, 'DELIVERY_BATCH', 2)
+    bot = FlakyBot()
+    token = await store.lock_delivery(1)
+    for text in 'abc':
+        await PreparedMessage(text=text).deliver(bot, store, 1)
+    await store.unlock_delivery(1, token)
+    assert await delivery.retry_due(bot, store) == 2
+    assert await delivery.retry_due(bot, store) == 1
+    assert [text for _, text in bot.messages] == ['a', 'b', 'c']
+    assert await store.delivery_delay(1) is None
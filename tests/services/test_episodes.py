@@ -0,0 +1,63 @@
+from collections import OrderedDict
+
+import pytest
+
+from traktogram.services import episodes
+from .test_notifications import make_ce
+
+
+class FakeTrakt:
+    def __init__(self):
+        self.calls = []
+
+    async def search_by_episode_id(self, episode_id, extended=True):
+        self.calls.append(episode_id)
+        return make_ce(1, episode_id)
+
+
+@pytest.fixture
+def lru(monkeypatch):
+    lru = OrderedDict()
+    monkeypatch.setattr(episodes, '_lru', lru)
+    return lru
+
+
+@pytest.mark.asyncio
+async def test_get_saved_episode(store, lru):
+    sess = FakeTrakt()
+    await episodes.save_episodes(store, [make_ce(1, 10), make_ce(1, 20)])
+    assert list(lru) == [10, 20]
+
+    lru.clear()
+    se = await episodes.get_show_episode('10', sess, store)
+    assert se.episode.id == 10 and se.show.id == 1
+    assert list(lru) == [10]
+    assert sess.calls == []
+
+
+@pytest.mark.asyncio
+async def test_get_episode_from_memory(store, lru):
+    await episodes.save_episodes(store, [make_ce(1, 10)])
+    conn = await store.redis()
+    await conn.flushdb()
+    se = await episodes.get_show_episode(10, FakeTrakt(), store)
+    assert se.episode.id == 10
+
+
+@pytest.mark.asyncio
+async def test_get_unknown_episode(store, lru):
+    sess = FakeTrakt()
+    for _ in range(2):
+        se = await episodes.get_show_episode(30, sess, store)
+        assert se.episode.id == 30
+    assert sess.calls == [30]
+    assert await store.get_episode(30) is not None
+    conn = await store.redis()
+    assert 0 < await conn.ttl(store.generate_key('episode', 30)) <= store.EPISODE_EXPIRY
+
+
+@pytest.mark.asyncio
+async def test_lru_size(store, lru, monkeypatch):
+    monkeypatch.setattr(episodes, 'LRU_SIZE', 2)
+    await episodes.save_episodes(store, [make_ce(1, id) for id in (1, 2, 3)])
+    assert list(lru) == [2, 3]
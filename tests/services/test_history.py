@@ -0,0 +1,129 @@
+import asyncio
+from time import time
+
+import pytest
+
+from traktogram.services import TraktException, history
+from .test_notifications import make_ce
+
+
+class FakeTrakt:
+    def __init__(self, watched=(), fail=None):
+        self.history = set(watched)
+        self.requests = []
+        # exception raised by writes
+        self.fail = fail
+
+    async def watched(self, episode_id):
+        return int(episode_id) in self.history
+
+    async def watched_progress(self, show_id):
+        self.requests.append(('progress', show_id))
+        return {(1, id) for id in self.history}
+
+    async def add_to_history(self, *episodes_ids):
+        self.requests.append(('add', sorted(episodes_ids)))
+        if self.fail:
+            raise self.fail
+        self.history.update(episodes_ids)
+
+    async def remove_from_history(self, *episodes_ids):
+        self.requests.append(('remove', sorted(episodes_ids)))
+        if self.fail:
+            raise self.fail
+        self.history.difference_update(episodes_ids)
+
+
+@pytest.fixture
+def flush_delay(monkeypatch):
+    monkeypatch.setattr(history, 'HISTORY_FLUSH_DELAY', 0.05)
+
+
+@pytest.mark.asyncio
+async def test_coalesced_writes(store, flush_delay):
+    sess = FakeTrakt(watched=[4])
+    flushes = set()
+    for episode_id, watched in ((1, True), (2, True), (3, True), (2, False), (4, False)):
+        flushes.add(await history.set_watched(sess, 1, episode_id, watched, store))
+    assert len(flushes) == 1
+    assert await history.watched(sess, 1, 1, store) is True
+    assert await history.watched(sess, 1, 2, store) is False
+    assert await history.watched(sess, 1, 4, store) is False
+    assert sess.requests == []
+
+    assert await flushes.pop() == {}
+    assert sorted(sess.requests) == [('add', [1, 3]), ('remove', [4])]
+    assert sess.history == {1, 3}
+    assert await store.history_pending_users() == []
+
+
+@pytest.mark.asyncio
+async def test_failed_flush(store):
+    sess = FakeTrakt(fail=ValueError())
+    await store.queue_history(1, 10, True)
+    assert await history.flush_history(sess, 1, store) == {}
+    assert await store.get_pending_history(1, 10) is True
+    # newer change takes precedence over restored one
+    await store.queue_history(1, 10, False)
+    await store.queue_history(1, 10, False)
+    await history.flush_history(sess, 1, store)
+    assert await store.history_pending_users() == [1]
+
+    sess.fail = None
+    assert await history.flush_history(sess, 1, store) == {}
+    assert sess.requests[-1] == ('remove', [10])
+    assert await store.pop_history(1) == {}
+    assert await store.history_pending_users() == []
+
+
+@pytest.mark.asyncio
+async def test_rejected_flush(store):
+    sess = FakeTrakt(fail=TraktException({}, 404))
+    await store.queue_history(1, 10, True)
+    assert await history.flush_history(sess, 1, store) == {10: True}
+    assert await store.history_pending_users() == []
+    assert await history.watched(sess, 1, 10, store) is False
+
+
+@pytest.mark.asyncio
+async def test_flush_attempts(store, monkeypatch):
+    monkeypatch.setattr(history, 'HISTORY_WRITE_ATTEMPTS', 2)
+    sess = FakeTrakt(fail=TraktException({}, 503))
+    await store.queue_history(1, 10, True)
+    assert await history.flush_history(sess, 1, store) == {}
+    assert await history.flush_history(sess, 1, store) == {10: True}
+    assert await store.history_pending_users() == []
+    # attempts are counted from scratch for new change
+    await store.queue_history(1, 10, True)
+    assert await history.flush_history(sess, 1, store) == {}
+    assert await store.history_pending_users() == [1]
+
+
+@pytest.mark.asyncio
+async def test_direct_writes(store, monkeypatch):
+    monkeypatch.setattr(history, 'HISTORY_FLUSH_DELAY', 0)
+    sess = FakeTrakt()
+    await history.set_watched(sess, 1, 10, True, store)
+    assert sess.requests == [('add', [10])]
+
+
+@pytest.mark.asyncio
+async def test_bulk_writes(store, flush_delay):
+    sess = FakeTrakt(watched=[1])
+    await store.queue_history(1, 2, True)
+    statuses = await history.watched_many(sess, 1, [make_ce(1, id) for id in (1, 2, 3)], store)
+    assert statuses == {1: True, 2: True, 3: False}
+    assert sess.requests == [('progress', 1)]
+
+    await history.set_watched_many(sess, 1, [3, 4], True, store)
+    await asyncio.sleep(0.1)
+    assert sess.requests[1:] == [('add', [2, 3, 4])]
+
+
+@pytest.mark.asyncio
+async def test_pending_users_queued_before(store):
+    await store.queue_history(1, 10, True)
+    assert await store.history_pending_users(queued_before=time() - 60) == []
+    assert await store.history_pending_users(queued_before=time() + 1) == [1]
+    await store.pop_history(1)
+    assert await store.history_pending_users() == []
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from traktogram.services import magnets, providers
+from traktogram.services.notifications import CalendarNotification
+from traktogram.services.torrent import PirateBayService
+from .test_notifications import make_ce
+
+
+@pytest.fixture
+def scrapes(monkeypatch):
+    calls = []
+
+    async def magnet_link(self, query):
+        calls.append(query)
+        await asyncio.sleep(0.01)
+        if 'E02' in query:
+            return None
+        if 'E03' in query:
+            raise ValueError
+        return f'magnet:?q={query}'
+
+    monkeypatch.setattr(PirateBayService, 'magnet_link', magnet_link)
+    monkeypatch.setattr(magnets, 'registry', providers.make_registry())
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_resolve_magnets(store, scrapes):
+    episodes = [make_ce(1, 1), make_ce(1, 2), make_ce(1, 3), make_ce(1, 1)]
+    res = await magnets.resolve_magnets(store, episodes)
+    assert res == {1: 'magnet:?q=show S01E01', 2: None}
+    assert sorted(scrapes) == ['show S01E01', 'show S01E02', 'show S01E03']
+
+    # only failed episode is scraped again
+    res = await magnets.resolve_magnets(store, episodes)
+    assert res == {1: 'magnet:?q=show S01E01', 2: None}
+    assert len(scrapes) == 4 and scrapes[-1] == 'show S01E03'
+
+
+@pytest.mark.asyncio
+async def test_resolve_magnets_concurrent(store, scrapes):
+    await asyncio.gather(
+        magnets.resolve_magnets(store, [make_ce(1, 1), make_ce(1, 4)]),
+        magnets.resolve_magnets(store, [make_ce(1, 4), make_ce(1, 5)]),
+    )
+    assert sorted(scrapes) == ['show S01E01', 'show S01E04', 'show S01E05']
+
+
+@pytest.mark.asyncio
+async def test_resolve_magnets_shared_limit(store, monkeypatch):
+    monkeypatch.setattr(magnets, 'registry', providers.make_registry())
+    monkeypatch.setattr(magnets, 'scrape_limiter', magnets.Limiter(2))
+    active = peak = 0
+
+    async def magnet_link(self, query):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        return None
+
+    monkeypatch.setattr(PirateBayService, 'magnet_link', magnet_link)
+    await asyncio.gather(*(
+        magnets.resolve_magnets(store, [make_ce(1, i), make_ce(1, i + 10)])
+        for i in range(1, 6)
+    ))
+    assert peak == 2
+
+
+@pytest.mark.asyncio
+async def test_resolve_magnets_provider_disabled(store, scrapes):
+    magnets.registry['piratebay'].enabled = False
+    assert await magnets.resolve_magnets(store, [make_ce(1, 1)]) == {}
+    assert scrapes == []
+
+
+@pytest.mark.asyncio
+async def test_magnet_button(store):
+    await store.save_magnets({10: 'magnet:?xt=1', 20: None})
+    for episode_id, has_button in ((10, True), (20, False), (30, False)):
+        kb = await CalendarNotification.markup(make_ce(1, episode_id), watched=False, hide=True, storage=store,
+                                               urls=[])
+        buttons = [btn for row in kb.inline_keyboard for btn in row]
+        assert any(btn.text == 'magnet' for btn in buttons) is has_button
@@ -0,0 +1,324 @@
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from arq import create_pool
+from arq.constants import default_queue_name
+
+from traktogram.models import CalendarEpisode
+from traktogram.services import episodes, notifications
+from traktogram.services.notifications import (
+    CalendarDigest, CalendarDigestFlow, CalendarMultiNotification, CalendarMultiNotificationFlow,
+    CalendarNotification, NotificationScheduler, digest_window,
+)
+from traktogram.storage import Storage
+from traktogram.worker import get_redis_settings
+
+
+class FakeQueue:
+    def __init__(self):
+        self.jobs = []
+
+    async def keys(self, pattern):
+        return []
+
+    async def enqueue_job(self, name, *args, **kwargs):
+        self.jobs.append((name, args, kwargs))
+
+
+def make_ce(show_id, episode_id, genres=('anime',), first_aired=datetime(2020, 1, 1)):
+    return CalendarEpisode(**{
+        'show': {'ids': {'trakt': show_id, 'slug': 'slug'}, 'title': 'show', 'year': 2020, 'genres': list(genres)},
+        'episode': {'ids': {'trakt': episode_id}, 'title': 'episode', 'season': 1, 'number': episode_id},
+        'first_aired': first_aired,
+    })
+
+
+@pytest.fixture
+def fake_watch_urls(monkeypatch):
+    calls = []
+
+    async def watch_urls(show, episode, storage=None):
+        calls.append(episode.id)
+        yield 'source', f'https://example.com/{episode.id}'
+
+    monkeypatch.setattr(notifications, 'watch_urls', watch_urls)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_precompute_urls(fake_watch_urls):
+    queue = FakeQueue()
+    scheduler = NotificationScheduler(queue, warm_up=0)
+    for user_id in (1, 2):
+        await scheduler.schedule(None, user_id, [make_ce(1, 10), make_ce(2, 20)])
+    assert len(queue.jobs) == 4
+    assert sorted(fake_watch_urls) == [10, 20]
+    name, (user_id, ce, urls), _ = queue.jobs[0]
+    assert urls == [('source', f'https://example.com/{ce.episode.id}')]
+
+
+@pytest.mark.asyncio
+async def test_markup_with_urls(fake_watch_urls):
+    ce = make_ce(1, 10)
+    kb = await CalendarNotification.markup(ce, watched=False, hide=True, urls=[('foo', 'https://foo.bar')])
+    assert kb.inline_keyboard[1][0].url == 'https://foo.bar'
+    assert fake_watch_urls == []
+    await CalendarNotification.markup(ce, watched=False, hide=True)
+    assert fake_watch_urls == [10]
+
+
+@pytest.mark.asyncio
+async def test_keyboard_urls(fake_watch_urls):
+    ce = make_ce(1, 10)
+    assert CalendarNotification.keyboard_urls(None) == []
+    kb = await CalendarNotification.markup(ce, watched=False, hide=True, urls=[('foo', 'https://foo.bar')])
+    assert CalendarNotification.keyboard_urls(kb) == [('foo', 'https://foo.bar')]
+    kb = await CalendarNotification.markup(ce, watched=True, hide=True, urls=[('foo', 'https://foo.bar')])
+    assert CalendarNotification.keyboard_urls(kb) == []
+
+
+class FakeTrakt:
+    def __init__(self):
+        self.calls = []
+
+    async def watched(self, episode_id):
+        self.calls.append(episode_id)
+        return episode_id == 30
+
+
+def make_query(markup, edits):
+    async def edit_reply_markup(markup):
+        edits.append(markup)
+
+    async def answer(text=None):
+        pass
+
+    message = SimpleNamespace(reply_markup=markup, chat=SimpleNamespace(id=1), message_id=5,
+                              edit_reply_markup=edit_reply_markup)
+    return SimpleNamespace(message=message, from_user=SimpleNamespace(id=1), answer=answer)
+
+
+@pytest.mark.asyncio
+async def test_multi_flow_state(store, fake_watch_urls, monkeypatch):
+    sess = FakeTrakt()
+
+    async def trakt_session(user_id):
+        return sess
+
+    monkeypatch.setattr(notifications, 'trakt_session', trakt_session)
+    monkeypatch.setattr(episodes, '_lru', OrderedDict())
+    Storage.set_current(store)
+    group = [make_ce(1, 10), make_ce(1, 20), make_ce(1, 30)]
+    await episodes.save_episodes(store, group)
+    await store.update_message_state(1, 5, {'episodes': [10, 20, 30], 'watched:10': False, 'urls:10': []})
+    edits = []
+    markup = await CalendarMultiNotification.markup(group[0], [10, 20, 30], watched=False, urls=[])
+
+    f = CalendarMultiNotificationFlow(make_query(markup, edits))
+    f.move_index(1)
+    await f.fetch_episode_data()
+    await f.update_message()
+    assert f.se.episode.id == 20
+    await asyncio.sleep(0.01)  # prefetch
+    assert sorted(sess.calls) == [20, 30]
+    assert sorted(fake_watch_urls) == [20]
+    state = await store.get_message_state(1, 5)
+    assert state['watched:30'] is True
+    assert state['urls:20'] == [['source', 'https://example.com/20']]
+
+    # next tap is served from message state
+    f = CalendarMultiNotificationFlow(make_query(edits[-1], edits))
+    f.move_index(1)
+    await f.fetch_episode_data()
+    await f.update_message()
+    assert f.watched is True
+    assert sorted(sess.calls) == [20, 30]
+
+
+@pytest.mark.asyncio
+async def test_multi_markup_bulk_buttons(fake_watch_urls):
+    group = [make_ce(1, 10), make_ce(1, 20), make_ce(1, 30)]
+
+    def bulk_actions(kb):
+        return [CalendarMultiNotification.cd.parse(btn.callback_data)['action'] for btn in kb.inline_keyboard[1]]
+
+    kb = await CalendarMultiNotification.markup(group[0], [10, 20, 30], watched=False, urls=[])
+    assert bulk_actions(kb) == ['all']
+    kb = await CalendarMultiNotification.markup(group[1], [10, 20, 30], watched=False, index=1, urls=[])
+    assert bulk_actions(kb) == ['upto', 'all']
+
+
+class FakeBot:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        self.messages.append((chat_id, text, reply_markup))
+        return SimpleNamespace(message_id=len(self.messages))
+
+
+@pytest.mark.asyncio
+async def test_multi_send_batched_watched(store, fake_watch_urls, monkeypatch):
+    class FakeProgressTrakt:
+        requests = []
+
+        def auth(self, access_token):
+            return self
+
+        async def watched_progress(self, show_id):
+            self.requests.append(show_id)
+            return {(1, 10), (1, 20)}
+
+    monkeypatch.setattr(episodes, '_lru', OrderedDict())
+    await store.save_creds(1, {'access_token': 'a', 'refresh_token': 'r'})
+    trakt, bot = FakeProgressTrakt(), FakeBot()
+    group = [make_ce(1, 10), make_ce(1, 20), make_ce(1, 30), make_ce(1, 40)]
+    await CalendarMultiNotification.send(bot, trakt, store, 1, group, urls=[('first', 'https://example.com')])
+    assert trakt.requests == [1]
+    _, _, kb = bot.messages[0]
+    watch_btn = kb.inline_keyboard[0][1]
+    assert watch_btn.text == '❌ 1x30'
+    assert fake_watch_urls == [30]
+    state = await store.get_message_state(1, 1)
+    assert [state[f'watched:{id}'] for id in (10, 20, 30, 40)] == [True, True, False, False]
+
+
+def test_digest_window():
+    assert digest_window(datetime(2020, 1, 1, 17, 30), hours=24) == datetime(2020, 1, 1)
+    assert digest_window(datetime(2020, 1, 1, 17, 30), hours=6) == datetime(2020, 1, 1, 12)
+
+
+@pytest.mark.asyncio
+async def test_schedule_digests(store, monkeypatch):
+    monkeypatch.setattr(episodes, '_lru', OrderedDict())
+    queue = FakeQueue()
+    scheduler = NotificationScheduler(queue, store, precompute_urls=False, magnets=False, warm_up=0)
+    day = datetime(2020, 1, 1)
+    eps = [make_ce(show_id, show_id * 10 + i, first_aired=day + timedelta(hours=show_id))
+           for show_id in range(1, 6) for i in range(2)]
+    eps.append(make_ce(1, 100, first_aired=day + timedelta(days=1, hours=3)))
+
+    await store.update_pref(user=1, delivery='digest')
+    await scheduler.schedule(None, 1, eps)
+    assert [name for name, _, _ in queue.jobs] == ['send_calendar_digest'] * 2
+    (_, (_, first, _), first_kw), (_, (_, second, _), second_kw) = queue.jobs
+    assert len(first) == 10
+    assert first_kw['_defer_until'] == day + timedelta(hours=5)
+    assert [ce.episode.id for ce in second] == [100]
+
+    queue.jobs.clear()
+    await scheduler.schedule(None, 2, eps)
+    assert len(queue.jobs) == 11
+
+
+@pytest.mark.asyncio
+async def test_digest_send_and_watch(store, fake_watch_urls, monkeypatch):
+    class FakeProgressTrakt:
+        added = []
+
+        def auth(self, access_token):
+            return self
+
+        async def watched_progress(self, show_id):
+            return {(1, 10)}
+
+        async def add_to_history(self, *ids):
+            self.added.extend(ids)
+
+    trakt, bot = FakeProgressTrakt(), FakeBot()
+
+    async def trakt_session(user_id):
+        return trakt
+
+    monkeypatch.setattr(notifications, 'trakt_session', trakt_session)
+    monkeypatch.setattr(notifications.history, 'HISTORY_FLUSH_DELAY', 0)
+    monkeypatch.setattr(episodes, '_lru', OrderedDict())
+    Storage.set_current(store)
+    await store.save_creds(1, {'access_token': 'a', 'refresh_token': 'r'})
+    eps = [make_ce(1, 10), make_ce(2, 20), make_ce(2, 21), make_ce(3, 30)]
+    await CalendarDigest.send(bot, trakt, store, 1, eps)
+    assert len(bot.messages) == 1
+    _, text, kb = bot.messages[0]
+    assert text.count('✅') == 1 and text.count('❌') == 3
+    # show with watched episodes is skipped
+    assert CalendarDigest.cd.parse(kb.inline_keyboard[0][1].callback_data)['index'] == '1'
+    assert fake_watch_urls == [20]
+
+    edits = []
+
+    async def edit_text(text, reply_markup=None, **kwargs):
+        edits.append((text, reply_markup))
+
+    query = make_query(kb, edits)
+    query.message.edit_text = edit_text
+    query.message.message_id = 1
+    f = CalendarDigestFlow(query, 1)
+    await f.fetch_data()
+    assert await f.mark_show_watched() == 2
+    f.move_to_unwatched()
+    await f.update_message(edit_text=True)
+    assert sorted(trakt.added) == [20, 21]
+    text, markup = edits[-1]
+    assert text.count('✅') == 3
+    assert markup.inline_keyboard[0][1].text.startswith('❌ show (3/3)')
+
+
+@pytest.mark.asyncio
+async def test_schedule_warm_up():
+    queue = FakeQueue()
+    scheduler = NotificationScheduler(queue, precompute_urls=False, warm_up=10)
+    air = datetime(2020, 1, 1, 12)
+    for user_id in (1, 2):
+        await scheduler.schedule(None, user_id, [make_ce(1, 10, first_aired=air), make_ce(2, 20, first_aired=air),
+                                                 make_ce(3, 30, first_aired=air + timedelta(hours=1))])
+    warm_ups = [(args, kwargs) for name, args, kwargs in queue.jobs if name == 'warm_up_notifications']
+    assert [args for args, _ in warm_ups] == [(air,), (air + timedelta(hours=1),)]
+    assert warm_ups[0][1]['_defer_until'] == air - timedelta(minutes=10)
+
+
+@pytest.mark.asyncio
+async def test_warm_up_notifications(store, fake_watch_urls, monkeypatch):
+    class FakeProgressTrakt:
+        requests = []
+
+        def auth(self, access_token):
+            return self
+
+        async def watched_progress(self, show_id):
+            self.requests.append(show_id)
+            return {(1, 10)}
+
+    monkeypatch.setattr(episodes, '_lru', OrderedDict())
+    trakt, bot = FakeProgressTrakt(), FakeBot()
+    queue = await create_pool(get_redis_settings(database=1))
+    try:
+        await store.save_creds(1, {'access_token': 'a', 'refresh_token': 'r'})
+        await store.save_creds(2, {'access_token': 'a', 'refresh_token': 'r'})
+        await store.update_pref(user=2, on_watch='delete')
+        scheduler = NotificationScheduler(queue, store, precompute_urls=False, magnets=False)
+        air = datetime(2030, 1, 1, 12)
+        await scheduler.schedule(None, 1, [make_ce(1, 10, first_aired=air), make_ce(2, 20, first_aired=air)])
+        await scheduler.schedule(None, 2, [make_ce(1, 10, first_aired=air)])
+        ctx = {'redis': queue, 'trakt': trakt, 'storage': store, 'bot': bot}
+        assert await NotificationScheduler.warm_up_notifications(ctx, air) == 3
+        assert sorted(trakt.requests) == [1, 1, 2]
+
+        jobs_ids = await queue.zrangebyscore(default_queue_name)
+        for job_id in jobs_ids:
+            if job_id.startswith('warm_up'):
+                continue
+            user_id = int(job_id.split('-')[1])
+            conn, key = await store.prerender_conn_key(user_id, job_id)
+            assert await conn.ttl(key) > store.PRERENDER_EXPIRY
+            assert await NotificationScheduler.send_prepared({**ctx, 'job_id': job_id}, user_id)
+            assert not await NotificationScheduler.send_prepared({**ctx, 'job_id': job_id}, user_id)
+        # watched episode is not sent to user with on_watch=delete
+        assert sorted(chat_id for chat_id, _, _ in bot.messages) == [1, 1]
+        assert len(trakt.requests) == 3
+    finally:
+        await queue.flushdb()
+        queue.close()
+        await queue.wait_closed()
@@ -0,0 +1,186 @@
+import asyncio
+import time
+
+import pytest
+
+from traktogram.models import Episode, Show
+from traktogram.services import ops, providers
+from traktogram.services.anime import AnimepaheService, MALService, TitleNotFound
+
+
+@pytest.fixture
+def show_episode():
+    show = Show(ids={'trakt': 1, 'slug': 'slug'}, title='show', year=2020, genres=['anime'])
+    episode = Episode(ids={'trakt': 1}, title='episode', season=2, number=3)
+    return show, episode
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    registry = providers.make_registry(min_calls=2)
+    monkeypatch.setattr(ops, 'registry', registry)
+    return registry
+
+
+@pytest.fixture
+def deadlines(monkeypatch):
+    monkeypatch.setattr(ops, 'MAL_DEADLINE', 0.1)
+    monkeypatch.setattr(ops, 'PAHE_DEADLINE', 0.2)
+
+
+@pytest.mark.asyncio
+async def test_watch_urls(show_episode, deadlines, monkeypatch):
+    async def get_title(self, query):
+        return 'mal title'
+
+    async def season_url(self, title, season):
+        return AnimepaheService.base / 'anime' / f'{title}-{season}'
+
+    monkeypatch.setattr(MALService, 'get_title', get_title)
+    monkeypatch.setattr(AnimepaheService, 'season_url', season_url)
+    urls = dict([e async for e in ops.watch_urls(*show_episode)])
+    assert str(urls['pahe[s]']) == 'https://animepahe.com/anime/mal%20title-2'
+    assert 'mal+title' in str(urls['dao[q]'])
+
+
+@pytest.mark.asyncio
+async def test_watch_urls_deadline(show_episode, deadlines, monkeypatch):
+    async def get_title(self, query):
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(MALService, 'get_title', get_title)
+    start = time.monotonic()
+    urls = dict([e async for e in ops.watch_urls(*show_episode)])
+    assert time.monotonic() - start < 1
+    # fall back to trakt title and guessed urls
+    assert str(urls['pahe[s]']) == 'https://animepahe.com/anime/show-2'
+    assert 'show' in str(urls['dao[q]'])
+
+
+@pytest.mark.asyncio
+async def test_watch_urls_provider_error(show_episode, deadlines, monkeypatch):
+    async def get_title(self, query):
+        return 'mal title'
+
+    async def season_url(self, title, season):
+        raise ValueError
+
+    monkeypatch.setattr(MALService, 'get_title', get_title)
+    monkeypatch.setattr(AnimepaheService, 'season_url', season_url)
+    urls = dict([e async for e in ops.watch_urls(*show_episode)])
+    assert str(urls['pahe[s]']) == 'https://animepahe.com/anime/mal-title-2'
+
+
+@pytest.mark.asyncio
+async def test_watch_urls_circuit_breaker(show_episode, deadlines, registry, monkeypatch):
+    calls = []
+
+    async def get_title(self, query):
+        calls.append(query)
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(MALService, 'get_title', get_title)
+    for _ in range(2):
+        [e async for e in ops.watch_urls(*show_episode)]
+    await asyncio.sleep(0)  # let cancelled scraping finish
+    assert registry['mal'].state == providers.Provider.OPEN
+
+    # dead provider is skipped without waiting for deadline
+    start = time.monotonic()
+    urls = dict([e async for e in ops.watch_urls(*show_episode)])
+    assert time.monotonic() - start < 0.1
+    assert len(calls) == 2
+    assert 'show' in str(urls['dao[q]'])
+
+
+@pytest.mark.asyncio
+async def test_watch_urls_priority(show_episode, registry, monkeypatch):
+    async def get_title(self, query):
+        return 'mal title'
+
+    async def season_url(self, title, season):
+        return AnimepaheService.base / 'anime' / title
+
+    monkeypatch.setattr(MALService, 'get_title', get_title)
+    monkeypatch.setattr(AnimepaheService, 'season_url', season_url)
+    registry['kisa'].priority = -1
+    registry['nyaasi'].enabled = False
+    names = [name async for name, _ in ops.watch_urls(*show_episode)]
+    assert names == ['kisa[e]', 'dao[q]', '9anime[q]', 'pahe[s]']
+
+
+@pytest.mark.asyncio
+async def test_resolve_mal_title(store, show_episode, monkeypatch):
+    show, _ = show_episode
+    calls = []
+
+    async def get_title(self, query):
+        calls.append(query)
+        return f'mal {len(calls)}'
+
+    monkeypatch.setattr(MALService, 'get_title', get_title)
+    async with MALService() as mal:
+        assert await ops.resolve_mal_title(mal, show, store) == 'mal 1'
+        assert await ops.resolve_mal_title(mal, show, store) == 'mal 1'
+        assert calls == ['show']
+        # stale title is returned right away and refreshed in background
+        monkeypatch.setattr(store, 'MAL_TITLE_REFRESH', -1)
+        assert await ops.resolve_mal_title(mal, show, store) == 'mal 1'
+        await asyncio.sleep(0.01)
+        assert await store.get_mal_title(show.id) == ('mal 2', True)
+
+
+@pytest.mark.asyncio
+async def test_resolve_mal_title_not_found(store, show_episode, monkeypatch):
+    show, episode = show_episode
+
+    async def get_title(self, query):
+        raise TitleNotFound(query)
+
+    monkeypatch.setattr(MALService, 'get_title', get_title)
+    async with MALService() as mal:
+        assert await ops.resolve_mal_title(mal, show, store) == 'show'
+    conn = await store.redis()
+    assert 0 < await conn.ttl(store.generate_key('mal_title', show.id)) <= store.MAL_TITLE_MISS_EXPIRY
+    urls = dict([e async for e in ops.watch_urls(show, episode, store)])
+    assert 'show' in str(urls['nyaasi[t]'])
+
+
+@pytest.mark.asyncio
+async def test_resolve_mal_title_same_as_trakt(store, show_episode, monkeypatch):
+    show, _ = show_episode
+
+    async def get_title(self, query):
+        return query
+
+    monkeypatch.setattr(MALService, 'get_title', get_title)
+    async with MALService() as mal:
+        assert await ops.resolve_mal_title(mal, show, store) == 'show'
+    conn = await store.redis()
+    assert await conn.ttl(store.generate_key('mal_title', show.id)) > store.MAL_TITLE_MISS_EXPIRY
+
+
+@pytest.mark.asyncio
+async def test_warm_up_mal_titles(store, show_episode, monkeypatch):
+    show, _ = show_episode
+    cartoon = Show(ids={'trakt': 2, 'slug': 'slug'}, title='cartoon', year=2020, genres=['animation'])
+
+    async def get_title(self, query):
+        return f'mal {query}'
+
+    monkeypatch.setattr(MALService, 'get_title', get_title)
+    await ops.warm_up_mal_titles(store, [show, cartoon])
+    assert await store.get_mal_title(show.id) == ('mal show', False)
+    assert await store.get_mal_title(cartoon.id) is None
+
+
+@pytest.mark.asyncio
+async def test_warm_up_mal_titles_cached(store, show_episode, monkeypatch):
+    show, _ = show_episode
+    await store.save_mal_title(show.id, 'mal show')
+
+    def session(*args, **kwargs):
+        raise AssertionError("session shouldn't be opened")
+
+    monkeypatch.setattr(MALService, '__aenter__', session)
+    await ops.warm_up_mal_titles(store, [show])
@@ -0,0 +1,120 @@
+import asyncio
+import threading
+from pathlib import Path
+
+import pytest
+
+from traktogram.services.anime import MALService, NineAnimeService, TitleNotFound
+from traktogram.services import parsing
+from traktogram.services.parsing import ParsingExecutor, iter_chunks, parse_first, parse_response, read_response
+from traktogram.services.torrent import PirateBayService
+
+
+FIXTURES = Path(__file__).parent.parent / 'fixtures'
+
+
+@pytest.fixture
+def read_fixture():
+    def read(name):
+        return (FIXTURES / name).read_bytes()
+
+    return read
+
+
+def test_mal_title(read_fixture):
+    assert MALService.extract_title(read_fixture('mal_search.html')) == 'Boku no Hero Academia'
+    with pytest.raises(TitleNotFound):
+        MALService.extract_title(b'<html><body><div id="content"><table></table></div></body></html>')
+
+
+@pytest.mark.parametrize('episode, url', [
+    (None, 'https://9anime.to/watch/one-punch-man-2.1002'),
+    (10, 'https://9anime.to/watch/one-punch-man-2.1002'),
+    (13, None),
+])
+def test_9anime_url(read_fixture, episode, url):
+    assert NineAnimeService.extract_episode_url(read_fixture('9anime_filter.html'), episode) == url
+
+
+def test_magnet_link(read_fixture):
+    link = PirateBayService.extract_magnet_link(read_fixture('piratebay_search.html'))
+    assert link.startswith('magnet:?xt=urn:btih:4a5012dc')
+
+
+def test_early_exit():
+    data = b'<html><body>' + b'<a href="x">x</a>' * 1000 + b'<a href="magnet:1">m</a>' + b'<p>' * 10000
+    chunks = list(iter_chunks(data, 1024))
+    consumed = []
+
+    def gen():
+        for chunk in chunks:
+            consumed.append(chunk)
+            yield chunk
+
+    assert parse_first(gen(), 'a', PirateBayService.match_magnet_link) == 'magnet:1'
+    assert len(consumed) < len(chunks)
+
+
+def test_max_bytes():
+    data = b'<html><body>' + b'<p>filler</p>' * 1000 + b'<a href="magnet:1">m</a>'
+    assert parse_first(data, 'a', PirateBayService.match_magnet_link) == 'magnet:1'
+    assert parse_first(data, 'a', PirateBayService.match_magnet_link, max_bytes=1000) is None
+
+
+class FakeContent:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def iter_chunked(self, n):
+        for chunk in iter_chunks(self.data, n):
+            yield chunk
+
+
+class FakeResponse:
+    def __init__(self, data: bytes):
+        self.content = FakeContent(data)
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+@pytest.mark.asyncio
+async def test_read_response():
+    r = FakeResponse(b'x' * 100)
+    assert await read_response(r, max_bytes=30) == b'x' * 30
+    assert r.released
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('kind', ['inline', 'thread', 'process'])
+async def test_parse_response(read_fixture, monkeypatch, kind):
+    executor = ParsingExecutor(kind, max_workers=1)
+    monkeypatch.setattr(parsing, 'executor', executor)
+    try:
+        r = FakeResponse(read_fixture('9anime_filter.html'))
+        url = await parse_response(r, NineAnimeService.extract_episode_url, 10)
+        assert url == 'https://9anime.to/watch/one-punch-man-2.1002'
+    finally:
+        executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_executor_metrics():
+    executor = ParsingExecutor('thread', max_workers=1)
+    event = threading.Event()
+    try:
+        tasks = [asyncio.ensure_future(executor.run(event.wait)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        assert executor.metrics() == {'kind': 'thread', 'size': 1, 'running': 1, 'queued': 2, 'completed': 0}
+        event.set()
+        await asyncio.gather(*tasks)
+        assert executor.metrics()['completed'] == 3
+        assert executor.queue_depth == 0
+    finally:
+        executor.shutdown()
+
+
+def test_executor_kind():
+    with pytest.raises(ValueError):
+        ParsingExecutor('fork')
@@ -0,0 +1,81 @@
+import pytest
+
+from traktogram.services.providers import Provider, ProviderRegistry, ProviderUnavailable
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def registry(clock):
+    registry = ProviderRegistry(disabled=['kisa'], priority={'pahe': -1}, min_calls=3, cooldown=10, clock=clock)
+    for priority, name in enumerate(('mal', 'dao', 'pahe', 'kisa')):
+        registry.register(name, priority)
+    return registry
+
+
+def test_provider_scores(clock):
+    provider = Provider('p', clock=clock)
+    assert provider.error_rate == 0 and provider.latency == 0
+    provider.record(True, 1.)
+    provider.record(True, 3.)
+    provider.record(False, 10.)
+    assert provider.latency == 2.
+    assert provider.error_rate == pytest.approx(1 / 3)
+
+
+def test_circuit_breaker(clock):
+    provider = Provider('p', min_calls=3, cooldown=10, clock=clock)
+    for ok in (True, False, False):
+        provider.acquire()
+        provider.record(ok, 1.)
+    assert provider.state == Provider.OPEN
+    with pytest.raises(ProviderUnavailable):
+        provider.acquire()
+
+    # half-open lets through single probe
+    clock.now = 10
+    provider.acquire()
+    assert provider.state == Provider.HALF_OPEN
+    assert not provider.available
+    provider.record(False, 1.)
+    assert provider.state == Provider.OPEN
+
+    clock.now = 20
+    provider.acquire()
+    provider.record(True, 1.)
+    assert provider.state == Provider.CLOSED
+    assert provider.error_rate == 0
+
+
+def test_registry_config(registry):
+    assert not registry.available('kisa')
+    assert [p.name for p in registry.ordered(['mal', 'dao', 'pahe', 'kisa'])] == ['pahe', 'mal', 'dao']
+
+
+@pytest.mark.asyncio
+async def test_registry_track(registry, clock):
+    async with registry.track('mal'):
+        clock.now += 2
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            async with registry.track('dao'):
+                raise ValueError
+    assert registry['mal'].latency == 2
+    assert registry['dao'].state == Provider.OPEN
+    with pytest.raises(ProviderUnavailable):
+        async with registry.track('dao'):
+            pass
+    # unhealthy providers go last among equals
+    registry['mal'].priority = registry['dao'].priority
+    assert [p.name for p in registry.ordered(['dao', 'mal'])] == ['mal', 'dao']
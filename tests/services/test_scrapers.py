@@ -0,0 +1,60 @@
+import pytest
+
+from benchmarks.standin import StandIn
+from traktogram.services import parsing
+from traktogram.services.anime import AnimeDaoService, AnimepaheService, MALService, NineAnimeService
+from traktogram.services.parsing import ParsingExecutor
+from traktogram.services.session import Session
+from traktogram.services.torrent import PirateBayService
+
+
+@pytest.fixture
+async def standin(monkeypatch):
+    monkeypatch.setattr(parsing, 'executor', ParsingExecutor('inline'))
+    async with StandIn() as standin:
+        yield standin
+
+
+@pytest.mark.asyncio
+async def test_mal_title(standin):
+    async with MALService(standin.client_session()) as mal:
+        assert await mal.get_title('my hero academia') == 'Boku no Hero Academia'
+    assert standin.requests == [('myanimelist.net', '/anime.php', {'q': 'my hero academia'})]
+
+
+@pytest.mark.asyncio
+async def test_9anime_url(standin):
+    async with NineAnimeService(standin.client_session()) as nine:
+        assert await nine.get_9anime_url('one punch man', episode=3, season=2) == \
+            'https://9anime.to/watch/one-punch-man-2.1002'
+        assert await nine.get_9anime_url('one punch man', episode=13, season=2) is None
+    assert standin.requests[0][2]['keyword'] == 'one punch man 2'
+
+
+@pytest.mark.asyncio
+async def test_pahe_url(standin):
+    async with AnimepaheService(standin.client_session()) as pahe:
+        assert str(await pahe.season_url('one punch man', 2)) == 'https://animepahe.com/anime/one-punch-man-2'
+    assert standin.requests == [('animepahe.com', '/api', {'m': 'search', 'l': '8', 'q': 'one punch man 2'})]
+
+
+@pytest.mark.asyncio
+async def test_magnet_link(standin):
+    async with PirateBayService(standin.client_session()) as pb:
+        link = await pb.magnet_link('one punch man S02E03')
+    assert link.startswith('magnet:?xt=urn:btih:4a5012dc')
+    assert standin.requests == [('thepiratebay.org', '/search/one punch man S02E03', {})]
+
+
+@pytest.mark.asyncio
+async def test_animedao_url(standin):
+    async with AnimeDaoService(standin.client_session()) as dao:
+        url = await dao.episode_url('my hero academia', 1, 5)
+    assert url == 'https://animedao.com/watch-online/boku-no-hero-academia-episode-5'
+
+
+@pytest.mark.asyncio
+async def test_not_found(standin):
+    async with Session(standin.client_session()) as session:
+        r = await session.get('https://example.com/')
+        assert r.status == 404
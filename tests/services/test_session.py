@@ -0,0 +1,106 @@
+import asyncio
+from collections import defaultdict
+
+import pytest
+
+from traktogram.services import session
+from traktogram.services.session import HedgeBudget, LatencyWindow, Session
+
+
+class FakeResponse:
+    def __init__(self, n):
+        self.n = n
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+class FakeClientSession:
+    def __init__(self, delays):
+        self.delays = list(delays)
+        self.responses = []
+
+    async def get(self, url, **kwargs):
+        n = len(self.responses)
+        r = FakeResponse(n)
+        self.responses.append(r)
+        delay, error = self.delays[n], None
+        if isinstance(delay, tuple):
+            delay, error = delay
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        return r
+
+
+@pytest.fixture
+def budget(monkeypatch):
+    budget = HedgeBudget(ratio=1)
+    monkeypatch.setattr(session, 'hedge_budget', budget)
+    window = LatencyWindow(min_samples=2)
+    window.samples.extend([0.01, 0.01])
+    monkeypatch.setattr(session, 'latencies', defaultdict(lambda: window))
+    return budget
+
+
+def test_latency_window():
+    window = LatencyWindow(size=100, min_samples=10)
+    for i in range(9):
+        window.add(i)
+    assert window.percentile(0.9) is None
+    for i in range(9, 200):
+        window.add(i)
+    assert window.percentile(0.9) == 190
+    assert window.percentile(1) == 199
+
+
+def test_hedge_budget():
+    budget = HedgeBudget(ratio=0.5, max_tokens=1)
+    assert not budget.withdraw()
+    for _ in range(10):
+        budget.deposit()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+
+@pytest.mark.asyncio
+async def test_hedged_get(budget):
+    fake = FakeClientSession([1, 0.01])
+    r = await Session(fake, hedge=True).get('https://example.com')
+    assert r.n == 1
+    assert budget.sent == budget.won == 1
+    await asyncio.sleep(0)
+    assert len(fake.responses) == 2
+
+
+@pytest.mark.asyncio
+async def test_hedged_get_fast(budget):
+    fake = FakeClientSession([0])
+    r = await Session(fake, hedge=True).get('https://example.com')
+    assert r.n == 0
+    assert budget.sent == 0
+
+
+@pytest.mark.asyncio
+async def test_hedged_get_error(budget):
+    fake = FakeClientSession([(0.02, ValueError()), 0.05])
+    r = await Session(fake, hedge=True).get('https://example.com')
+    assert r.n == 1
+
+
+@pytest.mark.asyncio
+async def test_hedge_budget_exhausted(budget):
+    budget.ratio = 0
+    fake = FakeClientSession([0.05, 0])
+    r = await Session(fake, hedge=True).get('https://example.com')
+    assert r.n == 0
+    assert len(fake.responses) == 1
+
+
+@pytest.mark.asyncio
+async def test_hedging_disabled(budget):
+    fake = FakeClientSession([0.05, 0])
+    r = await Session(fake, hedge=False).get('https://example.com')
+    assert r.n == 0
+    assert len(fake.responses) == 1
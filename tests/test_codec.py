@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+from traktogram.codec import Codec, JsonCodec, MsgpackCodec, make_codec
+
+
+def test_make_codec():
+    codec = make_codec('json', 0)
+    assert isinstance(codec, JsonCodec) and codec.compress_threshold is None
+    with pytest.raises(ValueError):
+        make_codec('xml')
+    with pytest.raises(TypeError):
+        Codec()
+
+
+class TestJsonCodec:
+    def test_small(self):
+        codec = JsonCodec(compress_threshold=100)
+        data = codec.encode({'foo': 1})
+        assert data == b'\x01{"foo":1}'
+        assert Codec.decode(data) == {'foo': 1}
+
+    def test_compressed(self):
+        codec = JsonCodec(compress_threshold=100)
+        value = {'foo': 'bar' * 100}
+        data = codec.encode(value)
+        assert data[:1] == JsonCodec.compressed_header
+        assert len(data) < len(json.dumps(value))
+        assert codec.decode(data) == value
+
+    def test_no_compression(self):
+        codec = JsonCodec(compress_threshold=None)
+        assert codec.encode('bar' * 1000)[:1] == JsonCodec.header
+
+    def test_legacy(self):
+        value = {'foo': [1, 2]}
+        assert Codec.decode(json.dumps(value).encode()) == value
+        assert Codec.decode(json.dumps(value)) == value
+        assert Codec.decode(b'5') == 5
+
+
+class TestMsgpackCodec:
+    def test_round_trip(self):
+        pytest.importorskip('msgpack')
+        value = {'foo': 'bar' * 100, 'baz': [1, None]}
+        for threshold in (None, 10):
+            codec = MsgpackCodec(compress_threshold=threshold)
+            assert codec.decode(codec.encode(value)) == value
+            assert JsonCodec.decode(codec.encode(value)) == value
@@ -1,7 +1,7 @@
 import textwrap
 
 from traktogram.models import ShowEpisode
-from traktogram.rendering import render_html, render_string
+from traktogram.rendering import collapse_white_space, compile_string, render_html, render_string
 from traktogram.utils import dedent
 
 
@@ -34,6 +34,15 @@ class TestRender:
         """), foo=True)
         assert text == "foo\nbar"
 
+    def test_collapse_white_space(self):
+        assert collapse_white_space(" <br/> foo  <br/> <br/>\n bar\tbaz \n") == "foo\n\nbar\tbaz"
+
+    def test_string_template_cache(self):
+        compile_string.cache_clear()
+        for name in ('foo', 'bar'):
+            assert render_string("hi, {{ name }}", name=name) == f"hi, {name}"
+        assert compile_string.cache_info().hits == 1
+
 
 class TestMessages:
     def test_new_episode(self):
@@ -1,3 +1,6 @@
+import asyncio
+import json
+
 import pytest
 
 from traktogram.storage import Storage
@@ -23,10 +26,10 @@ async def test_redis_cache_dec(store):
     async def func(d):
         return {'foo': d}
 
-    key = store.make_func_key(func, 4)
+    key = await store.make_func_key(func, 4)
     assert await store.get_cache(key) is None
     assert await func(4) == {'foo': 4}
-    assert await store.get_cache(key) == b'{"foo": 4}'
+    assert store.codec.decode(await store.get_cache(key)) == {'foo': 4}
     assert await func(4) == {'foo': 4}
 
 
@@ -35,10 +38,10 @@ async def test_cached_call_coro(store: Storage):
     async def coro(a):
         return a + 1
 
-    key = store.make_func_key(coro, 4)
+    key = await store.make_func_key(coro, 4)
     assert await store.get_cache(key) is None
     assert await store.cached_call(coro, 4) == 5
-    assert await store.get_cache(key) == b'5'
+    assert store.codec.decode(await store.get_cache(key)) == 5
     assert await store.cached_call(coro, 4) == 5
 
 
@@ -47,8 +50,185 @@ async def test_cached_call_func(store: Storage):
     def func(a):
         return a + 1
 
-    key = store.make_func_key(func, 4)
+    key = await store.make_func_key(func, 4)
     assert await store.get_cache(key) is None
     assert await store.cached_call(func, 4) == 5
-    assert await store.get_cache(key) == b'5'
+    assert store.codec.decode(await store.get_cache(key)) == 5
+    assert await store.cached_call(func, 4) == 5
+
+
+@pytest.mark.asyncio
+async def test_func_key(store: Storage):
+    def func(a, b=2, client=None):
+        return a + b
+
+    key = await store.make_func_key(func, 1)
+    assert key == await store.make_func_key(func, a=1, b=2)
+    assert key != await store.make_func_key(func, 1, 3)
+    assert len(key) == len(await store.make_func_key(func, 'x' * 1000))
+    # only declared arguments participate in the key
+    key_a = await store.make_func_key(func, 1, 3, key_args=('a',))
+    assert key_a == await store.make_func_key(func, 1, 4, client=object(), key_args=('a',))
+    with pytest.raises(TypeError):
+        await store.make_func_key(func, 1, client=object())
+
+
+@pytest.mark.asyncio
+async def test_invalidate_cache(store: Storage):
+    def func(a):
+        return a + 1
+
+    assert await store.cached_call(func, 4) == 5
+    key = await store.make_func_key(func, 4)
+    assert store.codec.decode(await store.get_cache(key)) == 5
+    assert await store.invalidate_cache(func) == 1
+    new_key = await store.make_func_key(func, 4)
+    assert new_key != key
+    assert await store.get_cache(new_key) is None
     assert await store.cached_call(func, 4) == 5
+    assert store.codec.decode(await store.get_cache(new_key)) == 5
+
+
+@pytest.mark.asyncio
+async def test_pref(store: Storage):
+    assert await store.get_pref(user=1) == {}
+    await store.set_pref(user=1, on_watch='delete')
+    await store.update_pref(user=1, foo='bar')
+    assert await store.get_pref(user=1) == {'on_watch': 'delete', 'foo': 'bar'}
+
+
+@pytest.mark.asyncio
+async def test_legacy_creds(store: Storage):
+    conn, key = await store.creds_conn_key(1)
+    await conn.hset(key, 1, json.dumps({'access_token': 'a', 'refresh_token': 'r'}))
+    await store.save_creds(2, {'access_token': 'b', 'refresh_token': 'r'})
+    assert (await store.get_creds(1)).access_token == 'a'
+    creds = {user_id: c.access_token async for user_id, c in store.creds_iter()}
+    assert creds == {'1': 'a', '2': 'b'}
+
+
+@pytest.mark.asyncio
+async def test_pref_value(store: Storage):
+    assert await store.get_pref_value('on_watch', 'hide', user=1) == 'hide'
+    await store.update_pref(user=1, on_watch='delete')
+    assert await store.get_pref_value('on_watch', 'hide', user=1) == 'delete'
+    await store.set_pref(user=1, foo='bar')
+    assert await store.get_pref(user=1) == {'foo': 'bar'}
+
+
+@pytest.mark.asyncio
+async def test_legacy_pref(store: Storage):
+    conn, key = await store.pref_conn_key(user=1)
+    await conn.set(key, json.dumps({'on_watch': 'delete', 'foo': 1}))
+    await store.update_pref(user=1, foo=2)
+    assert await store.get_pref(user=1) == {'on_watch': 'delete', 'foo': 2}
+    await conn.set(key, json.dumps({'on_watch': 'nothing'}))
+    assert await store.get_pref_value('on_watch', user=1) == 'nothing'
+    # concurrent migrations don't drop updates
+    await conn.set(key, json.dumps({'on_watch': 'hide'}))
+    await asyncio.gather(*(store.update_pref(user=1, **{f'k{i}': i}) for i in range(5)))
+    assert await store.get_pref(user=1) == {'on_watch': 'hide', **{f'k{i}': i for i in range(5)}}
+
+
+@pytest.mark.asyncio
+async def test_prefs_many(store: Storage):
+    await store.update_pref(user=1, on_watch='delete', delivery='digest')
+    conn, key = await store.pref_conn_key(user=2)
+    await conn.set(key, json.dumps({'on_watch': 'nothing'}))
+    prefs = await store.get_prefs_many([1, 2, 3], 'on_watch', 'delivery')
+    assert prefs == {'1': {'on_watch': 'delete', 'delivery': 'digest'}, '2': {'on_watch': 'nothing'}, '3': {}}
+
+
+@pytest.mark.asyncio
+async def test_prerendered(store: Storage):
+    await store.save_prerendered(1, 'job', {'text': 'hi'})
+    assert await store.pop_prerendered(1, 'job') == {'text': 'hi'}
+    assert await store.pop_prerendered(1, 'job') is None
+
+
+@pytest.mark.asyncio
+async def test_creds_batches(store: Storage):
+    # small hashes are returned by single HSCAN call regardless of COUNT
+    for i in range(600):
+        await store.save_creds(i, {'access_token': f'a{i}', 'refresh_token': 'r'})
+    batches = [batch async for batch in store.creds_batches(count=10, validate=False)]
+    assert len(batches) > 1
+    creds = dict(e for batch in batches for e in batch)
+    assert len(creds) == 600
+    assert creds['3'].access_token == 'a3'
+
+
+@pytest.mark.asyncio
+async def test_hscan_batches_no_prefetch(store: Storage):
+    conn = await store.redis()
+    await conn.hmset_dict('h', {str(i): i for i in range(600)})
+    items = [e async for batch in store.hscan_batches('h', count=5, prefetch=False) for e in batch]
+    assert len(set(items)) == 600
+    # stop early, pending page is cancelled
+    async for _ in store.hscan_batches('h', count=5):
+        break
+
+
+@pytest.mark.asyncio
+async def test_shards(sharded_store: Storage):
+    store = sharded_store
+    for i in range(20):
+        await store.save_creds(i, {'access_token': f'a{i}', 'refresh_token': 'r'})
+        await store.update_pref(user=i, on_watch='delete')
+    shards = await store.all_shards()
+    key = store.generate_key('creds')
+    sizes = [await conn.hlen(key) for conn in shards]
+    assert sum(sizes) == 20 and all(sizes)
+    assert await (await store.redis()).hlen(key) == 0
+
+    assert (await store.get_creds(7)).access_token == 'a7'
+    assert await store.get_pref_value('on_watch', user=7) == 'delete'
+    creds = {u: c.access_token async for u, c in store.creds_iter()}
+    assert creds == {str(i): f'a{i}' for i in range(20)}
+    many = await store.get_creds_many([1, 2, 100])
+    assert many['1'].access_token == 'a1' and many['100'] is None
+    prefs = await store.get_prefs_many([1, 2, 100], 'on_watch')
+    assert prefs == {'1': {'on_watch': 'delete'}, '2': {'on_watch': 'delete'}, '100': {}}
+
+
+@pytest.mark.asyncio
+async def test_rebalance(sharded_store: Storage):
+    store = sharded_store
+    main = await store.redis()
+    # data saved before sharding was enabled
+    for i in range(10):
+        creds = store.codec.encode({'access_token': f'a{i}', 'refresh_token': 'r'})
+        await main.hset(store.generate_key('creds'), i, creds)
+        await main.hset(store.generate_key('pref', i, i), 'on_watch', store.codec.encode('delete'))
+    await main.hset(store.generate_key('history', 1), 10, 1)
+    await main.hset(store.generate_key('message_state', 1, 5), 'index', store.codec.encode(2))
+    await main.expire(store.generate_key('message_state', 1, 5), 100)
+    # newer data at the new location takes precedence
+    await store.save_creds(3, {'access_token': 'new', 'refresh_token': 'r'})
+    assert await store.get_creds(1) is None
+
+    assert await store.shards_changed()
+    assert await store.rebalance() == 22
+    assert not await store.shards_changed()
+    assert await main.keys(store.generate_key('*')) == [store.generate_key('shards').encode()]
+    assert (await store.get_creds(1)).access_token == 'a1'
+    assert (await store.get_creds(3)).access_token == 'new'
+    assert await store.get_pref_value('on_watch', user=7) == 'delete'
+    assert await store.get_pending_history(1, 10) is True
+    assert await store.get_message_state(1, 5) == {'index': 2}
+    conn, key = await store.message_state_conn_key(1, 5)
+    assert 0 < await conn.ttl(key) <= 100
+    assert await store.rebalance() == 0
+
+
+@pytest.mark.asyncio
+async def test_mal_title(store: Storage, monkeypatch):
+    assert await store.get_mal_title(1) is None
+    await store.save_mal_title(1, 'title')
+    assert await store.get_mal_title(1) == ('title', False)
+    monkeypatch.setattr(store, 'MAL_TITLE_REFRESH', -1)
+    assert await store.get_mal_title(1) == ('title', True)
+    await store.set_mal_title_override(1, 'override')
+    assert await store.get_mal_title(1) == ('override', False)
+    await store.set_mal_title_override(1, None)
+    assert await store.get_mal_title(1) == ('title', True)
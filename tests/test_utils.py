@@ -1,6 +1,7 @@
 import pytest
 
-from traktogram.utils import split_group
+from traktogram.models import IDs
+from traktogram.utils import HashRing, hash_key_args, split_group
 
 
 class TestSplitGroup:
@@ -17,7 +18,37 @@ class TestSplitGroup:
         assert gs == [[1, 2, 3], [4, 5], [6, 7]]
 
 
+class TestHashKeyArgs:
+    def test_fixed_length(self):
+        assert len(hash_key_args(1)) == len(hash_key_args('x' * 1000)) == 32
+
+    def test_dict_order(self):
+        assert hash_key_args({'a': 1, 'b': 2}) == hash_key_args({'b': 2, 'a': 1})
+
+    def test_model(self):
+        assert hash_key_args(IDs(trakt=1)) == hash_key_args({'trakt': 1})
+        assert hash_key_args(IDs(trakt=1)) != hash_key_args(IDs(trakt=2))
+
+    def test_default_repr(self):
+        with pytest.raises(TypeError):
+            hash_key_args(object())
+
+
 @pytest.mark.asyncio
 async def test_creds(store):
     async for user_id, creds in store.creds_iter():
         assert creds.access_token
+
+
+class TestHashRing:
+    def test_stable(self):
+        ring = HashRing(['a', 'b', 'c'])
+        nodes = [ring.get_node(i) for i in range(1000)]
+        assert set(nodes) == {'a', 'b', 'c'}
+        assert nodes == [HashRing(['c', 'b', 'a']).get_node(i) for i in range(1000)]
+
+    def test_add_node(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        moved = sum(before.get_node(i) != after.get_node(i) for i in range(1000))
+        assert moved < 400
@@ -4,14 +4,15 @@ import arq
 from aiogram import Bot
 from aiogram.utils import executor
 
-from traktogram.config import REDIS_URL, BOT_TOKEN
+from traktogram.codec import make_codec
+from traktogram.config import BOT_TOKEN, REDIS_SHARDS, REDIS_URL, STORAGE_CODEC, STORAGE_COMPRESS_THRESHOLD
 from traktogram.filters import CmdArgs
 from traktogram.logging_setup import setup_logging
 from traktogram.middlewares import LoggingMiddleware
 from traktogram.router import Dispatcher
 from traktogram.storage import Storage
-from traktogram.services import TraktClient
-from traktogram.worker import get_redis_settings, worker_queue_var
+from traktogram.services import TraktClient, parsing
+from traktogram.worker import get_redis_settings, schedule_rebalance, worker_queue_var
 
 
 logger = logging.getLogger(__name__)
@@ -19,7 +20,8 @@ logger = logging.getLogger(__name__)
 
 async def on_startup(dispatcher: Dispatcher, **kwargs):
     logger.debug('setting up services')
-    dispatcher.storage = Storage(REDIS_URL)
+    codec = make_codec(STORAGE_CODEC, STORAGE_COMPRESS_THRESHOLD)
+    dispatcher.storage = Storage(REDIS_URL, codec=codec, shards=REDIS_SHARDS)
 
     queue = await arq.create_pool(get_redis_settings())
     dispatcher.context_vars.update({
@@ -34,6 +36,7 @@ async def on_startup(dispatcher: Dispatcher, **kwargs):
         dispatcher.add_router(router)
 
     await dispatcher.storage.redis()  # test connection
+    await schedule_rebalance(queue, dispatcher.storage)
 
 
 async def on_shutdown(dispatcher: Dispatcher):
@@ -42,6 +45,7 @@ async def on_shutdown(dispatcher: Dispatcher):
     queue = context['queue']
     queue.close()
     await queue.wait_closed()
+    parsing.executor.shutdown()
     # storage and bot will be closed in dispatcher
     logger.debug('services were shut down')
 
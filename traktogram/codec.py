@@ -0,0 +1,114 @@
+import json
+import zlib
+from abc import ABC, abstractmethod
+from typing import Dict, Tuple, Type
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec(ABC):
+    """
+    Serialize values for storing in redis.
+
+    Every encoded value starts with a header byte which marks serialization format and
+    compression, so values written by any codec can be decoded by any other one.
+    Values without known header are treated as legacy plain json.
+    """
+    header: bytes
+    compressed_header: bytes
+
+    def __init__(self, compress_threshold: int = 1024, compress_level: int = 6):
+        """
+        :param compress_threshold: compress payloads which are at least that long,
+            `None` disables compression
+        :param compress_level: zlib compression level
+        """
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    @classmethod
+    @abstractmethod
+    def dumps(cls, value) -> bytes:
+        pass
+
+    @classmethod
+    @abstractmethod
+    def loads(cls, data: bytes):
+        pass
+
+    def encode(self, value) -> bytes:
+        data = self.dumps(value)
+        if self.compress_threshold is not None and len(data) >= self.compress_threshold:
+            return self.compressed_header + zlib.compress(data, self.compress_level)
+        return self.header + data
+
+    @staticmethod
+    def decode(data: bytes):
+        if data is None:
+            return None
+        if isinstance(data, str):
+            data = data.encode()
+        header, body = data[:1], data[1:]
+        if header not in HEADERS:
+            return json.loads(data)
+        codec, compressed = HEADERS[header]
+        if compressed:
+            body = zlib.decompress(body)
+        return codec.loads(body)
+
+
+class JsonCodec(Codec):
+    header = b'\x01'
+    compressed_header = b'\x02'
+
+    @classmethod
+    def dumps(cls, value) -> bytes:
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode()
+
+    @classmethod
+    def loads(cls, data: bytes):
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    header = b'\x03'
+    compressed_header = b'\x04'
+
+    def __init__(self, *args, **kwargs):
+        if msgpack is None:
+            raise ImportError("msgpack is not installed")
+        super().__init__(*args, **kwargs)
+
+    @classmethod
+    def dumps(cls, value) -> bytes:
+        return msgpack.packb(value, use_bin_type=True)
+
+    @classmethod
+    def loads(cls, data: bytes):
+        if msgpack is None:
+            raise ImportError("msgpack is not installed")
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS: Dict[str, Type[Codec]] = {
+    'json': JsonCodec,
+    'msgpack': MsgpackCodec,
+}
+
+HEADERS: Dict[bytes, Tuple[Type[Codec], bool]] = {}
+for _codec in CODECS.values():
+    HEADERS[_codec.header] = (_codec, False)
+    HEADERS[_codec.compressed_header] = (_codec, True)
+
+
+def make_codec(name: str = 'json', compress_threshold: int = 1024) -> Codec:
+    """
+    :param name: serialization format, one of `CODECS`
+    :param compress_threshold: see `Codec`, 0 disables compression
+    """
+    if name not in CODECS:
+        raise ValueError(f"unknown codec {name!r}, available: {', '.join(CODECS)}")
+    return CODECS[name](compress_threshold=compress_threshold or None)
@@ -12,6 +12,46 @@ LOG_LEVEL_ROOT = os.getenv('LOG_LEVEL_ROOT', 'WARNING')
 TRAKT_CLIENT_ID = os.getenv('TRAKT_CLIENT_ID')
 TRAKT_CLIENT_SECRET = os.getenv('TRAKT_CLIENT_SECRET')
 REDIS_URL = os.getenv('REDIS_URL')
+REDIS_SHARDS = [uri for uri in os.getenv('REDIS_SHARDS', '').split(',') if uri]
+# format of values in redis: json or msgpack (requires msgpack to be installed)
+STORAGE_CODEC = os.getenv('STORAGE_CODEC', 'json')
+# stored values of at least that many bytes are compressed, 0 disables compression
+STORAGE_COMPRESS_THRESHOLD = int(os.getenv('STORAGE_COMPRESS_THRESHOLD', '1024'))
 WORKER = os.getenv('WORKER', '1') == '1'
+SWEEP_BATCH_SIZE = int(os.getenv('SWEEP_BATCH_SIZE', '500'))
+SWEEP_CONCURRENCY = int(os.getenv('SWEEP_CONCURRENCY', '20'))
+PARSER_EXECUTOR = os.getenv('PARSER_EXECUTOR', 'thread')
+PARSER_POOL_SIZE = int(os.getenv('PARSER_POOL_SIZE', '2'))
+HEDGE_REQUESTS = os.getenv('HEDGE_REQUESTS', '0') == '1'
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '0.9'))
+# max ratio of hedged requests to all requests
+HEDGE_BUDGET = float(os.getenv('HEDGE_BUDGET', '0.1'))
+# update watch button before trakt confirms it
+OPTIMISTIC_WATCH = os.getenv('OPTIMISTIC_WATCH', '0') == '1'
+# seconds to coalesce watch history writes for, 0 writes them right away
+HISTORY_FLUSH_DELAY = float(os.getenv('HISTORY_FLUSH_DELAY', '0'))
+# failed flushes of coalesced history change before it is dropped
+HISTORY_WRITE_ATTEMPTS = int(os.getenv('HISTORY_WRITE_ATTEMPTS', '5'))
+# attach magnet links to notifications, requires scraping piratebay
+MAGNET_LINKS = os.getenv('MAGNET_LINKS', '0') == '1'
+# hours covered by single digest of users with 'digest' delivery, should divide 24
+DIGEST_WINDOW = int(os.getenv('DIGEST_WINDOW', '24'))
+# minutes before air time when notifications are prepared, 0 disables preparation
+WARM_UP_MINUTES = float(os.getenv('WARM_UP_MINUTES', '10'))
+# attempts to send notification before it is moved to dead letters
+DELIVERY_ATTEMPTS = int(os.getenv('DELIVERY_ATTEMPTS', '5'))
+# seconds before the first retry, doubled after every failed attempt
+DELIVERY_BACKOFF = float(os.getenv('DELIVERY_BACKOFF', '5'))
+DELIVERY_MAX_BACKOFF = float(os.getenv('DELIVERY_MAX_BACKOFF', '600'))
+# messages sent to a chat in one go, the rest are left for the next retry sweep,
+# sending them should take well below delivery lock expiry (60s)
+DELIVERY_BATCH = int(os.getenv('DELIVERY_BATCH', '20'))
+# comma separated provider names, e.g. "9anime,kisa"
+PROVIDERS_DISABLED = [name for name in os.getenv('PROVIDERS_DISABLED', '').split(',') if name]
+# comma separated provider priorities (lower goes first), e.g. "pahe:0,nyaasi:10"
+PROVIDERS_PRIORITY = {
+    name: int(priority)
+    for name, priority in (item.split(':') for item in os.getenv('PROVIDERS_PRIORITY', '').split(',') if item)
+}
 
 assert BOT_TOKEN and TRAKT_CLIENT_ID and TRAKT_CLIENT_SECRET and REDIS_URL
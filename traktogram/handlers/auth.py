@@ -5,10 +5,9 @@ from aiogram.types import Message
 
 from traktogram.rendering import render_html
 from traktogram.router import Router
-from traktogram.services.notifications import NotificationScheduler
 from traktogram.storage import Storage
 from traktogram.services import TraktClient
-from traktogram.worker import get_tasks_keys, worker_queue_var
+from traktogram.worker import get_tasks_keys, schedule_user_notifications, worker_queue_var
 
 
 logger = logging.getLogger(__name__)
@@ -48,7 +47,6 @@ async def process_auth_flow(message: Message):
 @router.command_handler('auth', help="log into trakt.tv")
 async def auth_handler(message: Message):
     storage = Storage.get_current()
-    trakt = TraktClient.get_current()
     queue = worker_queue_var.get()
     user_id = message.from_user.id
 
@@ -60,10 +58,8 @@ async def auth_handler(message: Message):
 
     await storage.set_state(user=user_id, state='auth')
     try:
-        if access_token := await process_auth_flow(message):
-            sess = trakt.auth(access_token)
-            service = NotificationScheduler(queue)
-            await service.schedule(sess, user_id)
+        if await process_auth_flow(message):
+            await queue.enqueue_job(schedule_user_notifications.__name__, user_id)
     finally:
         await storage.finish(user=user_id)
 
@@ -7,12 +7,12 @@ from aiogram.types import Message
 from traktogram.rendering import render_html
 from traktogram.router import Dispatcher, Router
 from traktogram.services import (
-    CalendarNotification, NotificationScheduler, TraktClient, TraktException,
-    trakt_session,
+    CalendarNotification, TraktClient, TraktException,
+    get_show_episode, history, trakt_session,
 )
 from traktogram.storage import Storage
 from traktogram.utils import a
-from traktogram.worker import worker_queue_var
+from traktogram.worker import get_tasks_keys, schedule_user_notifications, worker_queue_var
 
 
 logger = logging.getLogger(__name__)
@@ -46,8 +46,8 @@ async def cancel_handler(message: Message):
         sess = await trakt_session(user_id, storage)
         del user_data['deleted_episode']
         se, rfh_data, _ = await asyncio.gather(
-            sess.search_by_episode_id(de, extended=True),
-            sess.remove_from_history(de),
+            get_show_episode(de, sess, storage),
+            history.set_watched(sess, user_id, de, False, storage),
             storage.set_data(user=user_id, data=user_data),
         )
         logger.debug((se, rfh_data))
@@ -77,8 +77,7 @@ async def on_watch_behavior_handler(message: Message, command_args, command_args
     b = command_args.behavior
     storage = Storage.get_current()
     if b is None:
-        user_pref = await storage.get_pref(user=message.from_user.id)
-        b = user_pref.get('on_watch', 'hide')
+        b = await storage.get_pref_value('on_watch', 'hide', user=message.from_user.id)
         await message.answer(f"current 'on watch' behavior is {b!r}")
     else:
         await asyncio.gather(
@@ -87,6 +86,35 @@ async def on_watch_behavior_handler(message: Message, command_args, command_args
         )
 
 
+@router.command_handler(
+    'delivery',
+    command_args=(
+        (('mode',), dict(choices=['instant', 'digest'], nargs='?')),
+    ),
+    help="how should bot deliver notifications: instant - message per episode, "
+         "digest - single message per day. Example: /delivery digest",
+)
+async def delivery_handler(message: Message, command_args, command_args_error):
+    if command_args_error:
+        await message.answer(command_args_error)
+        return
+    mode = command_args.mode
+    storage = Storage.get_current()
+    user_id = message.from_user.id
+    if mode is None:
+        mode = await storage.get_pref_value('delivery', 'instant', user=user_id)
+        await message.answer(f"current delivery mode is {mode!r}")
+        return
+    queue = worker_queue_var.get()
+    await storage.update_pref(user=user_id, delivery=mode)
+    # notifications which were scheduled in the old mode are replaced
+    if keys := await get_tasks_keys(queue, user_id):
+        await queue.delete(*keys)
+    if await storage.has_creds(user_id):
+        await queue.enqueue_job(schedule_user_notifications.__name__, user_id)
+    await message.answer(f"new delivery mode was set: {mode}")
+
+
 @router.command_handler(
     'calendar',
     command_args=(
@@ -113,6 +141,5 @@ async def calendar_show_handler(message: Message, command_args):
     queue = worker_queue_var.get()
     tasks = [message.answer(text)]
     if command_args.schedule:
-        service = NotificationScheduler(queue)
-        tasks.append(service.schedule(sess, user_id, episodes))
+        tasks.append(queue.enqueue_job(schedule_user_notifications.__name__, user_id, episodes))
     await asyncio.gather(*tasks)
@@ -3,11 +3,13 @@ import logging
 from datetime import datetime, timedelta
 
 from aiogram.types import CallbackQuery, Message
+from aiogram.utils.markdown import hcode
 
+from traktogram.config import OPTIMISTIC_WATCH
 from traktogram.router import Router
 from traktogram.services import (
-    CalendarMultiNotification, CalendarMultiNotificationFlow, CalendarNotification,
-    TraktClient, trakt_session,
+    CalendarDigest, CalendarDigestFlow, CalendarMultiNotification, CalendarMultiNotificationFlow,
+    CalendarNotification, TraktClient, get_show_episode, history, magnet_cd, trakt_session,
 )
 from traktogram.storage import Storage
 
@@ -16,14 +18,12 @@ logger = logging.getLogger(__name__)
 router = Router()
 single_nt_cd = CalendarNotification.cd
 multi_nt_cd = CalendarMultiNotification.cd
+digest_cd = CalendarDigest.cd
 
 
-async def toggle_watched_status(sess: TraktClient, episode_id, watched: bool):
+async def toggle_watched_status(sess: TraktClient, user_id, episode_id, watched: bool):
     logger.debug(f"was watched {watched}")
-    if watched:
-        await sess.remove_from_history(episode_id)
-    else:
-        await sess.add_to_history(episode_id)
+    await history.set_watched(sess, user_id, episode_id, not watched)
     return not watched
 
 
@@ -32,31 +32,39 @@ async def postponed_delete(msg: Message, delay=5.):
     await msg.delete()
 
 
+async def resolve_on_watch(query: CallbackQuery, user_id):
+    store = Storage.get_current()
+    on_watch = await store.get_pref_value('on_watch', 'hide', user=user_id)
+    # if message was created more than 48 hours ago then it cannot be deleted
+    now = datetime.now()
+    delta = now - query.message.date
+    if on_watch == 'delete' and delta >= timedelta(hours=48):
+        warn = await query.message.reply("quick note: bot cannot delete messages older then 48 hours",
+                                         disable_notification=True)
+        asyncio.create_task(postponed_delete(warn, delay=5))
+        on_watch = 'hide'
+    return on_watch
+
+
 @router.callback_query_handler(single_nt_cd.filter())
 async def calendar_notification_watch_handler(query: CallbackQuery, callback_data: dict):
+    if OPTIMISTIC_WATCH:
+        await optimistic_watch(query, callback_data)
+        return
     user_id = query.from_user.id
     episode_id = callback_data['id']
     prev_watched = callback_data.get('watched') == '1'
 
     store = Storage.get_current()
-    sess, user_pref = await asyncio.gather(
+    sess, on_watch = await asyncio.gather(
         trakt_session(user_id),
-        store.get_pref(user=user_id)
+        resolve_on_watch(query, user_id),
     )
-    on_watch = user_pref.get('on_watch', 'hide')
-    watched = await sess.watched(episode_id)
+    watched = await history.watched(sess, user_id, episode_id, store)
 
-    # if message was created more than 48 hours ago then it cannot be deleted
-    now = datetime.now()
-    delta = now - query.message.date
-    if on_watch == 'delete' and delta >= timedelta(hours=48):
-        warn = await query.message.reply("quick note: bot cannot delete messages older then 48 hours",
-                                         disable_notification=True)
-        asyncio.create_task(postponed_delete(warn, delay=5))
-        on_watch = 'hide'
     # delete message if it is marked as watched
     if on_watch == 'delete':
-        watched = await toggle_watched_status(sess, episode_id, watched)
+        watched = await toggle_watched_status(sess, user_id, episode_id, watched)
         if watched:
             logger.debug("episode is watched and on_watch=delete")
             await asyncio.gather(
@@ -64,26 +72,125 @@ async def calendar_notification_watch_handler(query: CallbackQuery, callback_dat
                 query.message.delete(),
                 query.answer("added to history"),
             )
+            if flush := history.pending_flush(user_id):
+                asyncio.create_task(reconcile_watched_status(query, sess, episode_id, watched, flush))
             return
     # sync with current watch status
     else:
         if watched is prev_watched:
-            watched = await toggle_watched_status(sess, episode_id, watched)
+            watched = await toggle_watched_status(sess, user_id, episode_id, watched)
         else:
             msg = 'watched' if watched else 'unwatched'
             logger.debug(f"user already marked this as {msg}")
 
-    se = await sess.search_by_episode_id(episode_id, extended=True)
+    se = await get_show_episode(episode_id, sess, store)
     logger.debug(se)
 
     # update keyboard
     hide = on_watch == 'hide'
-    markup = await CalendarNotification.markup(se, watched, hide=hide)
+    markup = await CalendarNotification.markup(se, watched, hide=hide, storage=store)
     await asyncio.gather(
         query.message.edit_text(query.message.html_text, reply_markup=markup,
                                 disable_web_page_preview=hide and watched),
         query.answer("added to history" if watched else "removed from history"),
     )
+    # coalesced change is written later, message is corrected if trakt doesn't accept it
+    if flush := history.pending_flush(user_id):
+        asyncio.create_task(reconcile_watched_status(query, sess, episode_id, watched, flush, se, hide))
+
+
+async def optimistic_watch(query: CallbackQuery, callback_data: dict):
+    """
+    Toggle watched status of the episode without waiting for trakt.
+    Message is updated right away and trakt is synced in background.
+    """
+    user_id = query.from_user.id
+    episode_id = callback_data['id']
+    watched = callback_data.get('watched') != '1'
+    # answer right away so that telegram stops showing progress on the button
+    await query.answer("added to history" if watched else "removed from history")
+    store = Storage.get_current()
+    sess, on_watch = await asyncio.gather(
+        trakt_session(user_id),
+        resolve_on_watch(query, user_id),
+    )
+
+    if on_watch == 'delete' and watched:
+        logger.debug("episode is watched and on_watch=delete")
+        await asyncio.gather(
+            store.update_data(user=user_id, data={'deleted_episode': episode_id}),
+            query.message.delete(),
+        )
+        asyncio.create_task(sync_watched_status(query, episode_id, watched))
+        return
+
+    hide = on_watch == 'hide'
+    se = await get_show_episode(episode_id, sess, store)
+    # reuse urls of the message, they will be resolved in background if message doesn't have them
+    urls = CalendarNotification.keyboard_urls(query.message.reply_markup)
+    need_urls = not urls and not (hide and watched)
+    markup = await CalendarNotification.markup(se, watched, hide=hide, storage=store, urls=urls)
+    await query.message.edit_text(query.message.html_text, reply_markup=markup,
+                                  disable_web_page_preview=hide and watched)
+    asyncio.create_task(sync_watched_status(query, episode_id, watched, se, hide, urls=None if need_urls else urls,
+                                            update=need_urls))
+
+
+async def sync_watched_status(query: CallbackQuery, episode_id, watched: bool, se=None, hide=False,
+                              urls=None, update=False):
+    """
+    Write watched status to trakt and wait until it is flushed. If trakt doesn't end up in the
+    expected state then message is corrected (or user is notified if message was deleted).
+    """
+    user_id = query.from_user.id
+    store = Storage.get_current()
+    try:
+        sess = await trakt_session(user_id)
+        actual = await history.watched(sess, user_id, episode_id, store)
+        if actual is not watched:
+            flush = await history.set_watched(sess, user_id, episode_id, watched, store)
+            actual = await watched_after_flush(sess, user_id, episode_id, watched, flush)
+    except Exception as e:
+        logger.exception(e)
+        actual = not watched
+    if actual is watched and not update:
+        return
+    await correct_watched_status(query, episode_id, actual, se, hide, urls)
+
+
+async def watched_after_flush(sess: TraktClient, user_id, episode_id, watched: bool, flush) -> bool:
+    """
+    Wait for `flush` returned by `history.set_watched` and return actual watched status.
+    Status stays pending if write is going to be retried and falls back to trakt if change was dropped.
+    """
+    if flush is None:
+        # change was written right away
+        return watched
+    await flush
+    return await history.watched(sess, user_id, episode_id)
+
+
+async def reconcile_watched_status(query: CallbackQuery, sess: TraktClient, episode_id, watched: bool, flush,
+                                   se=None, hide=False):
+    """Correct message once change of watched status is flushed if trakt didn't accept it."""
+    try:
+        actual = await watched_after_flush(sess, query.from_user.id, episode_id, watched, flush)
+    except Exception as e:
+        logger.exception(e)
+        return
+    if actual is not watched:
+        await correct_watched_status(query, episode_id, actual, se, hide)
+
+
+async def correct_watched_status(query: CallbackQuery, episode_id, actual: bool, se=None, hide=False, urls=None):
+    logger.debug(f"correcting watched status of {episode_id} to {actual}")
+    if se is None:
+        await query.message.answer("failed to update watch history, use /cancel to restore notification")
+        return
+    store = Storage.get_current()
+    markup = await CalendarNotification.markup(se, actual, hide=hide, storage=store, urls=urls)
+    await query.message.edit_text(query.message.html_text, reply_markup=markup,
+                                  disable_web_page_preview=hide and actual)
 
 
 @router.callback_query_handler(multi_nt_cd.filter(action='prev'))
@@ -112,12 +219,85 @@ async def calendar_multi_notification_next_handler(query: CallbackQuery, callbac
 async def calendar_multi_notification_watch_handler(query: CallbackQuery, callback_data: dict):
     f = CalendarMultiNotificationFlow(query)
     async with f.fetch_episode_data_context() as sess:
-        watched_current = await toggle_watched_status(sess, f.episode_id, f.watched)
+        watched_current = await toggle_watched_status(sess, f.user_id, f.episode_id, f.watched)
+        await f.set_episode_watched(f.episode_id, watched_current)
         # patch helper's watch and se so that the right episode will be displayed
         if watched_current:
             f.move_index(1)
-            f.watched = await sess.watched(f.episode_id)
+            f.watched = await f.episode_watched(f.episode_id)
         else:
             f.watched = False
     answer = f"marked as watched" if watched_current else "unwatched"
     await f.update_message(answer)
+
+
+@router.callback_query_handler(multi_nt_cd.filter(action=['all', 'upto']))
+async def calendar_multi_notification_watch_all_handler(query: CallbackQuery, callback_data: dict):
+    f = CalendarMultiNotificationFlow(query)
+    if callback_data['action'] == 'upto':
+        episodes_ids = f.episodes_ids[:f.index + 1]
+    else:
+        episodes_ids = f.episodes_ids
+    async with f.fetch_episode_data_context():
+        marked = await f.mark_watched(episodes_ids)
+        # show next episode after marked ones
+        f.move_index(len(episodes_ids) - f.index)
+        f.watched = await f.episode_watched(f.episode_id)
+    await f.update_message(f"marked {marked} episodes as watched")
+
+
+async def digest_flow(query: CallbackQuery, callback_data: dict) -> CalendarDigestFlow:
+    f = CalendarDigestFlow(query, int(callback_data['index']))
+    await f.fetch_data()
+    if not f.groups:
+        await query.answer("this digest is too old")
+        return None
+    return f
+
+
+@router.callback_query_handler(digest_cd.filter(action='prev'))
+async def calendar_digest_prev_handler(query: CallbackQuery, callback_data: dict):
+    f = await digest_flow(query, callback_data)
+    if f is None:
+        return
+    if f.index == 0:
+        await query.answer("this is first show in the digest")
+        return
+    f.move_index(-1)
+    await f.update_message()
+
+
+@router.callback_query_handler(digest_cd.filter(action='next'))
+async def calendar_digest_next_handler(query: CallbackQuery, callback_data: dict):
+    f = await digest_flow(query, callback_data)
+    if f is None:
+        return
+    if f.index == len(f.groups) - 1:
+        await query.answer("this is last show in the digest")
+        return
+    f.move_index(1)
+    await f.update_message()
+
+
+@router.callback_query_handler(digest_cd.filter(action='watch'))
+async def calendar_digest_watch_handler(query: CallbackQuery, callback_data: dict):
+    f = await digest_flow(query, callback_data)
+    if f is None:
+        return
+    marked = await f.mark_show_watched()
+    f.move_to_unwatched()
+    await f.update_message(f"marked {marked} episodes as watched", edit_text=True)
+
+
+@router.callback_query_handler(magnet_cd.filter())
+async def magnet_handler(query: CallbackQuery, callback_data: dict):
+    episode_id = int(callback_data['id'])
+    store = Storage.get_current()
+    link = (await store.get_magnets([episode_id])).get(episode_id)
+    if not link:
+        await query.answer("magnet link is not available anymore")
+        return
+    await asyncio.gather(
+        query.message.reply(hcode(link), disable_notification=True),
+        query.answer(),
+    )
@@ -1,28 +1,49 @@
-import re
+from functools import lru_cache
 from pathlib import Path
+from typing import Dict
 
 from jinja2 import Environment, FileSystemLoader, Template
 
 
-env = Environment(loader=FileSystemLoader(Path(__file__).parent / 'templates'))
-white_spaces = re.compile(r' +')
-leading_space = re.compile(r'(^ +| +$)', re.MULTILINE)
+TEMPLATES_DIR = Path(__file__).parent / 'templates'
+# templates don't change at runtime, so there is no need to check their files on every render
+env = Environment(loader=FileSystemLoader(str(TEMPLATES_DIR)), auto_reload=False)
+templates: Dict[str, Template] = {}
+
+
+def load_templates():
+    """Compile all html templates ahead of the first render."""
+    for name in env.list_templates(extensions=['html']):
+        templates[name[:-len('.html')]] = env.get_template(name)
+
+
+@lru_cache(maxsize=128)
+def compile_string(template: str) -> Template:
+    return env.from_string(template)
 
 
 def render_string(template: str, **kwargs):
-    template = Template(template)
-    return _render(template, **kwargs)
+    return _render(compile_string(template), **kwargs)
 
 
 def render_html(template_name: str, **kwargs):
-    template = env.get_template(f'{template_name}.html')
+    template = templates.get(template_name)
+    if template is None:
+        template = templates[template_name] = env.get_template(f'{template_name}.html')
     return _render(template, **kwargs)
 
 
+def collapse_white_space(text: str) -> str:
+    """
+    Turn `<br/>` (with surrounding white space) into line break and any other run of
+    spaces and new lines into single space.
+    """
+    lines = (' '.join(filter(None, line.replace('\n', ' ').split(' '))) for line in text.split('<br/>'))
+    return '\n'.join(lines).strip('\n')
+
+
 def _render(template: Template, **kwargs):
-    text = template.render(**kwargs)
-    text = text.replace('\n', ' ').replace(r'<br/>', '\n')
-    text = white_spaces.sub(' ', text)
-    text = leading_space.sub('', text)
-    text = text.strip(' \n')
-    return text
+    return collapse_white_space(template.render(**kwargs))
+
+
+load_templates()
@@ -1,8 +1,10 @@
 from .anime import AnimeDaoService, MALService, NineAnimeService
+from .episodes import get_show_episode, save_episodes
+from .magnets import magnet_cd, resolve_magnets
 from .notifications import (
-    CalendarMultiNotification, CalendarMultiNotificationFlow, CalendarNotification,
-    NotificationScheduler,
+    CalendarDigest, CalendarDigestFlow, CalendarMultiNotification, CalendarMultiNotificationFlow,
+    CalendarNotification, NotificationScheduler,
 )
-from .ops import trakt_session, watch_urls
+from .ops import trakt_session, warm_up_mal_titles, watch_urls
 from .torrent import NyaaSiService, PirateBayService
 from .trakt import TraktClient, TraktException
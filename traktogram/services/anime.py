@@ -1,10 +1,11 @@
 import asyncio
 import re
 
-from lxml import html
+from lxml import etree
 from slugify import slugify
 from yarl import URL
 
+from .parsing import parse_first, parse_response
 from .session import Session
 
 
@@ -12,15 +13,29 @@ white_space_re = re.compile(r'[\n\s]+')
 generic_season_ending = re.compile(r'(1st|first|2nd|second|3rd|third|\d+th) season$', re.I)
 
 
+class TitleNotFound(LookupError):
+    """MAL search has no results."""
+
+
 class MALService(Session):
+    in_content = etree.XPath("ancestor::div[@id='content']")
+    row_link = etree.XPath("td[2]//a[starts-with(@href, 'https://myanimelist.net/anime/')]")
+
     @classmethod
-    def extract_title(cls, text: bytes):
-        root = html.fromstring(text)
-        row = root.xpath("//div[@id='content']/descendant::table[last()]/descendant::tr[2]")[0]
-        info = row.xpath("td[2]")[0]
-        link = info.xpath(".//a[starts-with(@href, 'https://myanimelist.net/anime/')]")[0]
-        title = link.text_content().strip()
-        title = white_space_re.sub(' ', title)
+    def match_title(cls, row: etree.ElementBase):
+        """Extract title from the first search result row."""
+        if not cls.in_content(row):
+            return
+        link = cls.row_link(row)
+        if link:
+            title = ''.join(link[0].itertext()).strip()
+            return white_space_re.sub(' ', title)
+
+    @classmethod
+    def extract_title(cls, text: bytes) -> str:
+        title = parse_first(text, 'tr', cls.match_title)
+        if not title:
+            raise TitleNotFound("MAL search has no results")
         return title
 
     @classmethod
@@ -31,9 +46,8 @@ class MALService(Session):
     async def get_title(self, query: str):
         url = URL('https://myanimelist.net/anime.php')
         url = url.update_query(q=query)
-        r = await self.session.get(url)
-        text = await r.read()
-        return self.extract_title(text)
+        r = await self.get(url)
+        return await parse_response(r, self.extract_title)
 
 
 class AnimeDaoService(Session):
@@ -76,6 +90,10 @@ class AnimeDaoService(Session):
 
 class NineAnimeService(Session):
     episode_num = re.compile(r'ep (\d+)/\d+', re.I)
+    in_film_list = etree.XPath("parent::div[@class='film-list']")
+    not_subbed = etree.XPath(".//div[@class='status']//div[@class='dub' or @class='special' or @class='movie']")
+    item_link = etree.XPath('.//a')
+    item_episode = etree.XPath(".//div[@class='status']//div[@class='ep']")
 
     @classmethod
     def search_url(cls, title: str, season: int):
@@ -89,36 +107,40 @@ class NineAnimeService(Session):
         return url
 
     @classmethod
-    def extract_episode_url(cls, html_data: bytes, episode: int = None):
-        root = html.fromstring(html_data)
-        items = root.xpath("(//div[@class='film-list']/div[@class='item'])")
-        for item in items:
-            el = item.xpath(".//div[@class='status']//div[@class='dub' or @class='special' or @class='movie']")
-            if not el:
-                break
-        else:
+    def match_item(cls, item: etree.ElementBase):
+        """Match first subbed item of the film list."""
+        if item.get('class') == 'item' and cls.in_film_list(item) and not cls.not_subbed(item):
+            return item
+
+    @classmethod
+    def item_url(cls, item: etree.ElementBase, episode: int = None):
+        if item is None:
             # everything is dubbed/special/movie
             return
-        href = item.xpath('.//a')[0].get("href")
+        href = cls.item_link(item)[0].get("href")
 
         if episode is not None:
-            ep = item.xpath(".//div[@class='status']//div[@class='ep']")[0].text
+            ep = cls.item_episode(item)[0].text
             ep = int(cls.episode_num.search(ep)[1])
             if ep >= episode:
                 return href
             return
         return href
 
-    async def get_9anime_url(self, title, episode: int = None, **kwargs):
+    @classmethod
+    def extract_episode_url(cls, html_data: bytes, episode: int = None):
+        item = parse_first(html_data, 'div', cls.match_item)
+        return cls.item_url(item, episode)
+
+    async def get_9anime_url(self, title, episode: int = None, season: int = 0, **kwargs):
         """
         Scrap anime url from 9anime.to.
         If `episode` parameter is specified then url will be returned only if number
         of aired episode is greater or equal to `episode` param.
         """
-        url = self.search_url(title)
-        r = await self.session.get(url)
-        data = await r.read()
-        return self.extract_episode_url(data, episode)
+        url = self.search_url(title, season)
+        r = await self.get(url)
+        return await parse_response(r, self.extract_episode_url, episode)
 
 
 class KimCartoonService(Session):
@@ -148,7 +170,7 @@ class AnimepaheService(Session):
             l=8,
             q=title
         )
-        r = await self.session.get(url)
+        r = await self.get(url)
         data = await r.json()
         if data['total'] == 0:
             return
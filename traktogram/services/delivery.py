@@ -0,0 +1,131 @@
+import asyncio
+import logging
+from time import time
+from typing import Optional
+
+import aiohttp
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup, Message
+from aiogram.utils.exceptions import (
+    BadRequest, ConflictError, MigrateToChat, NotFound, RetryAfter, TelegramAPIError, Unauthorized,
+    ValidationError,
+)
+from pydantic import BaseModel
+
+from ..config import DELIVERY_ATTEMPTS, DELIVERY_BACKOFF, DELIVERY_BATCH, DELIVERY_MAX_BACKOFF, SWEEP_CONCURRENCY
+from ..storage import Storage
+
+
+logger = logging.getLogger(__name__)
+# errors which won't go away by retrying, e.g. user blocked bot or message is malformed
+PERMANENT_ERRORS = (BadRequest, Unauthorized, NotFound, ConflictError, MigrateToChat, ValidationError)
+# network errors and telegram failures (5xx, restarts)
+TRANSIENT_ERRORS = (TelegramAPIError, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class PreparedMessage(BaseModel):
+    """Rendered notification which can be sent with a single request."""
+    text: Optional[str] = None  # nothing should be sent if there is no text
+    markup: Optional[dict] = None
+    preview: bool = True
+    # message state to save once message id is known
+    state: dict = {}
+
+    async def send(self, bot: Bot, chat_id) -> Message:
+        markup = InlineKeyboardMarkup.to_object(self.markup) if self.markup else None
+        return await bot.send_message(chat_id, self.text, reply_markup=markup,
+                                      disable_web_page_preview=not self.preview)
+
+    async def save_state(self, storage: Storage, chat_id, msg: Message):
+        if self.state:
+            await storage.update_message_state(chat_id, msg.message_id, self.state)
+
+    async def deliver(self, bot: Bot, storage: Storage, chat_id):
+        """Send message through the chat delivery queue."""
+        if self.text is None:
+            return
+        await deliver(bot, storage, chat_id, self)
+
+
+def backoff(attempt: int) -> float:
+    """Delay before the next attempt after `attempt` failed ones."""
+    return min(DELIVERY_BACKOFF * 2 ** (attempt - 1), DELIVERY_MAX_BACKOFF)
+
+
+async def deliver(bot: Bot, storage: Storage, chat_id, message: PreparedMessage):
+    """
+    Queue message and deliver it right away if the chat isn't waiting for retry.
+    Messages of the chat are always sent in the order they were queued.
+    """
+    await storage.push_delivery(chat_id, {'message': message.dict(), 'attempts': 0})
+    await drain(bot, storage, chat_id)
+
+
+async def drain(bot: Bot, storage: Storage, chat_id) -> int:
+    """
+    Send queued messages of the chat until the queue is empty, sending fails or DELIVERY_BATCH
+    messages were processed, so that the chat lock doesn't expire in the middle of the drain.
+    Chat with messages left stays due and is drained again by the next retry sweep.
+    Failed message stays at the head of the queue and the chat is scheduled for retry
+    with exponential backoff or after delay requested by telegram. Messages which failed
+    permanently or DELIVERY_ATTEMPTS times are moved to dead letters.
+    Return number of sent messages.
+    """
+    due = await storage.delivery_delay(chat_id)
+    if due is None or due > time():
+        return 0
+    token = await storage.lock_delivery(chat_id)
+    if token is None:
+        # someone else is sending messages of this chat
+        return 0
+    sent = 0
+    try:
+        for _ in range(DELIVERY_BATCH):
+            item = await storage.peek_delivery(chat_id)
+            if item is None:
+                break
+            message = PreparedMessage(**item['message'])
+            try:
+                msg = await message.send(bot, chat_id)
+            except RetryAfter as e:
+                logger.debug(f"delivery to {chat_id} is throttled for {e.timeout}s")
+                await storage.delay_delivery(chat_id, time() + e.timeout)
+                break
+            except PERMANENT_ERRORS as e:
+                logger.warning(f"failed to deliver message to {chat_id}: {e!r}")
+                await storage.dead_letter(chat_id, item, repr(e))
+                await storage.pop_delivery(chat_id)
+                continue
+            except TRANSIENT_ERRORS as e:
+                item['attempts'] += 1
+                if item['attempts'] >= DELIVERY_ATTEMPTS:
+                    logger.warning(f"gave up delivering message to {chat_id} after {item['attempts']} attempts: {e!r}")
+                    await storage.dead_letter(chat_id, item, repr(e))
+                    await storage.pop_delivery(chat_id)
+                    continue
+                logger.debug(f"delivery to {chat_id} failed (attempt {item['attempts']}): {e!r}")
+                await storage.update_delivery(chat_id, item)
+                await storage.delay_delivery(chat_id, time() + backoff(item['attempts']))
+                break
+            await storage.pop_delivery(chat_id)
+            sent += 1
+            await message.save_state(storage, chat_id, msg)
+    finally:
+        await storage.unlock_delivery(chat_id, token)
+    return sent
+
+
+async def retry_due(bot: Bot, storage: Storage, count=100) -> int:
+    """Deliver messages of chats which are due for retry. Return number of sent messages."""
+    chats_ids = await storage.due_deliveries(count=count)
+    sem = asyncio.Semaphore(SWEEP_CONCURRENCY)
+
+    async def process(chat_id):
+        async with sem:
+            try:
+                return await drain(bot, storage, chat_id)
+            except Exception as e:
+                logger.exception(e)
+                return 0
+
+    return sum(await asyncio.gather(*(process(chat_id) for chat_id in chats_ids)))
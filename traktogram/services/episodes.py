@@ -0,0 +1,53 @@
+import logging
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from .trakt import TraktClient
+from ..models import ShowEpisode
+from ..storage import Storage
+
+
+logger = logging.getLogger(__name__)
+LRU_SIZE = 2048
+
+# episode id -> show episode, most recently used go last
+_lru: 'OrderedDict[int, ShowEpisode]' = OrderedDict()
+
+
+def remember(se: ShowEpisode):
+    _lru[se.episode.id] = se
+    _lru.move_to_end(se.episode.id)
+    while len(_lru) > LRU_SIZE:
+        _lru.popitem(last=False)
+
+
+async def save_episodes(storage: Storage, episodes: Iterable[ShowEpisode]):
+    """Save show and episode data of fetched episodes (e.g. from calendar) so that it can be recovered by id."""
+    new = {}
+    for se in episodes:
+        if se.episode.id not in _lru:
+            new[se.episode.id] = se
+    for se in new.values():
+        remember(ShowEpisode(show=se.show, episode=se.episode))
+    await storage.save_episodes(new.values())
+
+
+async def get_show_episode(episode_id, sess: TraktClient, storage: Storage = None) -> Optional[ShowEpisode]:
+    """Get show episode by trakt id from memory, then from storage and only then from trakt."""
+    episode_id = int(episode_id)
+    se = _lru.get(episode_id)
+    if se is not None:
+        _lru.move_to_end(episode_id)
+        return se
+    storage = storage or Storage.get_current()
+    data = await storage.get_episode(episode_id)
+    if data is not None:
+        se = ShowEpisode(**data)
+        remember(se)
+        return se
+    logger.debug(f"episode {episode_id} is not stored, fetching it from trakt")
+    se = await sess.search_by_episode_id(episode_id, extended=True)
+    if se is not None:
+        remember(ShowEpisode(show=se.show, episode=se.episode))
+        await storage.save_episodes([se])
+    return se
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from .trakt import TraktClient, TraktException
+from ..config import HISTORY_FLUSH_DELAY, HISTORY_WRITE_ATTEMPTS
+from ..models import ShowEpisode
+from ..storage import Storage
+
+
+logger = logging.getLogger(__name__)
+
+# user id -> scheduled flush of pending history changes
+_flushes: Dict[int, asyncio.Task] = {}
+
+
+async def watched(sess: TraktClient, user_id, episode_id, storage: Storage = None) -> bool:
+    """Watched status of the episode with pending (not yet written) changes taken into account."""
+    storage = storage or Storage.get_current()
+    pending = await storage.get_pending_history(user_id, episode_id)
+    if pending is not None:
+        return pending
+    return await sess.watched(episode_id)
+
+
+async def watched_many(sess: TraktClient, user_id, episodes: Iterable[ShowEpisode],
+                       storage: Storage = None) -> Dict[int, bool]:
+    """
+    Watched status of multiple episodes with pending changes taken into account.
+    Trakt is queried once per show.
+    """
+    storage = storage or Storage.get_current()
+    episodes = list(episodes)
+    res = await storage.get_pending_history_many(user_id, (se.episode.id for se in episodes))
+    unknown = defaultdict(list)
+    for se in episodes:
+        if se.episode.id not in res:
+            unknown[se.show.id].append(se)
+    progresses = await asyncio.gather(*(sess.watched_progress(show_id) for show_id in unknown))
+    for ses, progress in zip(unknown.values(), progresses):
+        for se in ses:
+            res[se.episode.id] = (se.episode.season, se.episode.number) in progress
+    return res
+
+
+async def set_watched(sess: TraktClient, user_id, episode_id, watched: bool,
+                      storage: Storage = None) -> Optional[asyncio.Task]:
+    """
+    Change watched status of the episode.
+    Changes are buffered in storage for HISTORY_FLUSH_DELAY seconds and written to trakt in batch.
+
+    :return: flush which will write the change, its result is dropped changes (see `flush_history`),
+        or None if change was written right away
+    """
+    storage = storage or Storage.get_current()
+    if HISTORY_FLUSH_DELAY <= 0:
+        if watched:
+            await sess.add_to_history(episode_id)
+        else:
+            await sess.remove_from_history(episode_id)
+        return None
+    await storage.queue_history(user_id, episode_id, watched)
+    if user_id not in _flushes:
+        _flushes[user_id] = asyncio.create_task(delayed_flush(sess, user_id, storage))
+    return _flushes[user_id]
+
+
+def pending_flush(user_id) -> Optional[asyncio.Task]:
+    """Flush which will write changes queued by the user so far, see `set_watched`."""
+    return _flushes.get(user_id)
+
+
+async def set_watched_many(sess: TraktClient, user_id, episodes_ids: List[int], watched: bool,
+                           storage: Storage = None):
+    """Change watched status of multiple episodes with single request."""
+    storage = storage or Storage.get_current()
+    if not episodes_ids:
+        return
+    if HISTORY_FLUSH_DELAY <= 0:
+        if watched:
+            await sess.add_to_history(*episodes_ids)
+        else:
+            await sess.remove_from_history(*episodes_ids)
+        return
+    for episode_id in episodes_ids:
+        await set_watched(sess, user_id, episode_id, watched, storage)
+
+
+async def delayed_flush(sess: TraktClient, user_id, storage: Storage) -> Optional[Dict[int, bool]]:
+    try:
+        await asyncio.sleep(HISTORY_FLUSH_DELAY)
+    finally:
+        # changes queued during flush will schedule next one
+        _flushes.pop(user_id, None)
+    try:
+        return await flush_history(sess, user_id, storage)
+    except Exception as e:
+        logger.exception(e)
+
+
+async def flush_history(sess: TraktClient, user_id, storage: Storage) -> Dict[int, bool]:
+    """
+    Write all pending changes of the user with at most one add and one remove requests.
+    Changes which failed to be written are returned to storage for the next flush. Changes which
+    trakt rejected or which failed HISTORY_WRITE_ATTEMPTS times are dropped.
+
+    :return: dropped changes
+    """
+    changes = await storage.pop_history(user_id)
+    add = [id for id, watched in changes.items() if watched]
+    remove = [id for id, watched in changes.items() if not watched]
+    failed, dropped = {}, {}
+    for ids, write in ((add, sess.add_to_history), (remove, sess.remove_from_history)):
+        if not ids:
+            continue
+        try:
+            await write(*ids)
+        except TraktException as e:
+            logger.warning(f"trakt rejected history of user {user_id}: {e!r}")
+            (dropped if e.permanent else failed).update((id, changes[id]) for id in ids)
+        except Exception as e:
+            logger.warning(f"failed to write history of user {user_id}: {e!r}")
+            failed.update((id, changes[id]) for id in ids)
+    await storage.clear_history_attempts(user_id, (id for id in changes if id not in failed))
+    dropped.update(await storage.restore_history(user_id, failed, max_attempts=HISTORY_WRITE_ATTEMPTS))
+    logger.debug(f"flushed history of user {user_id}: added {len(add)}, removed {len(remove)}, "
+                 f"failed {len(failed)}, dropped {len(dropped)}")
+    return dropped
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+from typing import Dict, Iterable, Optional
+
+from aiogram.utils.callback_data import CallbackData
+
+from .providers import ProviderUnavailable, registry
+from .torrent import PirateBayService
+from ..models import Episode, Show, ShowEpisode
+from ..storage import Storage
+from ..utils import Limiter
+
+
+logger = logging.getLogger(__name__)
+magnet_cd = CallbackData('m', 'id')
+
+# episode id -> future of magnet link, shared by concurrent resolvers
+_resolving: Dict[int, asyncio.Future] = {}
+# piratebay requests in flight across all resolvers
+scrape_limiter = Limiter(4)
+
+
+def magnet_query(show: Show, episode: Episode):
+    return f'{show.title} S{episode.season:02d}E{episode.number:02d}'
+
+
+async def scrape_magnet(pb: PirateBayService, se: ShowEpisode) -> Optional[str]:
+    async with scrape_limiter:
+        async with registry.track('piratebay'):
+            return await pb.magnet_link(magnet_query(se.show, se.episode))
+
+
+async def resolve_magnets(storage: Storage, episodes: Iterable[ShowEpisode]) -> Dict[int, Optional[str]]:
+    """
+    Resolve magnet links of all distinct episodes.
+    Every episode is scraped at most once per cache period, results (including misses)
+    are cached in storage so that sending notifications doesn't require any scraping.
+
+    :return: mapping of episode id to magnet link, None if link wasn't found
+    """
+    episodes = {se.episode.id: se for se in episodes}
+    magnets = await storage.get_magnets(episodes)
+    missing = [se for id, se in episodes.items() if id not in magnets]
+    if not missing or not registry.available('piratebay'):
+        return magnets
+
+    own = {}
+    async with PirateBayService() as pb:
+        for se in missing:
+            if se.episode.id not in _resolving:
+                own[se.episode.id] = _resolving[se.episode.id] = asyncio.ensure_future(scrape_magnet(pb, se))
+        try:
+            results = await asyncio.gather(*(_resolving[se.episode.id] for se in missing), return_exceptions=True)
+        finally:
+            for id in own:
+                _resolving.pop(id, None)
+
+    resolved = {}
+    for se, res in zip(missing, results):
+        if isinstance(res, ProviderUnavailable):
+            continue
+        if isinstance(res, Exception):
+            logger.warning(f"failed to resolve magnet link of {magnet_query(se.show, se.episode)!r}: {res!r}")
+            continue
+        resolved[se.episode.id] = res
+    await storage.save_magnets({id: link for id, link in resolved.items() if id in own})
+    magnets.update(resolved)
+    return magnets
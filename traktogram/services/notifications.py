@@ -1,32 +1,75 @@
 import asyncio
 import logging
+from collections import defaultdict
 from contextlib import asynccontextmanager
-from datetime import timedelta
-from typing import Callable, List, Union, Iterable
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 from aiogram import Bot
 from aiogram.types import CallbackQuery, InlineKeyboardButton as IKB, InlineKeyboardMarkup
 from aiogram.utils.callback_data import CallbackData
 from arq import ArqRedis
-from arq.constants import job_key_prefix
+from arq.constants import default_queue_name, job_key_prefix
+from arq.jobs import JobDef, deserialize_job
+from arq.utils import to_unix_ms
 
 from traktogram import rendering
+from traktogram.config import DIGEST_WINDOW, MAGNET_LINKS, SWEEP_CONCURRENCY, WARM_UP_MINUTES
 from traktogram.models import CalendarEpisode, ShowEpisode
 from traktogram.storage import Storage
-from traktogram.utils import compress_int, decompress_int, to_str
-from .ops import trakt_session, watch_urls
+from traktogram.utils import compress_int, decompress_int, split_group, to_str
+from . import history
+from .delivery import PreparedMessage
+from .episodes import get_show_episode, save_episodes
+from .magnets import magnet_cd, resolve_magnets
+from .ops import trakt_session, warm_up_mal_titles, watch_urls
 from .trakt import TraktClient
 
 
 logger = logging.getLogger(__name__)
+WatchUrls = List[Tuple[str, str]]
+
+
+async def make_watch_buttons(se: ShowEpisode, storage: Storage = None, urls: WatchUrls = None):
+    if urls is None:
+        urls = [(source, url) async for source, url in watch_urls(se.show, se.episode, storage)]
+    buttons = [IKB(source, url=str(url)) for source, url in urls]
+    if storage is not None:
+        magnets = await storage.get_magnets([se.episode.id])
+        if magnets.get(se.episode.id):
+            buttons.append(IKB('magnet', callback_data=magnet_cd.new(id=se.episode.id)))
+    return buttons
+
+
+def digest_window(dt: datetime, hours=DIGEST_WINDOW) -> datetime:
+    """Start of the digest window which contains `dt`. Windows are aligned to midnight."""
+    start = dt.replace(minute=0, second=0, microsecond=0)
+    return start - timedelta(hours=start.hour % hours)
 
 
 class NotificationScheduler:
     send_single_task_name = 'send_calendar_notifications'
     send_multi_task_name = 'send_calendar_multi_notifications'
+    send_digest_task_name = 'send_calendar_digest'
+    warm_up_task_name = 'warm_up_notifications'
 
-    def __init__(self, queue: ArqRedis):
+    def __init__(self, queue: ArqRedis, storage: Storage = None, precompute_urls=True, magnets=MAGNET_LINKS,
+                 warm_up=WARM_UP_MINUTES):
+        """
+        :param storage: used for resolving watch urls
+        :param precompute_urls: resolve watch urls at scheduling time and pass them with job
+            so that sending at air time doesn't need any scraping
+        :param magnets: resolve magnet links of scheduled episodes, requires storage
+        :param warm_up: minutes before air time when notifications of the same minute are prepared
+            in bulk, so that sending is a single request, 0 disables preparation
+        """
         self.queue = queue
+        self.storage = storage
+        self.precompute_urls = precompute_urls
+        self.magnets = magnets
+        self.warm_up = warm_up
+        self._urls: Dict[Tuple[int, int], asyncio.Future] = {}
+        self._warm_ups = set()
 
     @classmethod
     def make_job_id(cls, func: Union[str, Callable], user_id, *args, extra: Iterable = None):
@@ -55,9 +98,42 @@ class NotificationScheduler:
         if episodes is None:
             episodes = await sess.calendar_shows(start_date, days, extended=True)
         logger.debug(f"fetched {len(episodes)} episodes")
-        groups = CalendarEpisode.group_by_show(episodes, max_num=15)
-        await self.schedule_groups(user_id, groups)
-        logger.debug(f"scheduled {len(groups)} notifications")
+        if self.storage:
+            await save_episodes(self.storage, episodes)
+        if self.precompute_urls and self.storage:
+            # resolve MAL titles without deadline so that they won't be replaced by fallback in urls
+            await warm_up_mal_titles(self.storage, {e.show.id: e.show for e in episodes}.values())
+        if self.magnets and self.storage:
+            try:
+                await resolve_magnets(self.storage, episodes)
+            except Exception as e:
+                logger.exception(e)
+        delivery = 'instant'
+        if self.storage:
+            delivery = await self.storage.get_pref_value('delivery', 'instant', user=user_id)
+        if delivery == 'digest':
+            windows = await self.schedule_digests(user_id, episodes)
+            logger.debug(f"scheduled {windows} digests")
+        else:
+            groups = CalendarEpisode.group_by_show(episodes, max_num=15)
+            await self.schedule_groups(user_id, groups)
+            logger.debug(f"scheduled {len(groups)} notifications")
+        return episodes
+
+    async def collect_urls(self, se: ShowEpisode) -> Optional[WatchUrls]:
+        try:
+            return [(source, str(url)) async for source, url in watch_urls(se.show, se.episode, self.storage)]
+        except Exception as e:
+            logger.exception(e)
+
+    async def resolve_urls(self, se: ShowEpisode) -> Optional[WatchUrls]:
+        """Resolve watch urls of episode, each episode is resolved once per scheduler."""
+        if not self.precompute_urls:
+            return None
+        key = (se.show.id, se.episode.id)
+        if key not in self._urls:
+            self._urls[key] = asyncio.ensure_future(self.collect_urls(se))
+        return await self._urls[key]
 
     async def schedule_groups(self, user_id, groups: List[List[CalendarEpisode]]):
         for group in groups:
@@ -75,8 +151,10 @@ class NotificationScheduler:
             ce.show.id, ce.episode.id,
             ce.first_aired,
         )
+        urls = await self.resolve_urls(ce)
         await self.clear_existing_job(job_id)
-        await self.queue.enqueue_job(task_name, user_id, ce, _job_id=job_id, _defer_until=ce.first_aired)
+        await self.queue.enqueue_job(task_name, user_id, ce, urls, _job_id=job_id, _defer_until=ce.first_aired)
+        await self.schedule_warm_up(ce.first_aired)
 
     async def schedule_multi(self, user_id, group: List[CalendarEpisode]):
         task_name = self.send_multi_task_name
@@ -87,54 +165,202 @@ class NotificationScheduler:
             first.first_aired,
             extra=(e.episode.id for e in group)
         )
+        urls = await self.resolve_urls(first)
         await self.clear_existing_job(job_id)
-        await self.queue.enqueue_job(task_name, user_id, group, _job_id=job_id, _defer_until=first.first_aired)
+        await self.queue.enqueue_job(task_name, user_id, group, urls,
+                                     _job_id=job_id, _defer_until=first.first_aired)
+        await self.schedule_warm_up(first.first_aired)
+
+    async def schedule_digests(self, user_id, episodes: List[CalendarEpisode], max_num=30) -> int:
+        """
+        Schedule one digest per DIGEST_WINDOW instead of separate notifications.
+        Digest is sent when the last episode of the window is aired.
+        Windows with more than `max_num` episodes are split into several messages.
+        """
+        windows = defaultdict(list)
+        for ce in sorted(episodes, key=lambda e: e.first_aired):
+            windows[digest_window(ce.first_aired)].append(ce)
+        task_name = self.send_digest_task_name
+        for start, window in windows.items():
+            send_at = window[-1].first_aired
+            window = [ce for group in CalendarDigest.group_by_show(window) for ce in group]
+            for i, chunk in enumerate(split_group(window, max_num)):
+                job_id = self.make_job_id(task_name, user_id, start, i)
+                urls = await self.resolve_urls(chunk[0])
+                await self.clear_existing_job(job_id)
+                await self.queue.enqueue_job(task_name, user_id, chunk, urls,
+                                             _job_id=job_id, _defer_until=send_at + timedelta(seconds=i))
+                await self.schedule_warm_up(send_at)
+        return len(windows)
 
     @staticmethod
-    async def send_calendar_notifications(ctx: dict, user_id: str, ce: CalendarEpisode):
-        await CalendarNotification.send(ctx['bot'], ctx['trakt'], ctx['storage'], user_id, ce)
+    def warm_up_bucket(send_at: datetime) -> datetime:
+        return send_at.replace(second=0, microsecond=0)
+
+    async def schedule_warm_up(self, send_at: datetime):
+        """Schedule single preparation job for all notifications sent within the same minute."""
+        if self.warm_up <= 0:
+            return
+        bucket = self.warm_up_bucket(send_at)
+        if bucket in self._warm_ups:
+            return
+        self._warm_ups.add(bucket)
+        # job is shared between users, so it is not recreated if it already exists
+        job_id = f'{self.warm_up_task_name}-{to_str(bucket)}'
+        await self.queue.enqueue_job(self.warm_up_task_name, bucket,
+                                     _job_id=job_id, _defer_until=bucket - timedelta(minutes=self.warm_up))
 
     @staticmethod
-    async def send_calendar_multi_notifications(ctx: dict, user_id: str, episodes: List[CalendarEpisode]):
-        await CalendarMultiNotification.send(ctx['bot'], ctx['trakt'], ctx['storage'], user_id, episodes)
+    def job_episodes(job: JobDef) -> List[CalendarEpisode]:
+        payload = job.args[1]
+        return payload if isinstance(payload, list) else [payload]
+
+    @classmethod
+    async def prepare_job(cls, storage: Storage, job: JobDef, watched: Dict[int, bool],
+                          on_watch: str) -> PreparedMessage:
+        _, payload, urls = job.args
+        if job.function == cls.send_single_task_name:
+            return await CalendarNotification.prepare(storage, payload, watched[payload.episode.id], on_watch, urls)
+        if job.function == cls.send_multi_task_name:
+            return await CalendarMultiNotification.prepare(storage, payload, watched, urls)
+        return await CalendarDigest.prepare(storage, payload, watched, urls)
+
+    @classmethod
+    async def warm_up_notifications(cls, ctx: dict, bucket: datetime) -> int:
+        """
+        Prepare notifications which are going to be sent within a minute from `bucket`.
+        Credentials and preferences of their users are loaded in bulk, watched status is
+        queried once per user and show. Return number of prepared notifications.
+        """
+        queue: ArqRedis = ctx['redis']
+        trakt: TraktClient = ctx['trakt']
+        storage: Storage = ctx['storage']
+        start = to_unix_ms(bucket)
+        jobs_ids = await queue.zrangebyscore(default_queue_name, start, start + 59_999)
+        if not jobs_ids:
+            return 0
+        data = await queue.mget(*(job_key_prefix + job_id for job_id in jobs_ids), encoding=None)
+        send_tasks = {cls.send_single_task_name, cls.send_multi_task_name, cls.send_digest_task_name}
+        users_jobs = defaultdict(list)
+        for job_id, raw in zip(jobs_ids, data):
+            if raw is None:
+                continue
+            job = deserialize_job(raw)
+            if job.function in send_tasks:
+                users_jobs[job.args[0]].append((job_id, job))
+        creds, prefs = await asyncio.gather(
+            storage.get_creds_many(users_jobs),
+            storage.get_prefs_many(users_jobs, 'on_watch'),
+        )
+        sem = asyncio.Semaphore(SWEEP_CONCURRENCY)
+        # notifications are prepared WARM_UP_MINUTES before sending
+        expire = int(WARM_UP_MINUTES * 60) + storage.PRERENDER_EXPIRY
+
+        async def prepare(user_id, jobs: List[Tuple[str, JobDef]]):
+            user_creds = creds.get(str(user_id))
+            if user_creds is None:
+                return 0
+            on_watch = prefs.get(str(user_id), {}).get('on_watch', 'hide')
+            async with sem:
+                sess = trakt.auth(user_creds.access_token)
+                episodes = [ce for _, job in jobs for ce in cls.job_episodes(job)]
+                watched = await history.watched_many(sess, user_id, episodes, storage)
+                for job_id, job in jobs:
+                    message = await cls.prepare_job(storage, job, watched, on_watch)
+                    await storage.save_prerendered(user_id, job_id, message.dict(), expire=expire)
+            return len(jobs)
+
+        results = await asyncio.gather(*(prepare(user_id, jobs) for user_id, jobs in users_jobs.items()),
+                                       return_exceptions=True)
+        prepared = 0
+        for res in results:
+            if isinstance(res, Exception):
+                logger.error(f"failed to prepare notifications: {res!r}")
+            else:
+                prepared += res
+        logger.debug(f"prepared {prepared} notifications of {len(users_jobs)} users for {bucket}")
+        return prepared
+
+    @staticmethod
+    async def send_prepared(ctx: dict, user_id) -> bool:
+        """Send notification prepared by warm up. Return False if there is none."""
+        job_id = ctx.get('job_id')
+        if job_id is None:
+            return False
+        data = await ctx['storage'].pop_prerendered(user_id, job_id)
+        if data is None:
+            return False
+        await PreparedMessage(**data).deliver(ctx['bot'], ctx['storage'], user_id)
+        return True
+
+    @staticmethod
+    async def send_calendar_notifications(ctx: dict, user_id: str, ce: CalendarEpisode, urls: WatchUrls = None):
+        if await NotificationScheduler.send_prepared(ctx, user_id):
+            return
+        await CalendarNotification.send(ctx['bot'], ctx['trakt'], ctx['storage'], user_id, ce, urls=urls)
+
+    @staticmethod
+    async def send_calendar_multi_notifications(ctx: dict, user_id: str, episodes: List[CalendarEpisode],
+                                                urls: WatchUrls = None):
+        if await NotificationScheduler.send_prepared(ctx, user_id):
+            return
+        await CalendarMultiNotification.send(ctx['bot'], ctx['trakt'], ctx['storage'], user_id, episodes,
+                                             urls=urls)
+
+    @staticmethod
+    async def send_calendar_digest(ctx: dict, user_id: str, episodes: List[CalendarEpisode], urls: WatchUrls = None):
+        if await NotificationScheduler.send_prepared(ctx, user_id):
+            return
+        await CalendarDigest.send(ctx['bot'], ctx['trakt'], ctx['storage'], user_id, episodes, urls=urls)
 
 
 class CalendarNotification:
     cd = CallbackData('e', 'id', 'watched')
 
+    @staticmethod
+    def keyboard_urls(markup: Optional[InlineKeyboardMarkup]) -> WatchUrls:
+        """Extract watch urls from notification keyboard."""
+        if markup is None:
+            return []
+        return [(btn.text, btn.url) for row in markup.inline_keyboard[1:] for btn in row if btn.url]
+
     @classmethod
-    async def markup(cls, se: ShowEpisode, watched: bool, hide: bool):
+    async def markup(cls, se: ShowEpisode, watched: bool, hide: bool, storage: Storage = None,
+                     urls: WatchUrls = None):
         mark = '✅' if watched else '❌'
         cd = cls.cd.new(id=se.episode.ids.trakt, watched='1' if watched else '0')
         watch_btn = IKB(f'{mark} watched', callback_data=cd)
 
         kb = InlineKeyboardMarkup(row_width=5, inline_keyboard=[[watch_btn]])
         if not hide or not watched:
-            kb.add(*[
-                IKB(source, url=str(url))
-                async for source, url in watch_urls(se.show, se.episode)
-            ])
+            kb.add(*await make_watch_buttons(se, storage, urls))
         return kb
 
     @classmethod
-    async def send(cls, bot: Bot, trakt: TraktClient, storage: Storage, user_id, se: ShowEpisode,
-                   watched: bool = None):
+    async def prepare(cls, storage: Storage, se: ShowEpisode, watched: bool, on_watch: str,
+                      urls: WatchUrls = None) -> PreparedMessage:
+        if watched and on_watch == 'delete':
+            return PreparedMessage()
         text = rendering.render_html(
             'calendar_notification',
             show_episode=se,
         )
-        creds, user_pref = await asyncio.gather(
+        keyboard_markup = await cls.markup(se, watched=watched, hide=on_watch == 'hide', storage=storage,
+                                           urls=urls)
+        return PreparedMessage(text=text, markup=keyboard_markup.to_python(), preview=not watched)
+
+    @classmethod
+    async def send(cls, bot: Bot, trakt: TraktClient, storage: Storage, user_id, se: ShowEpisode,
+                   watched: bool = None, urls: WatchUrls = None):
+        creds, on_watch = await asyncio.gather(
             storage.get_creds(user_id),
-            storage.get_pref(user=user_id),
+            storage.get_pref_value('on_watch', 'hide', user=user_id),
         )
-        on_watch = user_pref.get('on_watch', 'hide')
         sess = trakt.auth(creds.access_token)
         if watched is None:
             watched = await sess.watched(se.episode.id)
-        if watched and on_watch == 'delete':
-            return
-        keyboard_markup = await cls.markup(se, watched=watched, hide=on_watch == 'hide')
-        await bot.send_message(user_id, text, reply_markup=keyboard_markup, disable_web_page_preview=watched)
+        message = await cls.prepare(storage, se, watched, on_watch, urls)
+        await message.deliver(bot, storage, user_id)
 
 
 class CalendarMultiNotification:
@@ -154,7 +380,8 @@ class CalendarMultiNotification:
         return ids
 
     @classmethod
-    async def markup(cls, se: ShowEpisode, episodes_ids: List[int], watched: bool, index=0):
+    async def markup(cls, se: ShowEpisode, episodes_ids: List[int], watched: bool, index=0,
+                     storage: Storage = None, urls: WatchUrls = None):
         prev_ids = cls.encode_ids(episodes_ids[:index])
         cur_id = cls.encode_ids(episodes_ids[index:index + 1])
         next_ids = cls.encode_ids(episodes_ids[index + 1:])
@@ -168,32 +395,110 @@ class CalendarMultiNotification:
                 callback_data=cls.cd.new(ids=next_ids, action='next')),
         ]
         kb = InlineKeyboardMarkup(inline_keyboard=[row])
+        bulk_row = [IKB('✅ all', callback_data=cls.cd.new(ids='-', action='all'))]
+        if 0 < index < len(episodes_ids) - 1:
+            bulk_row.insert(0, IKB(f'✅ up to {se.episode.season}x{se.episode.number}',
+                                   callback_data=cls.cd.new(ids=cur_id, action='upto')))
+        kb.row(*bulk_row)
         if not watched:
-            kb.add(*[
-                IKB(source, url=str(url))
-                async for source, url in watch_urls(se.show, se.episode)
-            ])
+            kb.add(*await make_watch_buttons(se, storage, urls))
         return kb
 
     @classmethod
-    async def send(cls, bot: Bot, trakt: TraktClient, storage: Storage, user_id: str, episodes: List[CalendarEpisode]):
+    async def prepare(cls, storage: Storage, episodes: List[CalendarEpisode], watched: Dict[int, bool],
+                      urls: WatchUrls = None) -> PreparedMessage:
         first = episodes[0]
         text = rendering.render_html(
             'calendar_multi_notification',
             show=first.show,
             episodes=episodes,
         )
+        episodes_ids = [cs.episode.id for cs in episodes]
+        # start from the first unwatched episode
+        index = next((i for i, id in enumerate(episodes_ids) if not watched[id]), len(episodes) - 1)
+        current = episodes[index]
+        if index != 0:
+            # precomputed urls belong to the first episode
+            urls = None
+        keyboard_markup = await cls.markup(current, episodes_ids, watched[current.episode.id], index=index,
+                                           storage=storage, urls=urls)
+        state = {'episodes': episodes_ids, **{f'watched:{id}': watched[id] for id in episodes_ids}}
+        if urls is not None:
+            state[f'urls:{current.episode.id}'] = urls
+        await save_episodes(storage, episodes)
+        return PreparedMessage(text=text, markup=keyboard_markup.to_python(), state=state)
+
+    @classmethod
+    async def send(cls, bot: Bot, trakt: TraktClient, storage: Storage, user_id: str, episodes: List[CalendarEpisode],
+                   urls: WatchUrls = None):
         creds = await storage.get_creds(user_id)
         sess = trakt.auth(creds.access_token)
-        watched = await sess.watched(first.episode.id)
-        episodes_ids = [cs.episode.id for cs in episodes]
-        keyboard_markup = await cls.markup(first, episodes_ids, watched)
-        await bot.send_message(user_id, text, reply_markup=keyboard_markup)
+        watched = await history.watched_many(sess, user_id, episodes, storage)
+        message = await cls.prepare(storage, episodes, watched, urls)
+        await message.deliver(bot, storage, user_id)
+
 
+class MessageStateFlow:
+    """Base of notification flows which keep watched flags and watch urls of episodes in message state."""
 
-class CalendarMultiNotificationFlow:
     def __init__(self, query: CallbackQuery):
         self.query = query
+        self.sess: Optional[TraktClient] = None
+        self.state: Optional[dict] = None
+
+    @property
+    def user_id(self):
+        return self.query.from_user.id
+
+    @property
+    def message_address(self):
+        return self.query.message.chat.id, self.query.message.message_id
+
+    async def load_state(self):
+        if self.state is None:
+            self.state = await Storage.get_current().get_message_state(*self.message_address)
+        return self.state
+
+    async def save_state(self, **state):
+        self.state.update(state)
+        await Storage.get_current().update_message_state(*self.message_address, state)
+
+    async def episode_watched(self, episode_id) -> bool:
+        field = f'watched:{episode_id}'
+        if field not in self.state:
+            watched = await history.watched(self.sess, self.user_id, episode_id)
+            await self.save_state(**{field: watched})
+        return self.state[field]
+
+    async def set_episode_watched(self, episode_id, watched: bool):
+        await self.save_state(**{f'watched:{episode_id}': watched})
+
+    async def mark_watched(self, episodes_ids: List[int]) -> int:
+        """Mark episodes as watched with single history write. Return number of newly watched episodes."""
+        ses = await asyncio.gather(*(get_show_episode(id, self.sess) for id in episodes_ids))
+        watched = await history.watched_many(self.sess, self.user_id, ses)
+        new = [id for id in episodes_ids if not watched[id]]
+        await history.set_watched_many(self.sess, self.user_id, new, True)
+        await self.save_state(**{f'watched:{id}': True for id in episodes_ids})
+        return len(new)
+
+    async def episode_urls(self, se: ShowEpisode) -> WatchUrls:
+        field = f'urls:{se.episode.id}'
+        if field not in self.state:
+            storage = Storage.get_current()
+            urls = [(source, str(url)) async for source, url in watch_urls(se.show, se.episode, storage)]
+            await self.save_state(**{field: urls})
+        return self.state[field]
+
+
+class CalendarMultiNotificationFlow(MessageStateFlow):
+    """
+    Navigation over episodes of multi notification.
+    Neighbours of displayed episode are prefetched in background.
+    """
+
+    def __init__(self, query: CallbackQuery):
+        super().__init__(query)
         self.buttons = query.message.reply_markup.inline_keyboard[0]
         self.episodes_ids = self.get_episode_ids()
         self.episode_id = self.get_current_episode()
@@ -222,18 +527,152 @@ class CalendarMultiNotificationFlow:
 
     @asynccontextmanager
     async def fetch_episode_data_context(self):
-        sess = await trakt_session(self.query.from_user.id)
-        self.watched = await sess.watched(self.episode_id)
-        yield sess
-        self.se = await sess.search_by_episode_id(self.episode_id)
+        self.sess, _ = await asyncio.gather(trakt_session(self.user_id), self.load_state())
+        self.watched = await self.episode_watched(self.episode_id)
+        yield self.sess
+        self.se = await get_show_episode(self.episode_id, self.sess)
 
     async def fetch_episode_data(self):
         async with self.fetch_episode_data_context():
             pass
 
+    async def prefetch_episode(self, episode_id):
+        se = await get_show_episode(episode_id, self.sess)
+        if not await self.episode_watched(episode_id):
+            await self.episode_urls(se)
+
+    async def prefetch_neighbours(self):
+        """Prefetch data of previous and next episodes so that navigation to them is served from cache."""
+        ids = [self.episodes_ids[i] for i in (self.index - 1, self.index + 1) if 0 <= i < len(self.episodes_ids)]
+        results = await asyncio.gather(*(self.prefetch_episode(id) for id in ids), return_exceptions=True)
+        for res in results:
+            if isinstance(res, Exception):
+                logger.warning(f"failed to prefetch episode: {res!r}")
+
     async def update_message(self, answer: str = None):
-        markup = await CalendarMultiNotification.markup(self.se, self.episodes_ids, self.watched, self.index)
+        urls = None if self.watched else await self.episode_urls(self.se)
+        markup = await CalendarMultiNotification.markup(self.se, self.episodes_ids, self.watched, self.index,
+                                                        storage=Storage.get_current(), urls=urls)
         await asyncio.gather(
             self.query.message.edit_reply_markup(markup),
             self.query.answer(answer)
         )
+        asyncio.create_task(self.prefetch_neighbours())
+
+
+class CalendarDigest:
+    """Single message with episodes of multiple shows aired within digest window."""
+    cd = CallbackData('dg', 'index', 'action')
+
+    @staticmethod
+    def group_by_show(episodes: List[ShowEpisode]) -> List[List[ShowEpisode]]:
+        """Group episodes by show keeping order of the first appearance."""
+        groups = {}
+        for se in episodes:
+            groups.setdefault(se.show.id, []).append(se)
+        return list(groups.values())
+
+    @staticmethod
+    def first_unwatched(group: List[ShowEpisode], watched: Dict[int, bool]) -> Optional[ShowEpisode]:
+        return next((se for se in group if not watched.get(se.episode.id)), None)
+
+    @staticmethod
+    def render(groups: List[List[ShowEpisode]], watched: Dict[int, bool]) -> str:
+        return rendering.render_html('calendar_digest', groups=groups, watched=watched)
+
+    @classmethod
+    async def markup(cls, groups: List[List[ShowEpisode]], watched: Dict[int, bool], index=0,
+                     storage: Storage = None, urls: WatchUrls = None):
+        group = groups[index]
+        current = cls.first_unwatched(group, watched)
+        mark = '❌' if current else '✅'
+        row = [
+            IKB('👈️' if index > 0 else '🤛',
+                callback_data=cls.cd.new(index=index, action='prev')),
+            IKB(f'{mark} {group[0].show.title} ({index + 1}/{len(groups)})',
+                callback_data=cls.cd.new(index=index, action='watch')),
+            IKB('👉' if index < len(groups) - 1 else '🤜',
+                callback_data=cls.cd.new(index=index, action='next')),
+        ]
+        kb = InlineKeyboardMarkup(inline_keyboard=[row])
+        if current:
+            kb.add(*await make_watch_buttons(current, storage, urls))
+        return kb
+
+    @classmethod
+    async def prepare(cls, storage: Storage, episodes: List[CalendarEpisode], watched: Dict[int, bool],
+                      urls: WatchUrls = None) -> PreparedMessage:
+        groups = cls.group_by_show(episodes)
+        # start from the first show with unwatched episodes
+        index = next((i for i, group in enumerate(groups) if cls.first_unwatched(group, watched)), 0)
+        current = cls.first_unwatched(groups[index], watched)
+        if current is not episodes[0]:
+            # precomputed urls belong to the first episode
+            urls = None
+        text = cls.render(groups, watched)
+        keyboard_markup = await cls.markup(groups, watched, index, storage=storage, urls=urls)
+        state = {
+            'digest': [[se.episode.id for se in group] for group in groups],
+            **{f'watched:{se.episode.id}': watched[se.episode.id] for se in episodes},
+        }
+        if urls is not None:
+            state[f'urls:{current.episode.id}'] = urls
+        await save_episodes(storage, episodes)
+        return PreparedMessage(text=text, markup=keyboard_markup.to_python(), preview=False, state=state)
+
+    @classmethod
+    async def send(cls, bot: Bot, trakt: TraktClient, storage: Storage, user_id: str, episodes: List[CalendarEpisode],
+                   urls: WatchUrls = None):
+        creds = await storage.get_creds(user_id)
+        sess = trakt.auth(creds.access_token)
+        watched = await history.watched_many(sess, user_id, episodes, storage)
+        message = await cls.prepare(storage, episodes, watched, urls)
+        await message.deliver(bot, storage, user_id)
+
+
+class CalendarDigestFlow(MessageStateFlow):
+    """Navigation over shows of digest."""
+
+    def __init__(self, query: CallbackQuery, index: int):
+        super().__init__(query)
+        self.index = index
+        self.groups: List[List[ShowEpisode]] = []
+
+    async def fetch_data(self):
+        self.sess, state = await asyncio.gather(trakt_session(self.user_id), self.load_state())
+        groups_ids = state.get('digest', [])
+        ses = iter(await asyncio.gather(*(get_show_episode(id, self.sess) for ids in groups_ids for id in ids)))
+        self.groups = [[next(ses) for _ in ids] for ids in groups_ids]
+        self.index = max(0, min(self.index, len(self.groups) - 1))
+
+    @property
+    def watched(self) -> Dict[int, bool]:
+        return {se.episode.id: self.state.get(f'watched:{se.episode.id}', False)
+                for group in self.groups for se in group}
+
+    def move_index(self, step):
+        self.index = max(0, min(self.index + step, len(self.groups) - 1))
+
+    def move_to_unwatched(self):
+        """Move to the next show with unwatched episodes, stay on current one if there are none."""
+        watched = self.watched
+        for i in range(self.index + 1, len(self.groups)):
+            if CalendarDigest.first_unwatched(self.groups[i], watched):
+                self.index = i
+                return
+
+    async def mark_show_watched(self) -> int:
+        return await self.mark_watched([se.episode.id for se in self.groups[self.index]])
+
+    async def update_message(self, answer: str = None, edit_text=False):
+        watched = self.watched
+        current = CalendarDigest.first_unwatched(self.groups[self.index], watched)
+        urls = await self.episode_urls(current) if current else None
+        markup = await CalendarDigest.markup(self.groups, watched, self.index, storage=Storage.get_current(),
+                                             urls=urls)
+        if edit_text:
+            edit = self.query.message.edit_text(CalendarDigest.render(self.groups, watched), reply_markup=markup,
+                                                disable_web_page_preview=True)
+        else:
+            edit = self.query.message.edit_reply_markup(markup)
+        await asyncio.gather(edit, self.query.answer(answer))
@@ -1,33 +1,157 @@
+import asyncio
 import logging
+from typing import Awaitable, Callable, Iterable, Optional, Set
 
 from . import anime
+from .providers import ProviderUnavailable, registry
 from .torrent import NyaaSiService
 from .trakt import TraktClient
 from ..models import Episode, Show
 from ..storage import Storage
+from ..utils import Limiter
 
 
 logger = logging.getLogger(__name__)
 
+MAL_DEADLINE = 2.
+PAHE_DEADLINE = 3.
 
-async def watch_urls(show: Show, episode: Episode):
+
+async def with_deadline(aw: Awaitable, deadline: float, fallback: Callable = None, name=None):
+    """
+    Await `aw` for at most `deadline` seconds.
+    If it is too slow or fails then result of `fallback` is returned instead.
+    """
+    try:
+        return await asyncio.wait_for(aw, deadline)
+    except asyncio.TimeoutError:
+        logger.warning(f"{name or aw!r} missed {deadline}s deadline")
+    except ProviderUnavailable as e:
+        logger.debug(f"{e} provider is unavailable")
+    except Exception as e:
+        logger.exception(e)
+    if fallback:
+        return fallback()
+
+
+_refreshing_titles: Set[int] = set()
+# MAL requests in flight across all resolvers and warm-ups
+mal_limiter = Limiter(4)
+
+
+async def scrape_mal_title(mal: anime.MALService, show: Show) -> Optional[str]:
+    """Scrape MAL title of the show, None if MAL doesn't know the show."""
+    async with mal_limiter, registry.track('mal'):
+        try:
+            return await mal.get_title(show.title)
+        except anime.TitleNotFound:
+            logger.debug(f"MAL doesn't know {show.title!r}")
+            return None
+
+
+async def fetch_mal_title(mal: anime.MALService, show: Show, storage: Storage) -> str:
+    """Scrape MAL title and save it, misses are saved for shorter time so that they are retried sooner."""
+    title = await scrape_mal_title(mal, show)
+    await storage.save_mal_title(show.id, title or show.title, miss=title is None)
+    return title or show.title
+
+
+async def refresh_mal_title(show: Show, storage: Storage, mal: anime.MALService = None):
+    if show.id in _refreshing_titles:
+        return
+    _refreshing_titles.add(show.id)
+    try:
+        if mal is None:
+            async with anime.MALService() as mal:
+                return await fetch_mal_title(mal, show, storage)
+        return await fetch_mal_title(mal, show, storage)
+    finally:
+        _refreshing_titles.discard(show.id)
+
+
+async def resolve_mal_title(mal: anime.MALService, show: Show, storage: Storage = None) -> str:
+    """
+    Get MAL title of the show.
+    Title is scraped only if it is not known yet, stale titles are refreshed in background.
+    """
+    if storage is None:
+        return await scrape_mal_title(mal, show) or show.title
+    cached = await storage.get_mal_title(show.id)
+    if cached:
+        title, stale = cached
+        if stale:
+            asyncio.create_task(refresh_mal_title(show, storage))
+        return title
+    return await fetch_mal_title(mal, show, storage)
+
+
+async def warm_up_mal_titles(storage: Storage, shows: Iterable[Show]):
+    """Scrape MAL titles of anime shows which are unknown or stale."""
+    shows = [show for show in shows if 'anime' in (show.genres or ())]
+    cached = await asyncio.gather(*(storage.get_mal_title(show.id) for show in shows))
+    shows = [show for show, c in zip(shows, cached) if not c or c[1]]
+    if not shows:
+        return
+
+    async def warm_up(mal: anime.MALService, show: Show):
+        try:
+            await refresh_mal_title(show, storage, mal)
+        except ProviderUnavailable:
+            pass
+        except Exception as e:
+            logger.exception(e)
+
+    async with anime.MALService() as mal:
+        await asyncio.gather(*(warm_up(mal, show) for show in shows))
+
+
+async def watch_urls(show: Show, episode: Episode, storage: Storage = None):
+    """
+    Generate urls of watch providers.
+    Scraped providers are resolved concurrently, each one has own deadline counted from the start
+    so that worst-case latency is bounded by the biggest deadline. Providers which missed the
+    deadline are replaced with urls which don't require scraping.
+    Unhealthy providers are not scraped at all, see `providers.registry`. Urls are ordered
+    by provider priority.
+    """
+    urls = {}
     if 'anime' in show.genres:
         async with anime.MALService() as mal:
-            title = await mal.get_title(show.title)
-            yield 'nyaasi[t]', NyaaSiService.search_url(title)
-            yield 'dao[q]', anime.AnimeDaoService.search_url(title)
-            yield '9anime[q]', anime.NineAnimeService.search_url(title, episode.season)
-            try:
-                yield 'pahe[s]', await anime.AnimepaheService(mal.session) \
-                    .season_url(title, episode.season)
-            except Exception as e:
-                logger.exception(e)
-            yield 'kisa[e]', anime.AnimekisaService.episode_url(title, episode.season, episode.number)
+            pahe = anime.AnimepaheService(mal.session)
+            title_task = asyncio.ensure_future(resolve_mal_title(mal, show, storage))
+
+            def known_title():
+                if title_task.done() and not title_task.cancelled() and not title_task.exception():
+                    return title_task.result()
+                return show.title
+
+            async def resolve_pahe_url():
+                if not registry.available('pahe'):
+                    raise ProviderUnavailable('pahe')
+                title = await asyncio.shield(title_task)
+                async with registry.track('pahe'):
+                    return await pahe.season_url(title, episode.season)
+
+            title, pahe_url = await asyncio.gather(
+                with_deadline(asyncio.shield(title_task), MAL_DEADLINE, fallback=known_title, name='mal'),
+                with_deadline(resolve_pahe_url(), PAHE_DEADLINE, name='pahe',
+                              fallback=lambda: pahe.guess_season_url(known_title(), episode.season)),
+            )
+            title_task.cancel()
+        urls['nyaasi'] = [('nyaasi[t]', NyaaSiService.search_url(title))]
+        urls['dao'] = [('dao[q]', anime.AnimeDaoService.search_url(title))]
+        urls['9anime'] = [('9anime[q]', anime.NineAnimeService.search_url(title, episode.season))]
+        urls['pahe'] = [('pahe[s]', pahe_url)]
+        urls['kisa'] = [('kisa[e]', anime.AnimekisaService.episode_url(title, episode.season, episode.number))]
     if 'animation' in show.genres:
-        yield 'kimcartoon', anime.KimCartoonService.episode_url(
-            show.title, episode.season, episode.number)
-        yield 'kimcartoon#2', anime.KimCartoonService.episode_url(
-            show.title, episode.season, episode.number, episode.title)
+        urls['kimcartoon'] = [
+            ('kimcartoon', anime.KimCartoonService.episode_url(show.title, episode.season, episode.number)),
+            ('kimcartoon#2', anime.KimCartoonService.episode_url(
+                show.title, episode.season, episode.number, episode.title)),
+        ]
+    for provider in registry.ordered(urls):
+        for url in urls[provider.name]:
+            yield url
 
 
 async def trakt_session(user_id, storage=None, trakt=None):
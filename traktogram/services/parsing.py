@@ -0,0 +1,150 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterable, Optional, TypeVar, Union
+
+from aiohttp import ClientResponse
+from lxml import etree
+
+from ..config import PARSER_EXECUTOR, PARSER_POOL_SIZE
+
+
+T = TypeVar('T')
+MAX_RESPONSE_BYTES = 1024 * 1024
+CHUNK_SIZE = 16 * 1024
+
+
+class FirstMatchParser:
+    """
+    Incremental html parser which stops as soon as the first matching element is found.
+
+    `match` is called for every closed `tag` element (with all its children already parsed)
+    and should return not-None value for the element we are looking for.
+    """
+
+    def __init__(self, tag: str, match: Callable[[etree.ElementBase], Optional[T]]):
+        self.parser = etree.HTMLPullParser(events=('end',), tag=tag)
+        self.match = match
+        self.result = None
+        self.done = False
+
+    def feed(self, chunk: bytes) -> bool:
+        """Feed next chunk of html. Return True if parsing is finished."""
+        if self.done:
+            return True
+        self.parser.feed(chunk)
+        return self.process_events()
+
+    def close(self) -> Optional[T]:
+        if not self.done:
+            self.parser.close()
+            self.process_events()
+            self.done = True
+        return self.result
+
+    def process_events(self):
+        for _, el in self.parser.read_events():
+            res = self.match(el)
+            if res is not None:
+                self.result = res
+                self.done = True
+                break
+        return self.done
+
+
+def iter_chunks(data: bytes, chunk_size=CHUNK_SIZE):
+    for i in range(0, len(data), chunk_size):
+        yield data[i:i + chunk_size]
+
+
+def parse_first(data: Union[bytes, Iterable[bytes]], tag: str, match: Callable[[etree.ElementBase], Optional[T]],
+                max_bytes=MAX_RESPONSE_BYTES) -> Optional[T]:
+    if isinstance(data, bytes):
+        data = iter_chunks(data)
+    parser = FirstMatchParser(tag, match)
+    read = 0
+    for chunk in data:
+        if parser.feed(chunk[:max_bytes - read]):
+            break
+        read += len(chunk)
+        if read >= max_bytes:
+            break
+    return parser.close()
+
+
+async def read_response(response: ClientResponse, max_bytes=MAX_RESPONSE_BYTES) -> bytes:
+    """Read at most `max_bytes` of response body."""
+    chunks = []
+    read = 0
+    try:
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            chunks.append(chunk[:max_bytes - read])
+            read += len(chunk)
+            if read >= max_bytes:
+                break
+    finally:
+        response.release()
+    return b''.join(chunks)
+
+
+class ParsingExecutor:
+    """
+    Run CPU-heavy parsing off the event loop.
+
+    :param kind: 'thread', 'process' or 'inline' (run in event loop)
+    :param max_workers: pool size
+    """
+
+    def __init__(self, kind='thread', max_workers=2):
+        if kind not in ('thread', 'process', 'inline'):
+            raise ValueError(f"unknown executor kind {kind!r}")
+        self.kind = kind
+        self.max_workers = max_workers
+        self.pool: Optional[Executor] = None
+        self.pending = 0
+        self.completed = 0
+
+    def get_pool(self) -> Executor:
+        if self.pool is None:
+            pool_cls = ThreadPoolExecutor if self.kind == 'thread' else ProcessPoolExecutor
+            self.pool = pool_cls(max_workers=self.max_workers)
+        return self.pool
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        if self.kind == 'inline':
+            return func(*args)
+        loop = asyncio.get_event_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(self.get_pool(), func, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    @property
+    def queue_depth(self):
+        """Number of submitted jobs which wait for free worker."""
+        return max(0, self.pending - self.max_workers)
+
+    def metrics(self) -> dict:
+        return {
+            'kind': self.kind,
+            'size': self.max_workers,
+            'running': min(self.pending, self.max_workers),
+            'queued': self.queue_depth,
+            'completed': self.completed,
+        }
+
+    def shutdown(self, wait=True):
+        if self.pool is not None:
+            self.pool.shutdown(wait=wait)
+            self.pool = None
+
+
+executor = ParsingExecutor(PARSER_EXECUTOR, PARSER_POOL_SIZE)
+
+
+async def parse_response(response: ClientResponse, extract: Callable[..., T], *args,
+                         max_bytes=MAX_RESPONSE_BYTES) -> T:
+    """Read response and parse it with `extract(data, *args)` in parsing executor."""
+    data = await read_response(response, max_bytes)
+    return await executor.run(extract, data, *args)
@@ -0,0 +1,157 @@
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Deque, Dict, Iterable, List, Tuple
+
+from ..config import PROVIDERS_DISABLED, PROVIDERS_PRIORITY
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderUnavailable(Exception):
+    pass
+
+
+class Provider:
+    """
+    Watch provider with health tracking.
+
+    Last `window` calls are used to compute latency and error rate. When error rate reaches
+    `error_threshold` circuit is opened and provider is skipped for `cooldown` seconds. After
+    that single probe call is let through (half-open state): success closes the circuit,
+    failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name: str, priority: int = 0, enabled=True, window=20, min_calls=5,
+                 error_threshold=0.5, cooldown=60., clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.priority = priority
+        self.enabled = enabled
+        self.min_calls = min_calls
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.calls: Deque[Tuple[bool, float]] = deque(maxlen=window)
+        self.state = self.CLOSED
+        self.opened_at = 0.
+        self.probing = False
+
+    def __repr__(self):
+        return f"Provider({self.name!r}, state={self.state!r}, error_rate={self.error_rate:.2f})"
+
+    @property
+    def error_rate(self) -> float:
+        if not self.calls:
+            return 0.
+        return sum(1 for ok, _ in self.calls if not ok) / len(self.calls)
+
+    @property
+    def latency(self) -> float:
+        """Average latency of successful calls."""
+        latencies = [latency for ok, latency in self.calls if ok]
+        if not latencies:
+            return 0.
+        return sum(latencies) / len(latencies)
+
+    @property
+    def available(self) -> bool:
+        if not self.enabled:
+            return False
+        if self.state == self.OPEN and self.clock() - self.opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+            self.probing = False
+        if self.state == self.HALF_OPEN:
+            return not self.probing
+        return self.state == self.CLOSED
+
+    def acquire(self):
+        """Claim a call. Raise `ProviderUnavailable` if circuit doesn't let it through."""
+        if not self.available:
+            raise ProviderUnavailable(self.name)
+        if self.state == self.HALF_OPEN:
+            self.probing = True
+
+    def record(self, ok: bool, latency: float):
+        self.calls.append((ok, latency))
+        if self.state == self.HALF_OPEN:
+            self.probing = False
+            if ok:
+                logger.info(f"{self.name} provider recovered")
+                self.state = self.CLOSED
+                self.calls.clear()
+            else:
+                self.open()
+        elif (self.state == self.CLOSED and len(self.calls) >= self.min_calls
+              and self.error_rate >= self.error_threshold):
+            self.open()
+
+    def open(self):
+        logger.warning(f"{self.name} provider is unhealthy, skipping it for {self.cooldown}s")
+        self.state = self.OPEN
+        self.opened_at = self.clock()
+
+
+class ProviderRegistry:
+    def __init__(self, disabled: Iterable[str] = (), priority: Dict[str, int] = None, **provider_kwargs):
+        """
+        :param disabled: names of disabled providers
+        :param priority: priority overrides, providers with lower priority go first
+        :param provider_kwargs: `Provider` parameters shared by all providers
+        """
+        self.disabled = set(disabled)
+        self.priority = priority or {}
+        self.provider_kwargs = provider_kwargs
+        self.providers: Dict[str, Provider] = {}
+
+    def register(self, name: str, priority: int = 0) -> Provider:
+        provider = Provider(
+            name,
+            priority=self.priority.get(name, priority),
+            enabled=name not in self.disabled,
+            **self.provider_kwargs,
+        )
+        self.providers[name] = provider
+        return provider
+
+    def __getitem__(self, name: str) -> Provider:
+        return self.providers[name]
+
+    def available(self, name: str) -> bool:
+        return self.providers[name].available
+
+    def ordered(self, names: Iterable[str]) -> List[Provider]:
+        """Enabled providers sorted by priority, healthier and faster ones go first among equals."""
+        providers = [self.providers[name] for name in names if self.providers[name].enabled]
+        return sorted(providers, key=lambda p: (p.priority, p.error_rate, p.latency))
+
+    @asynccontextmanager
+    async def track(self, name: str):
+        """
+        Measure call to provider. Raise `ProviderUnavailable` if provider is disabled or its
+        circuit is open. Exceptions and cancellations (e.g. missed deadlines) count as errors.
+        """
+        provider = self.providers[name]
+        provider.acquire()
+        start = provider.clock()
+        ok = False
+        try:
+            yield provider
+            ok = True
+        finally:
+            provider.record(ok, provider.clock() - start)
+
+
+def make_registry(**kwargs):
+    registry = ProviderRegistry(PROVIDERS_DISABLED, PROVIDERS_PRIORITY, **kwargs)
+    names = ('mal', 'nyaasi', 'dao', '9anime', 'pahe', 'kisa', 'kimcartoon', 'piratebay')
+    for priority, name in enumerate(names):
+        registry.register(name, priority)
+    return registry
+
+
+registry = make_registry()
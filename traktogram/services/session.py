@@ -1,11 +1,77 @@
-from typing import Coroutine
+import asyncio
+import logging
+from collections import defaultdict, deque
+from time import monotonic
+from typing import Coroutine, Deque, Dict, Optional
 
 import aiohttp
+from yarl import URL
+
+from ..config import HEDGE_BUDGET, HEDGE_PERCENTILE, HEDGE_REQUESTS
+
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyWindow:
+    """Latencies of the last `size` requests."""
+
+    def __init__(self, size=200, min_samples=20):
+        self.samples: Deque[float] = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, latency: float):
+        self.samples.append(latency)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Return `q` (0..1) percentile or None if there are not enough samples yet."""
+        if len(self.samples) < self.min_samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class HedgeBudget:
+    """
+    Token bucket which limits hedged requests to `ratio` of all requests.
+    Every request deposits `ratio` tokens, every hedge withdraws one.
+    """
+
+    def __init__(self, ratio=0.1, max_tokens=10.):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = 0.
+        self.sent = 0
+        self.won = 0
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        self.sent += 1
+        return True
+
+
+latencies: Dict[str, LatencyWindow] = defaultdict(LatencyWindow)
+hedge_budget = HedgeBudget(HEDGE_BUDGET)
+
+
+def release_response(task: asyncio.Future):
+    if not task.cancelled() and task.exception() is None:
+        task.result().release()
 
 
 class Session:
-    def __init__(self, session: aiohttp.ClientSession = None):
+    def __init__(self, session: aiohttp.ClientSession = None, hedge: bool = None):
+        """
+        :param hedge: send duplicate GET request if the first one is slower than
+            HEDGE_PERCENTILE of observed latency of the host, first response wins
+        """
         self.session = session or aiohttp.ClientSession()
+        self.hedge = HEDGE_REQUESTS if hedge is None else hedge
 
     async def __aenter__(self):
         return self
@@ -15,3 +81,41 @@ class Session:
 
     def close(self) -> Coroutine:
         return self.session.close()
+
+    async def get(self, url, **kwargs) -> aiohttp.ClientResponse:
+        window = latencies[URL(url).host]
+        hedge_budget.deposit()
+        delay = window.percentile(HEDGE_PERCENTILE) if self.hedge else None
+        start = monotonic()
+        if delay is None:
+            r = await self.session.get(url, **kwargs)
+        else:
+            r = await self.hedged_get(url, delay, **kwargs)
+        window.add(monotonic() - start)
+        return r
+
+    async def hedged_get(self, url, delay: float, **kwargs) -> aiohttp.ClientResponse:
+        tasks = {asyncio.ensure_future(self.session.get(url, **kwargs))}
+        hedge = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and hedge_budget.withdraw():
+                logger.debug(f"hedging request to {url} after {delay:.3f}s")
+                hedge = asyncio.ensure_future(self.session.get(url, **kwargs))
+                tasks.add(hedge)
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            hedge_budget.won += 1
+                        for other in done - {task}:
+                            release_response(other)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+                task.add_done_callback(release_response)
@@ -1,6 +1,7 @@
-from lxml import html
+from lxml import etree
 from yarl import URL
 
+from traktogram.services.parsing import parse_first, parse_response
 from traktogram.services.session import Session
 
 
@@ -10,18 +11,20 @@ class PirateBayService(Session):
         url = URL('https://thepiratebay.org/search')
         return url / query
 
+    @classmethod
+    def match_magnet_link(cls, el: etree.ElementBase):
+        href = el.get('href')
+        if href and href.startswith('magnet:'):
+            return href
+
     @classmethod
     def extract_magnet_link(cls, data: bytes):
-        root = html.fromstring(data)
-        el = root.xpath("/descendant::a[starts-with(@href, 'magnet:')][1]")
-        if el:
-            return el[0].get('href')
+        return parse_first(data, 'a', cls.match_magnet_link)
 
     async def magnet_link(self, query: str):
         url = self.search_url(query)
-        r = await self.session.get(url)
-        data = await r.read()
-        return self.extract_magnet_link(data)
+        r = await self.get(url)
+        return await parse_response(r, self.extract_magnet_link)
 
 
 class NyaaSiService(Session):
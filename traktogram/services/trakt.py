@@ -2,7 +2,7 @@ import asyncio
 import logging
 from datetime import datetime
 from time import time
-from typing import List, Optional
+from typing import List, Optional, Set, Tuple
 
 from aiogram.utils.mixins import ContextInstanceMixin
 from aiohttp import ClientSession
@@ -17,8 +17,15 @@ logger = logging.getLogger(__name__)
 
 
 class TraktException(Exception):
-    def __init__(self, data):
+    def __init__(self, data, status: int = None):
+        super().__init__(status, data)
         self.data = data
+        self.status = status
+
+    @property
+    def permanent(self) -> bool:
+        """Request was rejected and retrying it won't help (4xx except rate limiting)."""
+        return self.status is not None and 400 <= self.status < 500 and self.status != 429
 
 
 class TraktClient(Session, ContextInstanceMixin):
@@ -146,31 +153,47 @@ class TraktClient(Session, ContextInstanceMixin):
         data = await r.json()
         return [ShowEpisode(**e) for e in data]
 
-    async def add_to_history(self, episode_id) -> ShowEpisode:
+    async def add_to_history(self, *episodes_ids) -> dict:
         url = self.base / 'sync/history'
         data = {
-            'episodes': [{
-                'ids': {'trakt': episode_id}
-            }]
+            'episodes': [{'ids': {'trakt': episode_id}} for episode_id in episodes_ids]
         }
         r = await self.session.post(url, json=data, headers=self.headers)
         data = await r.json()
+        if not 200 <= r.status < 300:
+            raise TraktException(data, r.status)
         return data
 
-    async def remove_from_history(self, episode_id) -> ShowEpisode:
+    async def remove_from_history(self, *episodes_ids) -> dict:
         url = self.base / 'sync/history/remove'
         data = {
-            'episodes': [{
-                'ids': {'trakt': episode_id}
-            }]
+            'episodes': [{'ids': {'trakt': episode_id}} for episode_id in episodes_ids]
         }
         r = await self.session.post(url, json=data, headers=self.headers)
         data = await r.json()
+        if not 200 <= r.status < 300:
+            raise TraktException(data, r.status)
         return data
 
     async def watched(self, episode_id):
         return len(await self.get_history(episode_id)) != 0
 
+    async def watched_progress(self, show_id) -> Set[Tuple[int, int]]:
+        """Get season and number of all watched episodes of the show, specials included."""
+        url = self.base / f'shows/{show_id}/progress/watched'
+        # specials (season 0) are omitted from progress by default
+        url = url.update_query(specials='true')
+        r = await self.session.get(url, headers=self.headers)
+        data = await r.json()
+        if r.status != 200:
+            raise TraktException(data)
+        return {
+            (season['number'], episode['number'])
+            for season in data.get('seasons', [])
+            for episode in season['episodes']
+            if episode['completed']
+        }
+
     # = = = = = = = = = = = = = = = = = = = = = = = =
     # CALENDAR AND SEARCH
     # = = = = = = = = = = = = = = = = = = = = = = = =
@@ -195,15 +218,18 @@ class TraktClient(Session, ContextInstanceMixin):
         data = await r.json()
         return Episode(**data)
 
-    async def season_summary(self, show_id: str, season: int, extended=True):
+    async def seasons(self, show_id: str, extended=True) -> List[Season]:
         url = self.base / f'shows/{show_id}/seasons'
         if extended:
             url = url.update_query(extended='full')
         r = await self.session.get(url, headers=self.headers)
         seasons = await r.json()
-        for s in seasons:
-            if s['number'] == season:
-                return Season(**s)
+        return [Season(**s) for s in seasons]
+
+    async def season_summary(self, show_id: str, season: int, extended=True):
+        for s in await self.seasons(show_id, extended):
+            if s.number == season:
+                return s
 
     async def search_by_id(self, provider, id, type=None, extended=True):
         url = self.base / f'search/{provider}/{id}'
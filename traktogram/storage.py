@@ -1,22 +1,41 @@
 import asyncio
-import json
+import inspect
 import logging
+from collections import defaultdict
 from datetime import timedelta
+from time import time
 from functools import wraps
 from types import FunctionType
-from typing import Optional
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple, Union
+from uuid import uuid4
 
 import aioredis
 from aiogram.contrib.fsm_storage.redis import RedisStorage2
 from aiogram.utils.mixins import ContextInstanceMixin
 from pydantic import BaseModel
 
-from traktogram.utils import parse_redis_uri
+from traktogram.codec import Codec, JsonCodec
+from traktogram.utils import HashRing, hash_key_args, parse_redis_uri
 
 
 CREDS_KEY = 'creds'
 CACHE_KEY = 'cache'
+CACHE_VERSION_KEY = 'cache_version'
 USER_PREF_KEY = 'pref'
+MAL_TITLE_KEY = 'mal_title'
+MAL_TITLE_OVERRIDE_KEY = 'mal_title_override'
+MAGNET_KEY = 'magnet'
+EPISODE_KEY = 'episode'
+HISTORY_KEY = 'history'
+HISTORY_ATTEMPTS_KEY = 'history_attempts'
+HISTORY_PENDING_KEY = 'history_pending_since'
+MESSAGE_STATE_KEY = 'message_state'
+PRERENDER_KEY = 'prerender'
+DELIVERY_KEY = 'delivery'
+DELIVERY_DUE_KEY = 'delivery_due'
+DELIVERY_LOCK_KEY = 'delivery_lock'
+DELIVERY_DEAD_KEY = 'delivery_dead'
+SHARDS_KEY = 'shards'
 
 logger = logging.getLogger(__name__)
 
@@ -34,15 +53,47 @@ def display_redis_uri(host='localhost', port=6379, db=None, password=None, **kwa
     return uri
 
 
+async def merge_async_iters(*iters: AsyncIterator):
+    """Iterate over multiple async iterators concurrently, yield items as soon as they are ready."""
+    pending = {asyncio.ensure_future(it.__anext__()): it for it in iters}
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                it = pending.pop(fut)
+                try:
+                    item = fut.result()
+                except StopAsyncIteration:
+                    continue
+                pending[asyncio.ensure_future(it.__anext__())] = it
+                yield item
+    finally:
+        for fut in pending:
+            fut.cancel()
+
+
 class Storage(RedisStorage2, ContextInstanceMixin):
-    def __init__(self, uri=None, **kwargs):
+    def __init__(self, uri=None, codec: Codec = None, shards: Iterable[str] = None, **kwargs):
+        """
+        :param uri: main redis, holds FSM state, cache and, if there are no shards, users data
+        :param codec: values serializer
+        :param shards: redis uris between which users data (credentials, preferences)
+            is distributed by consistent hashing of user id
+        """
         kwargs.setdefault('prefix', 'traktogram')
+        self.codec = codec or JsonCodec()
         if uri:
             options = parse_redis_uri(uri)
             for k, v in options.items():
                 kwargs.setdefault(k, v)
         logger.debug(f"Connecting to redis: {display_redis_uri(**kwargs)}")
         super().__init__(**kwargs)
+        self.shards_options: Dict[str, dict] = {}
+        for shard_uri in shards or ():
+            options = parse_redis_uri(shard_uri)
+            self.shards_options[display_redis_uri(**options)] = options
+        self.shards_ring = HashRing(self.shards_options) if self.shards_options else None
+        self._shards: Dict[str, aioredis.Redis] = {}
 
     async def redis(self) -> aioredis.Redis:
         async with self._connection_lock:
@@ -55,60 +106,212 @@ class Storage(RedisStorage2, ContextInstanceMixin):
                 )
         return self._redis
 
+    async def shard(self, user_id) -> aioredis.Redis:
+        """Get redis which holds data of the user."""
+        if self.shards_ring is None:
+            return await self.redis()
+        name = self.shards_ring.get_node(user_id)
+        return await self.shard_by_name(name)
+
+    async def shard_by_name(self, name: str) -> aioredis.Redis:
+        async with self._connection_lock:
+            conn = self._shards.get(name)
+            if conn is None or conn.closed:
+                options = dict(self.shards_options[name])
+                address = options.pop('host'), options.pop('port')
+                conn = self._shards[name] = await aioredis.create_redis_pool(
+                    address, minsize=1, maxsize=self._pool_size, loop=self._loop, **options,
+                )
+        return conn
+
+    async def all_shards(self) -> List[aioredis.Redis]:
+        if self.shards_ring is None:
+            return [await self.redis()]
+        return list(await asyncio.gather(*map(self.shard_by_name, self.shards_options)))
+
     async def close(self):
         async with self._connection_lock:
             if self._redis and not self._redis.closed:
                 self._redis.close()
+            for conn in self._shards.values():
+                if not conn.closed:
+                    conn.close()
+
+    async def wait_closed(self):
+        await asyncio.gather(*(conn.wait_closed() for conn in self._shards.values()))
+        return await super().wait_closed()
 
     # = = = = = = = = = = = = = = = = = = = = = = = =
     # HELPERS
     # = = = = = = = = = = = = = = = = = = = = = = = =
 
-    async def hscan_iter(self: 'Storage', name, match=None, count=None):
-        conn = await self.redis()
-        cursor = '0'
-        while cursor != 0:
-            cursor, data = await conn.hscan(name, cursor=cursor, match=match, count=count)
-            for item in data:
+    SCAN_COUNT = 500
+
+    async def hscan_batches(self: 'Storage', name, match=None, count=SCAN_COUNT, prefetch=True,
+                            conn: aioredis.Redis = None):
+        """
+        Iterate over hash in batches of items returned by single HSCAN call.
+        Next batch is requested in background while consumer processes current one.
+
+        :param count: HSCAN COUNT hint, number of items per round trip
+        :param prefetch: request next page before current one is consumed
+        :param conn: redis to scan, main one by default
+        """
+        conn = conn or await self.redis()
+
+        def fetch(cursor):
+            return asyncio.ensure_future(conn.hscan(name, cursor=cursor, match=match, count=count))
+
+        page = fetch(0)
+        try:
+            while page:
+                cursor, data = await page
+                page = fetch(cursor) if cursor != 0 and prefetch else None
+                if data:
+                    yield data
+                if cursor != 0 and page is None:
+                    page = fetch(cursor)
+        finally:
+            if page:
+                page.cancel()
+
+    async def hscan_iter(self: 'Storage', name, match=None, count=SCAN_COUNT):
+        async for batch in self.hscan_batches(name, match=match, count=count):
+            for item in batch:
                 yield item
 
     # = = = = = = = = = = = = = = = = = = = = = = = =
-    # CREDENTIALS
+    # SHARDS REBALANCING
     # = = = = = = = = = = = = = = = = = = = = = = = =
 
+    # per user keys and position of the id by which key is sharded
+    SHARDED_KEYS = ((USER_PREF_KEY, -1), (HISTORY_KEY, -1), (HISTORY_ATTEMPTS_KEY, -1), (MESSAGE_STATE_KEY, -2))
+
+    async def move_key(self, src: aioredis.Redis, dst: aioredis.Redis, key) -> bool:
+        """Move key between redis instances. Key which already exists at destination takes precedence."""
+        data = await src.dump(key)
+        if data is None:
+            return False
+        ttl = await src.pttl(key)
+        try:
+            await dst.restore(key, max(ttl, 0), data)
+        except aioredis.ReplyError as e:
+            if not str(e).startswith('BUSYKEY'):
+                raise
+        await src.delete(key)
+        return True
+
     @property
-    async def creds_conn_key(self: 'Storage'):
+    def shards_layout(self) -> str:
+        return ','.join(sorted(self.shards_options))
+
+    async def shards_changed(self) -> bool:
+        """Check whether shards differ from the ones data was last rebalanced for."""
         conn = await self.redis()
+        layout = await conn.get(self.generate_key(SHARDS_KEY), encoding='utf-8')
+        return (layout or '') != self.shards_layout
+
+    async def rebalance(self) -> int:
+        """
+        Move users data to the shards it belongs to. Should be run after sharding was enabled
+        or shard was added, otherwise data left at the old location isn't visible (e.g. users are logged out).
+        Data which was already written to the new location takes precedence.
+        Scans whole keyspace of every instance so it isn't run on startup, see `worker.schedule_rebalance`.
+        Return number of moved entries.
+        """
+        main = await self.redis()
+        if self.shards_ring is None:
+            await main.delete(self.generate_key(SHARDS_KEY))
+            return 0
+        nodes = {name: await self.shard_by_name(name) for name in self.shards_options}
+        sources = dict(nodes)
+        main_name = display_redis_uri(host=self._host, port=self._port, db=self._db)
+        if main_name not in sources:
+            sources[main_name] = main
+        moved = 0
+        creds_key = self.generate_key(CREDS_KEY)
+        for name, conn in sources.items():
+            async for batch in self.hscan_batches(creds_key, conn=conn, prefetch=False):
+                for user_id, creds in batch:
+                    target = self.shards_ring.get_node(user_id.decode())
+                    if target != name:
+                        await nodes[target].hsetnx(creds_key, user_id, creds)
+                        await conn.hdel(creds_key, user_id)
+                        moved += 1
+            for prefix, position in self.SHARDED_KEYS:
+                async for key in conn.iscan(match=self.generate_key(prefix, '*')):
+                    target = self.shards_ring.get_node(key.decode().split(':')[position])
+                    if target != name and await self.move_key(conn, nodes[target], key):
+                        moved += 1
+        await main.set(self.generate_key(SHARDS_KEY), self.shards_layout)
+        if moved:
+            logger.info(f"moved {moved} users entries between shards")
+        return moved
+
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+    # CREDENTIALS
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+
+    async def creds_conn_key(self: 'Storage', user_id):
+        conn = await self.shard(user_id)
         creds_key = self.generate_key(CREDS_KEY)
         return conn, creds_key
 
     async def has_creds(self, user_id):
-        conn, key = await self.creds_conn_key
+        conn, key = await self.creds_conn_key(user_id)
         return await conn.hexists(key, user_id)
 
     async def save_creds(self, user_id, creds):
-        conn, key = await self.creds_conn_key
-        return await conn.hset(key, user_id, json.dumps(creds))
+        conn, key = await self.creds_conn_key(user_id)
+        return await conn.hset(key, user_id, self.codec.encode(creds))
 
     async def get_creds(self, user_id) -> Optional[Creds]:
-        conn, key = await self.creds_conn_key
+        conn, key = await self.creds_conn_key(user_id)
         data = await conn.hget(key, user_id)
         if data:
-            data = json.loads(data.decode())
-            return Creds(**data)
+            return Creds(**self.codec.decode(data))
+
+    async def get_creds_many(self, users_ids: Iterable) -> Dict[str, Optional[Creds]]:
+        """Fetch credentials of multiple users, one HMGET per shard, shards are queried in parallel."""
+        groups = defaultdict(list)
+        for user_id in users_ids:
+            groups[self.shards_ring.get_node(user_id) if self.shards_ring else None].append(str(user_id))
+
+        async def fetch(name, ids):
+            conn = await (self.shard_by_name(name) if name else self.redis())
+            values = await conn.hmget(self.generate_key(CREDS_KEY), *ids)
+            return zip(ids, values)
+
+        res = {}
+        for pairs in await asyncio.gather(*(fetch(name, ids) for name, ids in groups.items())):
+            for user_id, data in pairs:
+                res[user_id] = Creds(**self.codec.decode(data)) if data else None
+        return res
 
     async def remove_creds(self, user_id):
-        conn, key = await self.creds_conn_key
+        conn, key = await self.creds_conn_key(user_id)
         return await conn.hdel(key, user_id)
 
-    async def creds_iter(self):
-        conn, key = await self.creds_conn_key
-        async for user_id, tokens in self.hscan_iter(key):
-            data = json.loads(tokens.decode())
-            yield (
-                user_id.decode(),
-                Creds(**data),
-            )
+    async def creds_batches(self, count=SCAN_COUNT, validate=True) -> AsyncIterator[List[Tuple[str, Creds]]]:
+        """
+        Iterate over all users credentials in batches. Shards are scanned concurrently.
+
+        :param count: HSCAN COUNT hint
+        :param validate: skip pydantic validation if false, data was validated when it was saved
+        """
+        key = self.generate_key(CREDS_KEY)
+        make_creds = Creds if validate else Creds.construct
+        scans = [self.hscan_batches(key, count=count, conn=conn) for conn in await self.all_shards()]
+        async for batch in merge_async_iters(*scans):
+            yield [
+                (user_id.decode(), make_creds(**self.codec.decode(tokens)))
+                for user_id, tokens in batch
+            ]
+
+    async def creds_iter(self, count=SCAN_COUNT, validate=True):
+        async for batch in self.creds_batches(count, validate):
+            for item in batch:
+                yield item
 
     # = = = = = = = = = = = = = = = = = = = = = = = =
     # CACHE
@@ -143,60 +346,557 @@ class Storage(RedisStorage2, ContextInstanceMixin):
         return await conn.delete(name)
 
     @classmethod
-    def make_func_key(cls, func: FunctionType, *args, **kwargs):
-        key = ":".join(map(repr, (*args, *kwargs.values())))
-        key = f'{func.__module__}.{func.__qualname__}:{key}'
-        return key
+    def func_namespace(cls, func: Union[FunctionType, str]):
+        if isinstance(func, str):
+            return func
+        return f'{func.__module__}.{func.__qualname__}'
+
+    @classmethod
+    def hash_func_args(cls, func: FunctionType, args: tuple, kwargs: dict, key_args: Iterable[str] = None):
+        """
+        Hash call arguments into fixed length digest.
+        Arguments are bound to function signature so that positional and keyword calls
+        produce the same key. If `key_args` is specified then only those arguments
+        participate in the key.
+        """
+        try:
+            bound = inspect.signature(func).bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+        except (TypeError, ValueError):
+            params = {**dict(enumerate(args)), **kwargs}
+        if key_args is not None:
+            params = {k: params.get(k) for k in key_args}
+        return hash_key_args(params)
+
+    async def cache_version(self, func: Union[FunctionType, str]) -> int:
+        conn = await self.redis()
+        key = self.generate_key(CACHE_VERSION_KEY)
+        version = await conn.hget(key, self.func_namespace(func))
+        return int(version or 0)
+
+    async def invalidate_cache(self, func: Union[FunctionType, str]) -> int:
+        """Invalidate all cached results of the function by bumping its namespace version."""
+        conn = await self.redis()
+        key = self.generate_key(CACHE_VERSION_KEY)
+        return await conn.hincrby(key, self.func_namespace(func))
+
+    async def make_func_key(self, func: FunctionType, *args, key_args: Iterable[str] = None, **kwargs):
+        namespace = self.func_namespace(func)
+        version = await self.cache_version(namespace)
+        digest = self.hash_func_args(func, args, kwargs, key_args)
+        return f'{namespace}:{version}:{digest}'
+
+    # get namespace version and cached value under the versioned key in one round trip
+    GET_FUNC_CACHE_SCRIPT = """
+    local version = redis.call('HGET', KEYS[1], ARGV[1]) or '0'
+    local name = KEYS[2] .. ':' .. ARGV[1] .. ':' .. version .. ':' .. ARGV[2]
+    local value = redis.call('GET', name)
+    if value and tonumber(ARGV[3]) > 0 then
+        redis.call('EXPIRE', name, ARGV[3])
+    end
+    return {version, value}
+    """
+
+    async def get_func_cache(self, func: FunctionType, *args, expire=None, key_args: Iterable[str] = None,
+                             **kwargs) -> Tuple[str, Optional[bytes]]:
+        """
+        Get cached result of the call, same as `make_func_key` + `get_cache` but in single request.
+
+        :return: cache key and cached value
+        """
+        namespace = self.func_namespace(func)
+        digest = self.hash_func_args(func, args, kwargs, key_args)
+        conn, ckey = await self.cache_conn_key
+        version, res = await conn.eval(self.GET_FUNC_CACHE_SCRIPT,
+                                       keys=[self.generate_key(CACHE_VERSION_KEY), ckey],
+                                       args=[namespace, digest, expire or 0])
+        return f'{namespace}:{int(version)}:{digest}', res
 
-    def cache(self, expire=CACHE_EXPIRY):
+    def cache(self, expire=CACHE_EXPIRY, key_args: Iterable[str] = None):
         def wrap(f):
             @wraps(f)
             async def dec(*args, **kwargs):
-                key = self.make_func_key(f, *args, **kwargs)
-                res = await self.get_cache(key)
+                key, res = await self.get_func_cache(f, *args, key_args=key_args, **kwargs)
                 if res:
-                    return json.loads(res)
+                    return self.codec.decode(res)
                 res = await f(*args, **kwargs)
-                await self.save_cache(key, json.dumps(res), expire=expire)
+                await self.save_cache(key, self.codec.encode(res), expire=expire)
                 return res
 
             return dec
 
         return wrap
 
-    async def cached_call(self, func: FunctionType, *args, expire=CACHE_EXPIRY, **kwargs):
-        key = self.make_func_key(func, *args, **kwargs)
-        res = await self.get_cache(key, expire)
+    async def cached_call(self, func: FunctionType, *args, expire=CACHE_EXPIRY, key_args: Iterable[str] = None,
+                          **kwargs):
+        key, res = await self.get_func_cache(func, *args, expire=expire, key_args=key_args, **kwargs)
         if res:
-            return json.loads(res)
+            return self.codec.decode(res)
         maybe_coro = func(*args, **kwargs)
         if asyncio.iscoroutinefunction(func):
             res = await maybe_coro
         else:
             res = maybe_coro
-        await self.save_cache(key, json.dumps(res), expire=expire)
+        await self.save_cache(key, self.codec.encode(res), expire=expire)
         return res
 
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+    # MAL TITLES
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+
+    MAL_TITLE_EXPIRY = int(timedelta(days=90).total_seconds())
+    MAL_TITLE_REFRESH = int(timedelta(days=30).total_seconds())
+    # shows which MAL doesn't know are retried sooner
+    MAL_TITLE_MISS_EXPIRY = int(timedelta(days=1).total_seconds())
+
+    async def get_mal_title(self, show_id) -> Optional[Tuple[str, bool]]:
+        """
+        Get MAL title of trakt show.
+
+        :return: title and whether it should be refreshed, or None if title is unknown
+        """
+        conn = await self.redis()
+        pipe = conn.pipeline()
+        override = pipe.hget(self.generate_key(MAL_TITLE_OVERRIDE_KEY), show_id)
+        cached = pipe.get(self.generate_key(MAL_TITLE_KEY, show_id))
+        await pipe.execute()
+        override, cached = override.result(), cached.result()
+        if override:
+            return override.decode(), False
+        if cached:
+            data = self.codec.decode(cached)
+            return data['title'], time() - data['updated'] > self.MAL_TITLE_REFRESH
+        return None
+
+    async def save_mal_title(self, show_id, title: str, miss=False):
+        """
+        :param miss: MAL doesn't know the show and `title` is a fallback, such titles expire sooner
+        """
+        conn = await self.redis()
+        key = self.generate_key(MAL_TITLE_KEY, show_id)
+        value = self.codec.encode({'title': title, 'updated': int(time()), 'miss': miss})
+        expire = self.MAL_TITLE_MISS_EXPIRY if miss else self.MAL_TITLE_EXPIRY
+        await conn.set(key, value, expire=expire)
+
+    async def set_mal_title_override(self, show_id, title: Optional[str]):
+        """Manually set MAL title which takes precedence over scraped one. Remove override if title is None."""
+        conn = await self.redis()
+        key = self.generate_key(MAL_TITLE_OVERRIDE_KEY)
+        if title is None:
+            await conn.hdel(key, show_id)
+        else:
+            await conn.hset(key, show_id, title)
+
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+    # MAGNET LINKS
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+
+    MAGNET_EXPIRY = int(timedelta(hours=12).total_seconds())
+    MAGNET_MISS_EXPIRY = int(timedelta(hours=2).total_seconds())
+
+    async def get_magnets(self, episodes_ids: Iterable) -> Dict[int, Optional[str]]:
+        """
+        Get resolved magnet links of episodes.
+        Episodes which weren't resolved yet are missing in result, episodes without found
+        magnet link are mapped to None.
+        """
+        episodes_ids = list(episodes_ids)
+        if not episodes_ids:
+            return {}
+        conn = await self.redis()
+        values = await conn.mget(*(self.generate_key(MAGNET_KEY, id) for id in episodes_ids))
+        return {
+            id: value.decode() or None
+            for id, value in zip(episodes_ids, values)
+            if value is not None
+        }
+
+    async def save_magnets(self, magnets: Dict[int, Optional[str]]):
+        if not magnets:
+            return
+        conn = await self.redis()
+        pipe = conn.pipeline()
+        for id, link in magnets.items():
+            expire = self.MAGNET_EXPIRY if link else self.MAGNET_MISS_EXPIRY
+            pipe.set(self.generate_key(MAGNET_KEY, id), link or '', expire=expire)
+        await pipe.execute()
+
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+    # EPISODES
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+
+    # episodes are needed while their notifications can be interacted with, after that they are refetched
+    EPISODE_EXPIRY = int(timedelta(days=30).total_seconds())
+
+    async def save_episodes(self, episodes: Iterable[BaseModel]):
+        """Save show episodes under keys of trakt episode ids."""
+        episodes = list(episodes)
+        if not episodes:
+            return
+        conn = await self.redis()
+        pipe = conn.pipeline()
+        for se in episodes:
+            value = self.codec.encode({'show': se.show.dict(), 'episode': se.episode.dict()})
+            pipe.set(self.generate_key(EPISODE_KEY, se.episode.id), value, expire=self.EPISODE_EXPIRY)
+        await pipe.execute()
+
+    async def get_episode(self, episode_id) -> Optional[dict]:
+        conn = await self.redis()
+        data = await conn.get(self.generate_key(EPISODE_KEY, episode_id))
+        return self.codec.decode(data)
+
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+    # HISTORY WRITES
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+
+    # set pending operation of episode, opposite operations cancel each other out
+    QUEUE_HISTORY_SCRIPT = """
+    local cur = redis.call('HGET', KEYS[1], ARGV[1])
+    if cur and cur ~= ARGV[2] then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+        return -1
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    return tonumber(ARGV[2])
+    """
+
+    # failed attempts are forgotten if change isn't retried for that long
+    HISTORY_ATTEMPTS_EXPIRY = int(timedelta(days=1).total_seconds())
+
+    async def history_conn_key(self, user_id):
+        conn = await self.shard(user_id)
+        return conn, self.generate_key(HISTORY_KEY, user_id)
+
+    async def queue_history(self, user_id, episode_id, watched: bool) -> Optional[bool]:
+        """
+        Queue change of episode watched status.
+
+        :return: pending status of episode or None if change cancelled previous one
+        """
+        conn, key = await self.history_conn_key(user_id)
+        res = await conn.eval(self.QUEUE_HISTORY_SCRIPT, keys=[key], args=[episode_id, int(watched)])
+        await self.mark_history_pending(user_id)
+        return None if res == -1 else bool(res)
+
+    async def get_pending_history(self, user_id, episode_id) -> Optional[bool]:
+        conn, key = await self.history_conn_key(user_id)
+        value = await conn.hget(key, episode_id)
+        return None if value is None else value == b'1'
+
+    async def get_pending_history_many(self, user_id, episodes_ids: Iterable) -> Dict[int, bool]:
+        episodes_ids = list(episodes_ids)
+        if not episodes_ids:
+            return {}
+        conn, key = await self.history_conn_key(user_id)
+        values = await conn.hmget(key, *episodes_ids)
+        return {int(id): value == b'1' for id, value in zip(episodes_ids, values) if value is not None}
+
+    async def pop_history(self, user_id) -> Dict[int, bool]:
+        """Atomically take all pending changes of the user."""
+        main = await self.redis()
+        # user is unmarked before changes are taken so that changes queued in between stay marked
+        await main.zrem(self.generate_key(HISTORY_PENDING_KEY), user_id)
+        conn, key = await self.history_conn_key(user_id)
+        tr = conn.multi_exec()
+        data = tr.hgetall(key)
+        tr.delete(key)
+        await tr.execute()
+        return {int(id): value == b'1' for id, value in data.result().items()}
+
+    async def restore_history(self, user_id, changes: Dict[int, bool], max_attempts: int = None) -> Dict[int, bool]:
+        """
+        Return changes which failed to be written. Changes queued after them take precedence.
+        Failed attempts are counted per change, changes which failed `max_attempts` times are dropped.
+
+        :return: dropped changes
+        """
+        if not changes:
+            return {}
+        conn, key = await self.history_conn_key(user_id)
+        attempts_key = self.generate_key(HISTORY_ATTEMPTS_KEY, user_id)
+        pipe = conn.pipeline()
+        attempts = [pipe.hincrby(attempts_key, id) for id in changes]
+        pipe.expire(attempts_key, self.HISTORY_ATTEMPTS_EXPIRY)
+        await pipe.execute()
+        dropped = {}
+        pipe = conn.pipeline()
+        for (id, watched), fut in zip(changes.items(), attempts):
+            if max_attempts is not None and fut.result() >= max_attempts:
+                dropped[id] = watched
+                pipe.hdel(attempts_key, id)
+            else:
+                pipe.hsetnx(key, id, int(watched))
+        await pipe.execute()
+        if len(dropped) < len(changes):
+            await self.mark_history_pending(user_id)
+        return dropped
+
+    async def clear_history_attempts(self, user_id, episodes_ids: Iterable):
+        """Forget failed attempts of changes which were written or dropped."""
+        episodes_ids = list(episodes_ids)
+        if not episodes_ids:
+            return
+        conn = await self.shard(user_id)
+        await conn.hdel(self.generate_key(HISTORY_ATTEMPTS_KEY, user_id), *episodes_ids)
+
+    async def mark_history_pending(self, user_id):
+        """Remember when the oldest pending change of the user was queued."""
+        main = await self.redis()
+        await main.zadd(self.generate_key(HISTORY_PENDING_KEY), time(), user_id, exist=main.ZSET_IF_NOT_EXIST)
+
+    async def history_pending_users(self, queued_before: float = None) -> List[int]:
+        """Users with pending changes, optionally only those whose oldest change was queued before timestamp."""
+        main = await self.redis()
+        max = float('inf') if queued_before is None else queued_before
+        return [int(id) for id in await main.zrangebyscore(self.generate_key(HISTORY_PENDING_KEY), max=max)]
+
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+    # MESSAGE STATE
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+
+    MESSAGE_STATE_EXPIRY = int(timedelta(days=14).total_seconds())
+
+    async def message_state_conn_key(self, chat_id, message_id):
+        conn = await self.shard(chat_id)
+        return conn, self.generate_key(MESSAGE_STATE_KEY, chat_id, message_id)
+
+    async def get_message_state(self, chat_id, message_id) -> dict:
+        conn, key = await self.message_state_conn_key(chat_id, message_id)
+        data = await conn.hgetall(key)
+        return {field.decode(): self.codec.decode(value) for field, value in data.items()}
+
+    async def update_message_state(self, chat_id, message_id, state: dict):
+        """Update fields of message state, state expires in MESSAGE_STATE_EXPIRY after last update."""
+        if not state:
+            return
+        conn, key = await self.message_state_conn_key(chat_id, message_id)
+        tr = conn.multi_exec()
+        tr.hmset_dict(key, {field: self.codec.encode(value) for field, value in state.items()})
+        tr.expire(key, self.MESSAGE_STATE_EXPIRY)
+        await tr.execute()
+
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+    # PRERENDERED NOTIFICATIONS
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+
+    # how long prepared notification outlives its planned sending time, in case sending job is late
+    PRERENDER_EXPIRY = int(timedelta(minutes=30).total_seconds())
+
+    async def prerender_conn_key(self, user_id, job_id):
+        conn = await self.shard(user_id)
+        return conn, self.generate_key(PRERENDER_KEY, job_id)
+
+    async def save_prerendered(self, user_id, job_id, data: dict, expire: int = None):
+        """
+        Save notification prepared ahead of sending by job `job_id`.
+
+        :param expire: by default notification is expected to be sent right away
+        """
+        conn, key = await self.prerender_conn_key(user_id, job_id)
+        await conn.set(key, self.codec.encode(data), expire=expire or self.PRERENDER_EXPIRY)
+
+    async def pop_prerendered(self, user_id, job_id) -> Optional[dict]:
+        """Atomically take prepared notification so that it won't be sent twice."""
+        conn, key = await self.prerender_conn_key(user_id, job_id)
+        tr = conn.multi_exec()
+        data = tr.get(key)
+        tr.delete(key)
+        await tr.execute()
+        data = data.result()
+        return self.codec.decode(data) if data else None
+
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+    # DELIVERY QUEUE
+    # = = = = = = = = = = = = = = = = = = = = = = = =
+
+    DELIVERY_LOCK_EXPIRY = 60
+    DEAD_LETTERS_MAX = 1000
+    # remove delivered message and take chat off schedule if there is nothing left
+    POP_DELIVERY_SCRIPT = """
+    redis.call('LPOP', KEYS[1])
+    if redis.call('LLEN', KEYS[1]) == 0 then
+        redis.call('ZREM', KEYS[2], ARGV[1])
+    end
+    """
+    UNLOCK_DELIVERY_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        redis.call('DEL', KEYS[1])
+    end
+    """
+
+    async def push_delivery(self, chat_id, data: dict) -> int:
+        """
+        Append message to the chat delivery queue. Chat becomes due right away unless
+        it is already scheduled (e.g. waiting for retry). Return length of the queue.
+        """
+        conn = await self.redis()
+        tr = conn.multi_exec()
+        length = tr.rpush(self.generate_key(DELIVERY_KEY, chat_id), self.codec.encode(data))
+        tr.zadd(self.generate_key(DELIVERY_DUE_KEY), time(), chat_id, exist=conn.ZSET_IF_NOT_EXIST)
+        await tr.execute()
+        return length.result()
+
+    async def peek_delivery(self, chat_id) -> Optional[dict]:
+        conn = await self.redis()
+        return self.codec.decode(await conn.lindex(self.generate_key(DELIVERY_KEY, chat_id), 0))
+
+    async def update_delivery(self, chat_id, data: dict):
+        """Replace the first message of the chat delivery queue, e.g. to increase its attempts counter."""
+        conn = await self.redis()
+        await conn.lset(self.generate_key(DELIVERY_KEY, chat_id), 0, self.codec.encode(data))
+
+    async def pop_delivery(self, chat_id):
+        conn = await self.redis()
+        keys = [self.generate_key(DELIVERY_KEY, chat_id), self.generate_key(DELIVERY_DUE_KEY)]
+        await conn.eval(self.POP_DELIVERY_SCRIPT, keys=keys, args=[chat_id])
+
+    async def delay_delivery(self, chat_id, until: float):
+        conn = await self.redis()
+        await conn.zadd(self.generate_key(DELIVERY_DUE_KEY), until, chat_id)
+
+    async def delivery_delay(self, chat_id) -> Optional[float]:
+        """Time when chat is due for delivery or None if its queue is empty."""
+        conn = await self.redis()
+        return await conn.zscore(self.generate_key(DELIVERY_DUE_KEY), chat_id)
+
+    async def due_deliveries(self, now: float = None, count=100) -> List[str]:
+        """Chats which have messages to deliver right now."""
+        conn = await self.redis()
+        ids = await conn.zrangebyscore(self.generate_key(DELIVERY_DUE_KEY), max=now or time(), offset=0, count=count)
+        return [id.decode() for id in ids]
+
+    async def lock_delivery(self, chat_id) -> Optional[str]:
+        """Acquire exclusive right to deliver messages of the chat. Return lock token."""
+        conn = await self.redis()
+        token = str(uuid4())
+        ok = await conn.set(self.generate_key(DELIVERY_LOCK_KEY, chat_id), token,
+                            expire=self.DELIVERY_LOCK_EXPIRY, exist=conn.SET_IF_NOT_EXIST)
+        return token if ok else None
+
+    async def unlock_delivery(self, chat_id, token: str):
+        conn = await self.redis()
+        await conn.eval(self.UNLOCK_DELIVERY_SCRIPT, keys=[self.generate_key(DELIVERY_LOCK_KEY, chat_id)],
+                        args=[token])
+
+    async def dead_letter(self, chat_id, data: dict, error: str):
+        """Save message which cannot be delivered. Only DEAD_LETTERS_MAX latest messages are kept."""
+        conn = await self.redis()
+        key = self.generate_key(DELIVERY_DEAD_KEY)
+        entry = {'chat_id': chat_id, 'data': data, 'error': error, 'time': time()}
+        tr = conn.multi_exec()
+        tr.lpush(key, self.codec.encode(entry))
+        tr.ltrim(key, 0, self.DEAD_LETTERS_MAX - 1)
+        await tr.execute()
+
+    async def get_dead_letters(self, count=100) -> List[dict]:
+        conn = await self.redis()
+        return [self.codec.decode(v) for v in await conn.lrange(self.generate_key(DELIVERY_DEAD_KEY), 0, count - 1)]
+
     # = = = = = = = = = = = = = = = = = = = = = = = =
     # USER PREFERENCES
     # = = = = = = = = = = = = = = = = = = = = = = = =
 
-    async def get_pref(self, *, chat=None, user=None, default: dict = None) -> dict:
+    async def pref_conn_key(self, *, chat=None, user=None):
         chat, user = self.check_address(chat=chat, user=user)
-        key = self.generate_key(USER_PREF_KEY, chat, user)
-        redis = await self.redis()
-        raw_result = await redis.get(key, encoding='utf8')
+        conn = await self.shard(user)
+        return conn, self.generate_key(USER_PREF_KEY, chat, user)
+
+    async def migrate_pref(self, conn: aioredis.Redis, key):
+        """
+        Convert preferences stored as single serialized blob into hash.
+        Key is watched so that preferences written by concurrent migration aren't overwritten.
+        """
+        with await conn as conn:
+            while True:
+                await conn.watch(key)
+                try:
+                    raw_result = await conn.get(key)
+                except aioredis.ReplyError:
+                    await conn.unwatch()
+                    return  # already migrated
+                tr = conn.multi_exec()
+                tr.delete(key)
+                if raw_result:
+                    data = self.codec.decode(raw_result)
+                    tr.hmset_dict(key, {k: self.codec.encode(v) for k, v in data.items()})
+                try:
+                    await tr.execute()
+                    return
+                except aioredis.WatchVariableError:
+                    continue
+
+    async def pref_command(self, conn: aioredis.Redis, command: str, key, *args):
+        """
+        Execute hash command on preferences key.
+        Preferences which were saved in legacy format are migrated on the first access.
+        """
+        try:
+            return await getattr(conn, command)(key, *args)
+        except aioredis.ReplyError as e:
+            if not str(e).startswith('WRONGTYPE'):
+                raise
+        await self.migrate_pref(conn, key)
+        return await getattr(conn, command)(key, *args)
+
+    async def get_pref(self, *, chat=None, user=None, default: dict = None) -> dict:
+        conn, key = await self.pref_conn_key(chat=chat, user=user)
+        raw_result = await self.pref_command(conn, 'hgetall', key)
         if raw_result:
-            return json.loads(raw_result)
+            return {k.decode(): self.codec.decode(v) for k, v in raw_result.items()}
         return default or {}
 
+    async def get_pref_value(self, name: str, default=None, *, chat=None, user=None):
+        """Read single preference without fetching the rest of them."""
+        conn, key = await self.pref_conn_key(chat=chat, user=user)
+        raw_result = await self.pref_command(conn, 'hget', key, name)
+        if raw_result is None:
+            return default
+        return self.codec.decode(raw_result)
+
+    async def get_prefs_many(self, users_ids: Iterable, *names: str) -> Dict[str, dict]:
+        """
+        Read preferences `names` of multiple users, one pipeline per shard, shards are queried in parallel.
+        Preferences which are not set are omitted.
+        """
+        groups = defaultdict(list)
+        for user_id in users_ids:
+            groups[self.shards_ring.get_node(user_id) if self.shards_ring else None].append(str(user_id))
+
+        async def fetch(name, ids):
+            conn = await (self.shard_by_name(name) if name else self.redis())
+            pipe = conn.pipeline()
+            futs = [pipe.hmget(self.generate_key(USER_PREF_KEY, id, id), *names) for id in ids]
+            await pipe.execute(return_exceptions=True)
+            res = []
+            for user_id, fut in zip(ids, futs):
+                if fut.exception() is None:
+                    values = fut.result()
+                else:
+                    # legacy format, migrate it
+                    key = self.generate_key(USER_PREF_KEY, user_id, user_id)
+                    values = await self.pref_command(conn, 'hmget', key, *names)
+                res.append((user_id, values))
+            return res
+
+        res = {}
+        for pairs in await asyncio.gather(*(fetch(name, ids) for name, ids in groups.items())):
+            for user_id, values in pairs:
+                res[user_id] = {k: self.codec.decode(v) for k, v in zip(names, values) if v is not None}
+        return res
+
     async def set_pref(self, *, chat=None, user=None, **data):
-        chat, user = self.check_address(chat=chat, user=user)
-        key = self.generate_key(USER_PREF_KEY, chat, user)
-        redis = await self.redis()
-        await redis.set(key, json.dumps(data))
+        conn, key = await self.pref_conn_key(chat=chat, user=user)
+        tr = conn.multi_exec()
+        tr.delete(key)
+        if data:
+            tr.hmset_dict(key, {k: self.codec.encode(v) for k, v in data.items()})
+        await tr.execute()
 
     async def update_pref(self, *, chat=None, user=None, **data):
-        temp_data = await self.get_pref(chat=chat, user=user, default={})
-        temp_data.update(data)
-        await self.set_pref(chat=chat, user=user, **temp_data)
+        """Atomically update only specified preferences."""
+        if not data:
+            return
+        conn, key = await self.pref_conn_key(chat=chat, user=user)
+        data = {k: self.codec.encode(v) for k, v in data.items()}
+        await self.pref_command(conn, 'hmset_dict', key, data)
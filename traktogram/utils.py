@@ -1,13 +1,18 @@
+import asyncio
+import hashlib
+import json
 import math
 import string
 import textwrap
-from datetime import datetime
+from bisect import bisect
+from datetime import date, datetime
 from functools import singledispatch
 from types import FunctionType
-from typing import List
+from typing import Iterable, List
 
 import aioredis.util
 from aiogram.utils.callback_data import CallbackDataFilter
+from pydantic import BaseModel
 
 
 digs = string.digits + string.ascii_letters
@@ -74,6 +79,107 @@ def _(v: CallbackDataFilter):
     return f"CallbackDataFilter({v.config})"
 
 
+@singledispatch
+def normalize_key_arg(v):
+    """
+    Convert value into stable json-serializable form which is used for cache key hashing.
+    Objects with default ``repr`` (clients, sessions etc) can't be told apart by value,
+    such arguments should be excluded from the key (see `key_args` of cached calls).
+    """
+    if type(v).__repr__ is object.__repr__:
+        raise TypeError(f"{type(v).__qualname__} object can't be used as part of the key")
+    return repr(v)
+
+
+@normalize_key_arg.register(str)
+@normalize_key_arg.register(int)
+@normalize_key_arg.register(float)
+@normalize_key_arg.register(type(None))
+def _(v):
+    return v
+
+
+@normalize_key_arg.register(date)
+def _(v: date):
+    return v.isoformat()
+
+
+@normalize_key_arg.register(BaseModel)
+def _(v: BaseModel):
+    return normalize_key_arg(v.dict())
+
+
+@normalize_key_arg.register(dict)
+def _(v: dict):
+    return sorted((str(k), normalize_key_arg(e)) for k, e in v.items())
+
+
+@normalize_key_arg.register(list)
+@normalize_key_arg.register(tuple)
+def _(v):
+    return [normalize_key_arg(e) for e in v]
+
+
+@normalize_key_arg.register(set)
+@normalize_key_arg.register(frozenset)
+def _(v):
+    return sorted(map(normalize_key_arg, v), key=repr)
+
+
+def hash_key_args(*args, digest_size=16) -> str:
+    """Hash arguments into fixed length hex digest."""
+    data = json.dumps(normalize_key_arg(args), separators=(',', ':'))
+    return hashlib.blake2b(data.encode(), digest_size=digest_size).hexdigest()
+
+
+class HashRing:
+    """Consistent hashing ring. Adding or removing node remaps only ~1/N of the keys."""
+
+    def __init__(self, nodes: Iterable[str], replicas=128):
+        self.nodes = list(nodes)
+        self.ring = sorted(
+            (self.hash(f'{node}#{i}'), node)
+            for node in self.nodes
+            for i in range(replicas)
+        )
+        self.points = [point for point, _ in self.ring]
+
+    @staticmethod
+    def hash(key) -> int:
+        digest = hashlib.blake2b(str(key).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+
+    def get_node(self, key) -> str:
+        index = bisect(self.points, self.hash(key)) % len(self.points)
+        return self.ring[index][1]
+
+
+class Limiter:
+    """
+    Process-wide concurrency limit, share single instance between all callers.
+    Semaphore is bound to event loop so it is created lazily for the running loop.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._sem = None
+        self._loop = None
+
+    @property
+    def sem(self) -> asyncio.Semaphore:
+        loop = asyncio.get_event_loop()
+        if self._sem is None or self._loop is not loop:
+            self._sem = asyncio.Semaphore(self.limit)
+            self._loop = loop
+        return self._sem
+
+    async def __aenter__(self):
+        await self.sem.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self.sem.release()
+
+
 def parse_redis_uri(uri):
     (host, port), options = aioredis.util.parse_url(uri)
     return {
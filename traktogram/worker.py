@@ -1,7 +1,10 @@
+import asyncio
 import contextvars
 import logging
+from datetime import datetime
 from functools import wraps
-from typing import List
+from time import time
+from typing import Awaitable, Callable, List
 
 import arq
 from aiogram import Bot
@@ -10,16 +13,24 @@ from arq.connections import ArqRedis, RedisSettings
 from arq.constants import job_key_prefix
 from pydantic import BaseModel
 
-from traktogram.config import BOT_TOKEN, REDIS_URL
+from traktogram.codec import make_codec
+from traktogram.config import (
+    BOT_TOKEN, HISTORY_FLUSH_DELAY, REDIS_SHARDS, REDIS_URL, STORAGE_CODEC, STORAGE_COMPRESS_THRESHOLD,
+    SWEEP_BATCH_SIZE, SWEEP_CONCURRENCY,
+)
 from traktogram.logging_setup import setup_logging
 from traktogram.models import CalendarEpisode
-from traktogram.services import NotificationScheduler, TraktClient
-from traktogram.storage import Storage
+from traktogram.services import NotificationScheduler, TraktClient, delivery, history, parsing
+from traktogram.services.notifications import WatchUrls
+from traktogram.storage import Creds, Storage
 from traktogram.utils import parse_redis_uri
 
 
 logger = logging.getLogger(__name__)
 worker_queue_var = contextvars.ContextVar('worker_queue_var')
+# bot flushes history changes HISTORY_FLUSH_DELAY seconds after they were queued,
+# worker only picks up changes which bot should have flushed long ago
+HISTORY_FLUSH_GRACE = HISTORY_FLUSH_DELAY + 60
 
 
 class Context(BaseModel):
@@ -49,36 +60,131 @@ def without_context(f):
     return dec
 
 
-async def send_calendar_notifications(ctx: dict, user_id: str, ce: CalendarEpisode):
-    return await NotificationScheduler.send_calendar_notifications(ctx, user_id, ce)
+async def send_calendar_notifications(ctx: dict, user_id: str, ce: CalendarEpisode, urls: WatchUrls = None):
+    return await NotificationScheduler.send_calendar_notifications(ctx, user_id, ce, urls)
 
 
-async def send_calendar_multi_notifications(ctx: dict, user_id: str, episodes: List[CalendarEpisode]):
-    return await NotificationScheduler.send_calendar_multi_notifications(ctx, user_id, episodes)
+async def send_calendar_multi_notifications(ctx: dict, user_id: str, episodes: List[CalendarEpisode],
+                                            urls: WatchUrls = None):
+    return await NotificationScheduler.send_calendar_multi_notifications(ctx, user_id, episodes, urls)
+
+
+async def send_calendar_digest(ctx: dict, user_id: str, episodes: List[CalendarEpisode], urls: WatchUrls = None):
+    return await NotificationScheduler.send_calendar_digest(ctx, user_id, episodes, urls)
+
+
+async def warm_up_notifications(ctx: dict, bucket: datetime):
+    return await NotificationScheduler.warm_up_notifications(ctx, bucket)
+
+
+async def sweep_users(storage: Storage, func: Callable[[str, Creds], Awaitable], concurrency=SWEEP_CONCURRENCY):
+    """
+    Call `func` for every authenticated user.
+    Users are processed concurrently batch by batch while the next batch is fetched.
+    Failure for single user doesn't stop the sweep.
+    """
+    sem = asyncio.Semaphore(concurrency)
+
+    async def process(user_id, creds):
+        async with sem:
+            try:
+                await func(user_id, creds)
+            except Exception as e:
+                logger.exception(e)
+
+    async for batch in storage.creds_batches(count=SWEEP_BATCH_SIZE, validate=False):
+        await asyncio.gather(*(process(user_id, creds) for user_id, creds in batch))
 
 
 @with_context
 async def schedule_calendar_notifications(ctx: Context):
-    service = NotificationScheduler(ctx.redis)
-    async for user_id, creds in ctx.storage.creds_iter():
+    service = NotificationScheduler(ctx.redis, ctx.storage)
+
+    async def schedule(user_id, creds: Creds):
         sess = ctx.trakt.auth(creds.access_token)
         await service.schedule(sess, user_id)
 
+    await sweep_users(ctx.storage, schedule)
+
+
+@with_context
+async def schedule_user_notifications(ctx: Context, user_id, episodes: List[CalendarEpisode] = None):
+    """Schedule notifications of single user outside of bot handlers, e.g. right after authentication."""
+    creds = await ctx.storage.get_creds(user_id)
+    if creds is None:
+        return
+    sess = ctx.trakt.auth(creds.access_token)
+    service = NotificationScheduler(ctx.redis, ctx.storage)
+    await service.schedule(sess, user_id, episodes)
+
+
+@with_context
+async def flush_pending_history(ctx: Context):
+    """Write history changes which weren't flushed by bot (e.g. because it was restarted)."""
+    users_ids = await ctx.storage.history_pending_users(queued_before=time() - HISTORY_FLUSH_GRACE)
+    if not users_ids:
+        return
+    creds = await ctx.storage.get_creds_many(users_ids)
+    sem = asyncio.Semaphore(SWEEP_CONCURRENCY)
+
+    async def flush(user_id):
+        async with sem:
+            user_creds = creds.get(str(user_id))
+            if user_creds is None:
+                # user logged out
+                await ctx.storage.pop_history(user_id)
+                return
+            sess = ctx.trakt.auth(user_creds.access_token)
+            try:
+                dropped = await history.flush_history(sess, user_id, ctx.storage)
+                if dropped:
+                    await ctx.bot.send_message(user_id, f"failed to update watch history of {len(dropped)} "
+                                                        f"episode(s), trakt didn't accept the changes")
+            except Exception as e:
+                logger.exception(e)
+
+    await asyncio.gather(*(flush(user_id) for user_id in users_ids))
+
+
+@with_context
+async def retry_deliveries(ctx: Context):
+    """Resend notifications which failed to be delivered."""
+    sent = await delivery.retry_due(ctx.bot, ctx.storage)
+    if sent:
+        logger.debug(f"delivered {sent} delayed notifications")
+
 
 @with_context
 async def schedule_tokens_refresh(ctx: Context):
-    async for user_id, creds in ctx.storage.creds_iter():
+    async def refresh(user_id, creds: Creds):
         sess = ctx.trakt.auth(creds.access_token)
         tokens = await sess.refresh_token(creds.refresh_token)
         await ctx.storage.save_creds(user_id, tokens)
 
+    await sweep_users(ctx.storage, refresh)
+
+
+@with_context
+async def rebalance_shards(ctx: Context):
+    await ctx.storage.rebalance()
+
+
+async def schedule_rebalance(queue: ArqRedis, storage: Storage):
+    """Enqueue one-off rebalancing of users data if `REDIS_SHARDS` changed since the last one."""
+    if await storage.shards_changed():
+        await queue.enqueue_job(rebalance_shards.__name__, _job_id=rebalance_shards.__name__)
+
 
 async def on_startup(ctx: dict):
     NotificationScheduler.send_single_task_name = send_calendar_notifications.__name__
     NotificationScheduler.send_multi_task_name = send_calendar_multi_notifications.__name__
+    NotificationScheduler.send_digest_task_name = send_calendar_digest.__name__
+    NotificationScheduler.warm_up_task_name = warm_up_notifications.__name__
     ctx['trakt'] = TraktClient()
-    ctx['storage'] = Storage(REDIS_URL)
+    codec = make_codec(STORAGE_CODEC, STORAGE_COMPRESS_THRESHOLD)
+    ctx['storage'] = Storage(REDIS_URL, codec=codec, shards=REDIS_SHARDS)
     ctx['bot'] = Bot(BOT_TOKEN, parse_mode='html')
+    await schedule_rebalance(ctx['redis'], ctx['storage'])
 
 
 async def on_shutdown(ctx: dict):
@@ -86,6 +192,8 @@ async def on_shutdown(ctx: dict):
     await ctx['storage'].close()
     await ctx['storage'].wait_closed()
     await ctx['bot'].close()
+    logger.debug(f"parsing executor: {parsing.executor.metrics()}")
+    parsing.executor.shutdown()
 
 
 def get_redis_settings(**kwargs):
@@ -99,14 +207,18 @@ def get_redis_settings(**kwargs):
 async def get_tasks_keys(queue: ArqRedis, user_id):
     keys = await queue.keys(job_key_prefix + f'send_calendar_notifications-{user_id}-*')
     keys += await queue.keys(job_key_prefix + f'send_calendar_multi_notifications-{user_id}-*')
+    keys += await queue.keys(job_key_prefix + f'send_calendar_digest-{user_id}-*')
     return keys
 
 
 class WorkerConfig:
-    functions = (send_calendar_notifications, send_calendar_multi_notifications)
+    functions = (send_calendar_notifications, send_calendar_multi_notifications, send_calendar_digest,
+                 warm_up_notifications, schedule_user_notifications, rebalance_shards)
     cron_jobs = (
         cron(schedule_calendar_notifications, hour=0, minute=0, second=0),
         cron(schedule_tokens_refresh, weekday=1, hour=0, minute=0, second=0),
+        cron(flush_pending_history, second=30),
+        cron(retry_deliveries, second=set(range(0, 60, 5))),
     )
     keep_result = 0
     redis_settings = get_redis_settings()